@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""Benchmark the assembly and centre optimisation on synthetic ring images.
+
+Module stacks with known powder rings, a known misalignment of all four
+quadrants and known shifts of the quadrants relative to each other are
+generated for every detector. The assembly, the pyFAI integration and the
+centre optimisation are timed on them, and the offset found by the
+optimiser is compared with the true one, overall and for every quadrant.
+
+Run with ``python -m geoAssembler.benchmark --output results.json`` and
+pass ``--baseline`` with an earlier result file to flag regressions.
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+import json
+import logging
+import os.path
+import platform
+import sys
+import time
+
+import extra_geom
+import numpy as np
+import pyFAI
+
+from .defaults import DefaultGeometryConfig as Defaults
+from .geometry import AGIPDGeometry, DSSCGeometry, LPDGeometry
+from .optimiser import track_centre
+from .optimiser.utility import Integrator
+
+log = logging.getLogger(__name__)
+
+# Geometry files shipped with the extra_geom tests
+GEOM_FILES = {
+    'LPD': os.path.join(os.path.dirname(extra_geom.__file__), 'tests',
+                        'lpd_mar_18.h5'),
+    'DSSC': os.path.join(os.path.dirname(extra_geom.__file__), 'tests',
+                         'dssc_geo_june19.h5'),
+}
+# (loss, method) pairs of the centre optimisation benchmarks
+OPTIMISE_CASES = (('max', 'global'), ('profile', 'global'),
+                  ('annuli', 'global'), ('width', 'local'))
+# x, y shifts of the four quadrants relative to each other in pixels
+QUAD_SHIFTS = ((1, 0), (0, -1), (-1, 0), (0, 1))
+# Fields identifying a benchmark case in the result file
+KEY_FIELDS = ('detector', 'benchmark', 'loss', 'method', 'n_frames')
+
+
+def create_geometry(det, geom_file=None):
+    """Create the geometry of a detector at its fallback quad positions.
+
+    Parameters:
+        det (str): Name of the detector (AGIPD, LPD or DSSC)
+    Keywords:
+        geom_file (str): Geometry file for LPD and DSSC (default: the files
+                         of the extra_geom tests)
+    """
+    if det == 'AGIPD':
+        return AGIPDGeometry.from_quad_positions()
+    geom_file = geom_file or GEOM_FILES[det]
+    geom_class = {'LPD': LPDGeometry, 'DSSC': DSSCGeometry}[det]
+    return geom_class.from_h5_file_and_quad_positions(geom_file)
+
+
+def synthetic_rings(geom, misalignment=(0, 0), n_frames=1, n_rings=4,
+                    sample_dist_m=0.2, noise=0.05, seed=None,
+                    quad_shifts=None):
+    """Create module stacks with Gaussian powder rings.
+
+    The rings are centred on the beam, which is offset from the geometry
+    centre by the misalignment of the quadrants. Every quadrant can also
+    truly be shifted from where geom puts it, as if it was moved with
+    move_quad, so that the rings are offset by misalignment minus the shift
+    of the quadrant in its pixels. Their positions are spread over the
+    detector and their width is about 1.5 pixels. The pixels are placed
+    where the assembly puts them, square pixels of pixel_size like the
+    assembled image the optimiser works on, also for the hexagonal pixels
+    of DSSC.
+
+    Parameters:
+        geom (GeometryAssembler): Geometry of the detector
+    Keywords:
+        misalignment (tuple): x, y offset of the beam centre in pixels
+                              (default (0, 0))
+        n_frames (int): Number of frames, each with its own noise (default 1)
+        n_rings (int): Number of rings (default 4)
+        sample_dist_m (float): Distance from the detector to the sample
+                               (default 0.2)
+        noise (float): Standard deviation of the noise relative to the ring
+                       amplitude (default 0.05)
+        seed (int): Seed of the noise (default None)
+        quad_shifts (tuple): x, y shift in pixels of each of the four
+                             quadrants (default None: no shifts)
+
+    Returns:
+        tuple: Stack of frames (frames, modules, ss, fs) and the ring
+               positions in degrees 2theta
+    """
+    rng = np.random.default_rng(seed)
+    pixel_size = geom.pixel_size
+    amap = geom.assembly_map
+    # True pixel centres relative to the geometry centre
+    shifts = np.zeros((len(amap.x), 2))
+    if quad_shifts is not None:
+        for quad, first in Defaults.quad2index[geom.detector_name].items():
+            shifts[first:first + 4] = quad_shifts[quad - 1]
+    radii = pixel_size * np.hypot(
+        amap.x + 0.5 + shifts[:, 0, None, None] - misalignment[0],
+        amap.y + 0.5 + shifts[:, 1, None, None] - misalignment[1])
+    tth = np.degrees(np.arctan2(radii, sample_dist_m))
+
+    ring_radii = radii.max() * np.linspace(0.2, 0.8, n_rings)
+    ring_2th_deg = np.degrees(np.arctan2(ring_radii, sample_dist_m))
+    width_deg = np.degrees(np.arctan2(1.5 * pixel_size, sample_dist_m))
+
+    stack = np.zeros(tth.shape, dtype=np.float32)
+    for ring in ring_2th_deg:
+        stack += np.exp(-0.5 * ((tth - ring) / width_deg)**2)
+
+    frames = np.repeat(stack[None], n_frames, axis=0)
+    frames += rng.normal(1, noise, frames.shape).astype(np.float32)
+    return frames, ring_2th_deg
+
+
+def _time(func, repeat):
+    """Run func repeat times, return the result and the run times."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, times
+
+
+def _record(det, benchmark, n_frames, times=None, loss=None, method=None,
+            **extra):
+    """Collect the result of one benchmark case."""
+    record = dict(detector=det, benchmark=benchmark, loss=loss,
+                  method=method, n_frames=n_frames)
+    if times:
+        record.update(seconds=float(np.median(times)),
+                      best_seconds=float(np.min(times)),
+                      frames_per_second=n_frames / float(np.median(times)))
+    record.update(extra)
+    return record
+
+
+def bench_assembly(det, geom, frames, repeat=3):
+    """Time the assembly of every frame with position_all_modules.
+
+    The assembly map is built before the timing starts, so the result is the
+    steady state throughput of the GUI and the optimiser.
+    """
+    geom.position_all_modules(frames[0])
+
+    def assemble():
+        for module_stack in frames:
+            geom.position_all_modules(module_stack)
+    _, times = _time(assemble, repeat)
+    return _record(det, 'position_all_modules', len(frames), times)
+
+
+def bench_integration(det, geom, frames, sample_dist_m, repeat=3):
+    """Time the 2d pyFAI integration of the assembled mean frame."""
+    integrator = Integrator(geom, sample_dist_m)
+    image, _ = geom.position_all_modules(frames.mean(axis=0))
+    _, times = _time(lambda: integrator.integrate2d(image), repeat)
+    return _record(det, 'integrate2d', 1, times)
+
+
+def bench_optimise(det, geom, frames, ring_2th_deg, misalignment,
+                   sample_dist_m, loss, method, seed=None, quad_shifts=None):
+    """Time the centre optimisation of every frame and measure its error.
+
+    The frames are tracked with `track_centre`, so every frame after the
+    first is warm started from the previous solution. The error is the
+    distance to the misalignment minus the mean quadrant shift, and for
+    every quadrant to the misalignment minus its own shift. The optimiser
+    moves all quadrants together, so the quadrant errors can not get below
+    the distance of the quadrant shifts from their mean.
+    """
+    table, times = _time(lambda: track_centre(
+        geom, frames, sample_dist_m, bounds=[(-20, 20), (-20, 20)],
+        chunk_size=len(frames),
+        optimiser_kwargs=dict(ring_2th_deg=ring_2th_deg),
+        optimise_kwargs=dict(loss=loss, method=method, seed=seed),
+    ), 1)
+    shifts = np.zeros((4, 2)) if quad_shifts is None else np.array(quad_shifts)
+
+    def distance(target):
+        return np.hypot(table['x'] - target[0], table['y'] - target[1])
+    error = distance(misalignment - shifts.mean(axis=0))
+    quad_error = [float(distance(misalignment - shift).mean())
+                  for shift in shifts]
+    return _record(det, 'optimise', len(frames), times, loss=loss,
+                   method=method, error_px=float(error.mean()),
+                   max_error_px=float(error.max()),
+                   quad_error_px=quad_error,
+                   nfev=float(table['nfev'].mean()))
+
+
+def run_benchmarks(detectors=Defaults.detectors, frame_counts=(1, 8),
+                   optimise_cases=OPTIMISE_CASES, misalignment=(4.5, -3),
+                   quad_shifts=QUAD_SHIFTS, sample_dist_m=0.2, repeat=3,
+                   seed=0, geom_files=None):
+    """Run all benchmark cases, failing cases are recorded with their error.
+
+    Keywords:
+        detectors (tuple): Detectors to benchmark (default all)
+        frame_counts (tuple): Numbers of frames to assemble and optimise
+                              (default (1, 8))
+        optimise_cases (tuple): (loss, method) pairs of the centre
+                                optimisation (default OPTIMISE_CASES)
+        misalignment (tuple): x, y offset of all quadrants in pixels
+        quad_shifts (tuple): x, y shift of each quadrant in pixels (default
+                             QUAD_SHIFTS, None for no relative shifts)
+        sample_dist_m (float): Distance from the detector to the sample
+        repeat (int): Repetitions of the timed assembly and integration
+        seed (int): Seed of the noise and the optimiser (default 0)
+        geom_files (dict): Geometry files by detector name (default
+                           GEOM_FILES)
+
+    Returns:
+        list: One dict per benchmark case
+    """
+    geom_files = geom_files or {}
+    results = []
+
+    def run(det, benchmark, func, *args, **kwargs):
+        log.info('%s %s %s', det, benchmark, kwargs.get('loss', ''))
+        try:
+            results.append(func(*args, **kwargs))
+        except Exception as err:
+            log.warning('%s %s failed: %s', det, benchmark, err)
+            results.append(_record(det, benchmark, n_frames,
+                                   loss=kwargs.get('loss'),
+                                   method=kwargs.get('method'),
+                                   error=repr(err)))
+
+    for det in detectors:
+        geom = create_geometry(det, geom_files.get(det))
+        for n_frames in frame_counts:
+            frames, rings = synthetic_rings(geom, misalignment, n_frames,
+                                            sample_dist_m=sample_dist_m,
+                                            seed=seed,
+                                            quad_shifts=quad_shifts)
+            run(det, 'position_all_modules', bench_assembly, det, geom,
+                frames, repeat)
+            if n_frames == frame_counts[0]:
+                run(det, 'integrate2d', bench_integration, det, geom, frames,
+                    sample_dist_m, repeat)
+            for loss, method in optimise_cases:
+                run(det, 'optimise', bench_optimise, det, geom, frames,
+                    rings, misalignment, sample_dist_m, loss=loss,
+                    method=method, seed=seed, quad_shifts=quad_shifts)
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Find the cases which got slower or less accurate than a baseline.
+
+    Parameters:
+        results (list): Records of the current run
+        baseline (list): Records of an earlier run
+    Keywords:
+        tolerance (float): Allowed relative increase of the run time and of
+                           the centre error (default 0.2)
+
+    Returns:
+        list: (key, field, baseline value, current value) of every regression
+    """
+    def key(record):
+        return tuple(record.get(field) for field in KEY_FIELDS)
+    previous = {key(record): record for record in baseline}
+
+    regressions = []
+    for record in results:
+        old = previous.get(key(record))
+        if old is None:
+            continue
+        for field in ('seconds', 'error_px'):
+            if field not in record or field not in old:
+                continue
+            limit = old[field] * (1 + tolerance)
+            if field == 'error_px':
+                #  Sub pixel errors are within the noise
+                limit = max(limit, 0.5)
+            if record[field] > limit:
+                regressions.append((key(record), field, old[field],
+                                    record[field]))
+    return regressions
+
+
+def main(argv=None):
+    """Run the benchmarks and write the results to a json file."""
+    ap = ArgumentParser(description="""
+    Benchmark the assembly, integration and centre optimisation on synthetic
+    ring images with a known quadrant misalignment and known shifts of the
+    quadrants relative to each other.""")
+    ap.add_argument('--output', default='geoAssembler-benchmark.json',
+                    help='File to write the results to')
+    ap.add_argument('--det', nargs='+', default=list(Defaults.detectors),
+                    choices=Defaults.detectors,
+                    help='Detectors to benchmark (default all)')
+    ap.add_argument('--frames', nargs='+', type=int, default=[1, 8],
+                    help='Numbers of frames to benchmark (default 1 8)')
+    ap.add_argument('--optimise', nargs='*',
+                    default=['{}:{}'.format(*c) for c in OPTIMISE_CASES],
+                    help='loss:method pairs of the centre optimisation')
+    ap.add_argument('--repeat', type=int, default=3,
+                    help='Repetitions of the timed assembly and integration')
+    ap.add_argument('--seed', type=int, default=0,
+                    help='Seed of the noise and the optimiser')
+    ap.add_argument('--baseline', default=None,
+                    help='Earlier result file to compare with')
+    ap.add_argument('--tolerance', type=float, default=0.2,
+                    help='Allowed relative slow down compared to the baseline')
+    args = ap.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    results = run_benchmarks(
+        detectors=args.det,
+        frame_counts=args.frames,
+        optimise_cases=[tuple(case.split(':')) for case in args.optimise],
+        repeat=args.repeat,
+        seed=args.seed,
+    )
+    meta = dict(date=datetime.now().isoformat(), host=platform.node(),
+                python=platform.python_version(), numpy=np.__version__,
+                extra_geom=extra_geom.__version__, pyFAI=pyFAI.version)
+    with open(args.output, 'w') as f:
+        json.dump(dict(meta=meta, results=results), f, indent=1)
+    log.info('Results written to %s', args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for key, field, old, new in regressions:
+            log.warning('Regression in %s: %s %.4g -> %.4g',
+                        key, field, old, new)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
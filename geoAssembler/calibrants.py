@@ -22,3 +22,23 @@ for name, cell in _cells.items():
         cell.save(os.path.join(celldir, name))
 calibrants += list(_cells.keys())
 
+
+def get_calibrant(name, wavelength):
+    """Get a pyFAI calibrant object for a given material.
+
+    Parameters:
+        name (str): Name of the calibrant, see `calibrants`
+        wavelength (float): Beam wave length in m
+
+    Returns:
+        pyFAI.calibrant.Calibrant
+    """
+    try:
+        cal = pyFAI.calibrant.get_calibrant(name)
+        cal.set_wavelength(wavelength)
+    except KeyError:
+        # Not a pyFAI standard calibrant, use the cells defined here
+        cal_file = os.path.join(celldir, name+'.D')
+        cal = pyFAI.calibrant.Calibrant(cal_file, wavelength=wavelength)
+    return cal
+
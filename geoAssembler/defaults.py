@@ -1,6 +1,8 @@
 
 """Methods and Classes that handle different detectors and their defaults."""
 
+import os.path
+
 INC = 1
 
 class DefaultGeometryConfig:
@@ -39,7 +41,34 @@ class DefaultGeometryConfig:
                   'DSSC' : {1: 0, 2: 4, 3: 8, 4: 12},
                 }
 
+    # Quadrant moves of held keys are applied together every move_interval_ms,
+    # the step grows by move_acceleration with every move within
+    # move_burst_ms of the previous one, up to move_max_step pixels
+    move_interval_ms = 40
+    move_burst_ms = 250
+    move_acceleration = 1.2
+    move_max_step = 10
+
+    hover_rate = 30  # Hz, how often the pixel under the cursor is looked up
+
     canvas_margin = 300  # pixel, used as margin on each side of detector quadrants
+    train_cache_size = 2 * 1024**3  # bytes, memory budget of cached trains
+    prefetch_trains = 2  # trains read ahead on either side of the current one
+    prefetch_threads = 2  # background threads reading trains
+    hit_frames = 10  # brightest pulses averaged by the hits selection
+    run_trains = 10  # trains reduced by the run selection of the viewer
+    live_endpoint = 'tcp://localhost:4545'  # karabo-bridge of live data
+    live_queue_size = 4  # live images waiting for display, older are dropped
+    live_interval_ms = 200  # how often the viewer shows the newest image
+    live_average = 1  # trains in the rolling mean of live data
+    # Pixels (slow scan, fast scan) of the blocks sharing a common mode,
+    # the ASICs of AGIPD and DSSC and the sensor tiles of LPD
+    common_mode_blocks = {'AGIPD': (64, 64),
+                          'LPD': (32, 128),
+                          'DSSC': (64, 64)}
+    # directory of the run summaries, which make reopening runs fast
+    summary_cache_dir = os.path.join(os.path.expanduser('~'), '.cache',
+                                     'geoAssembler', 'runs')
     geom_sel_width = 114
 
     # Default colormaps
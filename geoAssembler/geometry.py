@@ -1,7 +1,10 @@
 """Provide AGIPD-D geometry information that supports quadrant moving."""
 
+from collections import namedtuple
+import copy
 import logging
 import tempfile
+import threading
 
 import h5py
 from extra_geom import (
@@ -15,6 +18,17 @@ from .defaults import DefaultGeometryConfig as Defaults
 
 log = logging.getLogger(__name__)
 
+# Position of every module pixel in the assembled image: the image size and
+# detector centre (y, x), and for each pixel its row and column relative to
+# the centre (arrays shaped like the module data)
+AssemblyMap = namedtuple('AssemblyMap', 'size_yx centre y x')
+# The inverse: for every pixel of the assembled image (without canvas) the
+# module and the flat pixel index within the module, -1 where there is none,
+# and the tile number of every module pixel
+LabelMap = namedtuple('LabelMap', 'module pixel tile')
+# The detector pixel at a position of the assembled image
+PixelLabel = namedtuple('PixelLabel', 'quadrant module tile ss fs')
+
 def _move_mod(module, inc):
     """Move module into an given direction.
 
@@ -47,8 +61,151 @@ class GeometryAssembler:
 
     def __init__(self, exgeom_obj):
         """The class is instanciated using an extra_geom geometry object."""
+        # The geometry may be moved in the GUI thread while a worker thread
+        # assembles data, the version tells which geometry a result used
+        self._lock = threading.RLock()
+        self.version = 0
         self.exgeom_obj = exgeom_obj
 
+    def __getstate__(self):
+        """Pickle without the lock, e.g. for worker processes.
+
+        The snapped geometry cached by extra_geom cannot be pickled either,
+        it is built again when needed.
+        """
+        state = self.__dict__.copy()
+        del state['_lock']
+        exgeom_obj = state['_exgeom_obj']
+        if getattr(exgeom_obj, '_snapped_cache', None) is not None:
+            exgeom_obj = copy.copy(exgeom_obj)
+            exgeom_obj._snapped_cache = None
+            state['_exgeom_obj'] = exgeom_obj
+        return state
+
+    def __setstate__(self, state):
+        """Restore a pickled geometry with a new lock."""
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    @property
+    def exgeom_obj(self):
+        """The extra_geom geometry object."""
+        return self._exgeom_obj
+
+    @exgeom_obj.setter
+    def exgeom_obj(self, exgeom_obj):
+        """Set a new geometry and drop everything cached for the old one."""
+        with self._lock:
+            self._exgeom_obj = exgeom_obj
+            self._assembly_map = None
+            self._label_map = None
+            self._flat_index = (None, None)  # ((size_yx, centre), index)
+            self.version += 1
+
+    @property
+    def assembly_map(self):
+        """Where each module pixel goes in the assembled image.
+
+        The map is built once per geometry from the snapped geometry and
+        reused by all assemblies until the geometry changes.
+        """
+        with self._lock:
+            if self._assembly_map is None:
+                self._assembly_map = self._build_assembly_map()
+            return self._assembly_map
+
+    def _build_assembly_map(self):
+        """Transform an index image of each tile to locate its pixels."""
+        size_yx, centre = self.snapped_geom._get_dimensions()
+        mod_shape = self.exgeom_obj.expected_data_shape[-2:]
+        pix_y = np.empty((len(self.modules),) + mod_shape, dtype=np.int32)
+        pix_x = np.empty_like(pix_y)
+
+        index = np.arange(np.prod(mod_shape)).reshape(mod_shape)
+        tiles_index = self.exgeom_obj.split_tiles(index)
+        for i, module in enumerate(self.snapped_geom.modules):
+            for j, tile in enumerate(module):
+                # Module pixel index of every pixel in the transformed tile
+                tile_index = tile.transform(tiles_index[j])
+                y, x = tile.corner_idx
+                h, w = tile.pixel_dims
+                yy, xx = np.mgrid[y:y + h, x:x + w]
+                pix_y[i].flat[tile_index] = yy
+                pix_x[i].flat[tile_index] = xx
+        return AssemblyMap(tuple(size_yx), np.array(centre), pix_y, pix_x)
+
+    @property
+    def label_map(self):
+        """Which module pixel is at each pixel of the assembled image.
+
+        Built with the assembly map, once per geometry version.
+        """
+        with self._lock:
+            if self._label_map is None:
+                self._label_map = self._build_label_map()
+            return self._label_map
+
+    def _build_label_map(self):
+        """Scatter module and pixel numbers like the data is assembled."""
+        amap = self.assembly_map
+        n_modules, n_ss, n_fs = amap.y.shape
+        yy, xx = amap.y + amap.centre[0], amap.x + amap.centre[1]
+        module = np.full(amap.size_yx, -1, dtype=np.int16)
+        pixel = np.full(amap.size_yx, -1, dtype=np.int32)
+        module[yy, xx] = np.arange(n_modules, dtype=np.int16)[:, None, None]
+        pixel[yy, xx] = np.arange(n_ss * n_fs, dtype=np.int32).reshape(n_ss,
+                                                                       n_fs)
+
+        tile = np.empty((n_ss, n_fs), dtype=np.int16)
+        index = np.arange(n_ss * n_fs).reshape(n_ss, n_fs)
+        for j, tile_index in enumerate(self.exgeom_obj.split_tiles(index)):
+            tile.flat[tile_index] = j
+        return LabelMap(module, pixel, tile)
+
+    def pixel_at(self, y, x, canvas=None):
+        """The detector pixel at a position of the assembled image.
+
+        Parameters:
+            y (int): Row in the assembled image
+            x (int): Column in the assembled image
+            canvas (tuple): Shape of the canvas the detector is embedded in,
+                            None for the detector alone (default)
+
+        Returns:
+            PixelLabel: quadrant (None if the detector has no quadrants),
+                        module, tile, slow scan and fast scan index of the
+                        pixel, None if there is no pixel at the position
+        """
+        with self._lock:
+            labels = self.label_map
+            _, centre = self.canvas_geometry(canvas)
+            y = int(y) - centre[0] + self.assembly_map.centre[0]
+            x = int(x) - centre[1] + self.assembly_map.centre[1]
+        size_y, size_x = labels.module.shape
+        if not (0 <= y < size_y and 0 <= x < size_x):
+            return None
+        module = int(labels.module[y, x])
+        if module < 0:
+            return None
+        ss, fs = divmod(int(labels.pixel[y, x]), labels.tile.shape[1])
+        quadrant = None
+        for quad, first in Defaults.quad2index.get(self.detector_name,
+                                                   {}).items():
+            if first <= module < first + 4:
+                quadrant = quad
+        return PixelLabel(quadrant, module, int(labels.tile[ss, fs]), ss, fs)
+
+    def _get_flat_index(self, size_yx, centre):
+        """Flat index into an image of a given size for each module pixel."""
+        key = (tuple(size_yx), tuple(centre))
+        with self._lock:
+            if key != self._flat_index[0]:
+                amap = self.assembly_map
+                index = np.ravel_multi_index((amap.y + centre[0],
+                                              amap.x + centre[1]), size_yx)
+                self._flat_index = (key, index)
+            return self._flat_index[1]
+
     @property
     def modules(self):
         """The karabo data geometry modules."""
@@ -105,7 +262,29 @@ class GeometryAssembler:
         dx = abs(max(X) - min(X))
         return (min(X)-2, min(Y)-2), dx+w+4, dy+4
 
-    def position_all_modules(self, data, canvas=None):
+    def canvas_geometry(self, canvas=None, margin=0):
+        """Shape and detector centre of an assembled image, without any data.
+
+        Parameters:
+            canvas (tuple): Shape of the canvas the detector is embedded in,
+                            None for the detector alone (default)
+            margin (int): Pixels added to the shape of the detector alone to
+                          get the canvas, if no canvas is given (default 0)
+
+        Returns:
+            tuple: (y, x) shape and (y, x) centre of the assembled image
+        """
+        with self._lock:
+            size_yx = self.assembly_map.size_yx
+            centre = self.assembly_map.centre.copy()
+        if canvas is None and margin:
+            canvas = tuple(np.array(size_yx) + margin)
+        if canvas is None:
+            return size_yx, centre
+        # Put the detector centre into the centre of the canvas
+        return tuple(canvas), np.array((canvas[0]//2, canvas[-1]//2))
+
+    def position_all_modules(self, data, canvas=None, out=None):
         """Assemble data from this detector according to where the pixels are.
 
         Parameters
@@ -117,6 +296,10 @@ class GeometryAssembler:
         canvas : ndarray
           The canvas the out array will be embeded in. If None is given
           (default) no embedding will be applied.
+        out : ndarray
+          C-contiguous array of the assembled shape and the dtype of data to
+          assemble into, reused instead of allocating a new one
+          (default None).
 
         Returns
         -------
@@ -126,28 +309,19 @@ class GeometryAssembler:
         centre : ndarray
           (y, x) pixel location of the detector centre in this geometry.
         """
-        if canvas is None:
-            size_yx, centre = self.snapped_geom._get_dimensions()
-            out = np.full(data.shape[:-3] + size_yx, np.nan, dtype=data.dtype)
-        else:
-            _, centre = self.snapped_geom._get_dimensions()
-            size_yx = canvas
-            cv_centre = (canvas[0]//2, canvas[-1]//2)
-            shift = np.array(centre) - np.array(cv_centre)
-            out = np.full(data.shape[:-3] + size_yx, np.nan, dtype=data.dtype)
-            out = np.roll(out, shift[0], axis=-2)
-            out = np.roll(out, shift[1], axis=-1)
-            centre -= shift
-        for i, module in enumerate(self.snapped_geom.modules):
-            mod_data = data[..., i, :, :]
-            tiles_data = self.exgeom_obj.split_tiles(mod_data)
-            for j, tile in enumerate(module):
-                tile_data = tiles_data[j]
-                # Offset by centre to make all coordinates positive
-                y, x = tile.corner_idx + centre
-                h, w = tile.pixel_dims
-                s = tile.transform(tile_data)
-                out[..., y: y + h, x: x + w] = tile.transform(tile_data)
+        with self._lock:
+            size_yx, centre = self.canvas_geometry(canvas)
+            index = self._get_flat_index(size_yx, centre)
+        shape = data.shape[:-3] + size_yx
+        if out is None:
+            out = np.empty(shape, dtype=data.dtype)
+        elif (out.shape != shape or out.dtype != data.dtype
+              or not out.flags.c_contiguous):
+            raise ValueError('out must be a contiguous array of the shape {} '
+                             'and dtype {}'.format(shape, data.dtype))
+        out.fill(np.nan)
+        flat = out.reshape(data.shape[:-3] + (-1,))
+        flat[..., index] = data
         return out, centre
 
     def write_crystfel_geom(self, filename, *,
@@ -1,9 +1,22 @@
 """Provide helper methods for the gui."""
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import glob
+import json
 import os
+import re
+import warnings
+
+from extra_data import by_id
+import h5py
+import numpy as np
 
 from .defaults import DefaultGeometryConfig as Defaults
 
+# Reductions of reduce_run
+REDUCTIONS = ('mean', 'sum', 'max', 'median')
+
 
 def read_geometry(detector, filename, quad_pos=None):
     """Create the correct geometry class for a given detector.
@@ -54,3 +67,588 @@ def write_geometry(geom, filename, logger):
     else:
         raise NotImplementedError('Detector Class not available')
 
+
+def run_fingerprint(run_path):
+    """Names, sizes and modification times of the files of a run.
+
+    Parameters:
+        run_path (str): Directory of the run
+
+    Returns:
+        str: JSON list of the files, which changes with any of the files
+    """
+    files = []
+    for path in sorted(glob.glob(os.path.join(run_path, '*.h5'))):
+        stat = os.stat(path)
+        files.append((os.path.basename(path), stat.st_size, stat.st_mtime_ns))
+    return json.dumps(files)
+
+
+def _module_data(run):
+    """Map the module numbers to the image.data KeyData of a run."""
+    modules = {}
+    for source in run.select('*/DET/*', 'image.data').instrument_sources:
+        match = re.search(r'/DET/(\d+)CH', source)
+        if match:
+            modules[int(match.group(1))] = run[source, 'image.data']
+    return modules
+
+
+@lru_cache(maxsize=256)
+def _memmap_dataset(filename, dataset_path, mtime_ns):
+    """Map a contiguous, unfiltered HDF5 dataset into memory, or None.
+
+    The modification time is only part of the cache key, so that rewritten
+    files are mapped again.
+    """
+    with h5py.File(filename, 'r') as f:
+        dset = f[dataset_path]
+        if (dset.chunks is not None or dset.is_virtual or dset.external
+                or dset.id.get_create_plist().get_nfilters()):
+            return None
+        offset = dset.id.get_offset()
+        if offset is None:
+            # Storage not allocated
+            return None
+        return np.memmap(filename, dtype=dset.dtype, mode='r', offset=offset,
+                         shape=dset.shape)
+
+
+def memmap_frames(key_data):
+    """Map the frames of a single train straight from its file.
+
+    Corrected data is usually stored contiguous and uncompressed, it can then
+    be used from the page cache without copying it through h5py.
+
+    Parameters:
+        key_data (KeyData): Data of one train of one source
+
+    Returns:
+        numpy.memmap: (frames, ...) read-only view of the file, or None if
+                      the dataset is chunked, filtered or virtual
+    """
+    rows = _train_rows(key_data)
+    if rows is None:
+        return None
+    file, first, count = rows
+    mapped = _memmap_dataset(file.filename, key_data.hdf5_data_path,
+                             os.stat(file.filename).st_mtime_ns)
+    if mapped is None:
+        return None
+    return mapped[first:first + count]
+
+
+def _train_rows(key_data):
+    """The file and the first row and count of a single train KeyData."""
+    if len(key_data.train_ids) != 1:
+        return None
+    tid = key_data.train_ids[0]
+    for file in key_data.files:
+        pos = np.nonzero(file.train_ids == tid)[0]
+        if len(pos):
+            firsts, counts = file.get_index(key_data.source,
+                                            key_data.index_group)
+            return file, int(firsts[pos[0]]), int(counts[pos[0]])
+    return None
+
+
+def _data_roi(key_data, preprocess=None):
+    """Select the data of raw data, which has an extra gain dimension."""
+    if key_data.ndim != 4:
+        return ()
+    return (preprocess.gain_index if preprocess else 0,)
+
+
+def _read_frames(key_data, roi, out=None, pulses=None):
+    """Read the frames of a single train, from a memory map if possible.
+
+    Only the frames at the (increasing) pulse indices are read if given.
+    """
+    frames = memmap_frames(key_data)
+    if frames is None:
+        if pulses is None:
+            return key_data.ndarray(roi=roi, out=out)
+        file, first, _ = _train_rows(key_data)
+        frames = file.file[key_data.hdf5_data_path][(first + pulses,) + roi]
+    else:
+        rows = slice(None) if pulses is None else pulses
+        frames = frames[(rows,) + roi]
+    if out is None:
+        return frames
+    np.copyto(out, frames)
+    return out
+
+
+def read_cells(key_data, pulses=None):
+    """Memory cell ids of the frames of a single train.
+
+    They are read from the image.cellId dataset next to the image data,
+    which has the same index.
+
+    Parameters:
+        key_data (KeyData): Image data of one train of one source
+    Keywords:
+        pulses (numpy.ndarray): Only the cells of these pulse indices
+                                (default all pulses)
+
+    Returns:
+        numpy.ndarray: Cell id of every frame, or None without cell ids
+    """
+    rows = _train_rows(key_data)
+    if rows is None:
+        return None
+    file, first, count = rows
+    path = key_data.hdf5_data_path.rsplit('/', 1)[0] + '/cellId'
+    try:
+        dset = file.file[path]
+    except KeyError:
+        return None
+    # Raw data stores (frames, 1) cell ids
+    cells = dset[first:first + count].reshape(count)
+    return cells if pulses is None else cells[pulses]
+
+
+def _frame_cells(key_data, preprocess, pulses=None):
+    """The cell ids of the frames, if the preprocessing depends on them."""
+    if preprocess is None or not preprocess.per_cell:
+        return None
+    return read_cells(key_data, pulses)
+
+
+def read_train(run, tid, n_modules=16, workers=None, preprocess=None):
+    """Read the image data of all detector modules in a train.
+
+    Every module is read by its own thread straight into one preallocated
+    buffer, without the intermediate per-module arrays of
+    stack_detector_data. Contiguous, uncompressed datasets are copied from
+    a memory map of the file instead of through h5py. h5py serialises its
+    calls with a global lock, so reads through h5py, decompression included,
+    run one at a time; the threads only overlap the memory map copies, with
+    their page cache I/O, and the preprocessing. The buffer is module-major,
+    so that every module is a contiguous block h5py can read into, and is
+    returned as a (pulses, modules, slow_scan, fast_scan) view.
+    Missing modules are NaN (or 0 for integer data).
+
+    Parameters:
+        run (DataCollection): Run (or selection) containing the detector
+        tid (int): Train id to read
+    Keywords:
+        n_modules (int): Number of detector modules (default 16)
+        workers (int): Number of reading threads (default one per module)
+        preprocess (Preprocessor): Read the data as float32 and preprocess
+                                   every module in place in its reading
+                                   thread (default the data as stored)
+
+    Returns:
+        numpy.ndarray: (pulses, modules, slow_scan, fast_scan)
+    """
+    sources = {modno: key_data.select_trains(by_id[[tid]])
+               for modno, key_data in _module_data(run).items()}
+    sources = {modno: key_data for modno, key_data in sources.items()
+               if key_data.shape[0]}
+    if not sources:
+        raise ValueError('No detector data in train {}'.format(tid))
+
+    first = next(iter(sources.values()))
+    shape = first.shape
+    roi = _data_roi(first, preprocess)
+    if any(key_data.shape != shape for key_data in sources.values()):
+        raise ValueError('Modules have different data shapes in train '
+                         '{}'.format(tid))
+
+    dtype = preprocess.dtype if preprocess else first.dtype
+    buf = np.empty((n_modules, shape[0]) + shape[-2:], dtype=dtype)
+    fill = np.nan if buf.dtype.kind == 'f' else 0
+    for modno in set(range(n_modules)) - set(sources):
+        buf[modno] = fill
+        if preprocess:
+            preprocess.process_module(buf[modno], modno,
+                                      _frame_cells(first, preprocess))
+
+    def read_module(modno):
+        _read_frames(sources[modno], roi, buf[modno])
+        if preprocess:
+            preprocess.process_module(
+                buf[modno], modno, _frame_cells(sources[modno], preprocess))
+
+    with ThreadPoolExecutor(workers or len(sources)) as pool:
+        # list() re-raises errors from the threads
+        list(pool.map(read_module, sources))
+
+    return buf.swapaxes(0, 1)
+
+
+class _Remedian:
+    """Approximate median of a stream of frames in bounded memory.
+
+    Frames are collected in groups of base frames, each full group is
+    replaced by its median on the next level (Rousseeuw & Bassett, 1990).
+    At most base frames are kept per level, base * log_base(frames) in all.
+    """
+
+    def __init__(self, base=15):
+        self.base = base
+        self.levels = []
+
+    def add(self, frame, level=0):
+        if level == len(self.levels):
+            self.levels.append([])
+        self.levels[level].append(frame)
+        if len(self.levels[level]) == self.base:
+            group, self.levels[level] = self.levels[level], []
+            with warnings.catch_warnings():
+                # All NaN pixels stay NaN
+                warnings.simplefilter('ignore', RuntimeWarning)
+                self.add(np.nanmedian(group, axis=0), level + 1)
+
+    def result(self):
+        """Weighted median of the frames left on all levels."""
+        values = np.array([frame for level in self.levels for frame in level])
+        weights = np.array([self.base**n for n, level in enumerate(self.levels)
+                            for _ in level], dtype=float)
+        weights = weights.reshape((-1,) + (1,) * (values.ndim - 1))
+        weights = np.where(np.isnan(values), 0, weights)
+        order = np.argsort(values, axis=0)  # NaN sorts last
+        values = np.take_along_axis(values, order, axis=0)
+        weights = np.take_along_axis(weights, order, axis=0)
+        cum_weights = np.cumsum(weights, axis=0)
+        idx = np.argmax(cum_weights >= cum_weights[-1] / 2, axis=0)
+        median = np.take_along_axis(values, idx[None], axis=0)[0]
+        median[cum_weights[-1] == 0] = np.nan
+        return median
+
+
+def _load_frames(train, modno, preprocess=None, pulses=None):
+    """Read the frames of one train of a module and preprocess them."""
+    frames = _read_frames(train, _data_roi(train, preprocess), pulses=pulses)
+    if preprocess is None:
+        return frames
+    # Memory maps are read-only, preprocess a float32 copy
+    frames = np.array(frames, dtype=preprocess.dtype)
+    return preprocess.process_module(
+        frames, modno, _frame_cells(train, preprocess, pulses))
+
+
+def _reduce_module(key_data, modno, method, base, preprocess):
+    """Reduce all frames of one module, reading one train at a time."""
+    total = count = peak = remedian = None
+    for train in key_data.split_trains(trains_per_part=1):
+        # Memory mapped float32 frames are reduced without any copy
+        frames = _load_frames(train, modno, preprocess).astype(
+            np.float32, copy=False)
+        if method == 'median':
+            remedian = remedian or _Remedian(base)
+            for frame in frames:
+                remedian.add(frame)
+        elif method == 'max':
+            frame_max = np.fmax.reduce(frames, axis=0)
+            peak = frame_max if peak is None else np.fmax(peak, frame_max)
+        else:
+            frame_sum = np.nansum(frames, axis=0, dtype=np.float64)
+            frame_count = np.isfinite(frames).sum(axis=0)
+            if total is None:
+                total, count = frame_sum, frame_count
+            else:
+                total += frame_sum
+                count += frame_count
+
+    if method == 'median':
+        return None if remedian is None else remedian.result()
+    if method == 'max':
+        return peak
+    if total is None:
+        return None
+    if method == 'sum':
+        return total.astype(np.float32)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (total / count).astype(np.float32)
+
+
+def reduce_run(run, method='mean', trains=None, n_modules=16, workers=None,
+               median_base=15, preprocess=None):
+    """Reduce all frames of a run, or a range of its trains, to one image.
+
+    The modules are reduced in parallel, each reading one train at a time,
+    so the memory needed is bounded by a train per worker whatever the
+    number of trains. The median is approximated with the remedian, which
+    keeps at most median_base * log(frames) frames of a module.
+
+    Parameters:
+        run (DataCollection): Run (or selection) containing the detector
+    Keywords:
+        method (str): Reduction of the frames, one of REDUCTIONS
+                      (default mean)
+        trains: Train selection, e.g. by_id[10000:10100] or by_index[:50]
+                (default all trains)
+        n_modules (int): Number of detector modules (default 16)
+        workers (int): Number of modules reduced in parallel
+                       (default all modules)
+        median_base (int): Group size of the approximate median (default 15)
+        preprocess (Preprocessor): Preprocessing of the frames before they
+                                   are reduced (default None)
+
+    Returns:
+        numpy.ndarray: (modules, slow_scan, fast_scan) float32, NaN for
+                       missing modules and pixels without valid data
+    """
+    if method not in REDUCTIONS:
+        raise ValueError('Unknown reduction {}, use one of {}'.format(
+            method, ', '.join(REDUCTIONS)))
+    if trains is not None:
+        run = run.select_trains(trains)
+    modules = _module_data(run)
+    if not modules:
+        raise ValueError('No detector data in the selected trains')
+
+    with ThreadPoolExecutor(workers or len(modules)) as pool:
+        results = dict(zip(modules, pool.map(
+            lambda item: _reduce_module(item[1], item[0], method,
+                                        median_base, preprocess),
+            modules.items())))
+
+    shapes = [res.shape for res in results.values() if res is not None]
+    if not shapes:
+        raise ValueError('No detector data in the selected trains')
+    out = np.full((n_modules,) + shapes[0], np.nan, dtype=np.float32)
+    for modno, res in results.items():
+        if res is not None:
+            out[modno] = res
+    return out
+
+
+def _reduce_module_cells(key_data, modno):
+    """Sum and count of the frames of every memory cell of one module."""
+    sums = {}
+    for train in key_data.split_trains(trains_per_part=1):
+        frames = _load_frames(train, modno).astype(np.float32, copy=False)
+        cells = read_cells(train)
+        if cells is None:
+            cells = np.arange(len(frames))
+        for cell in np.unique(cells):
+            cell_frames = frames[cells == cell]
+            frame_sum = np.nansum(cell_frames, axis=0, dtype=np.float64)
+            frame_count = np.isfinite(cell_frames).sum(axis=0)
+            if cell in sums:
+                sums[cell][0] += frame_sum
+                sums[cell][1] += frame_count
+            else:
+                sums[cell] = [frame_sum, frame_count]
+    return sums
+
+
+def reduce_cells(run, trains=None, n_modules=16, workers=None):
+    """Mean image of every memory cell of a run.
+
+    The frames are told apart by their image.cellId, or by their pulse
+    index in the train if the data has no cell ids. The modules are reduced
+    in parallel like in reduce_run.
+
+    Parameters:
+        run (DataCollection): Run (or selection) containing the detector
+    Keywords:
+        trains: Train selection, e.g. by_id[10000:10100] or by_index[:50]
+                (default all trains)
+        n_modules (int): Number of detector modules (default 16)
+        workers (int): Number of modules reduced in parallel
+                       (default all modules)
+
+    Returns:
+        tuple: (cells, modules, slow_scan, fast_scan) float32 means, NaN
+               for missing modules and pixels, and the increasing cell ids
+    """
+    if trains is not None:
+        run = run.select_trains(trains)
+    modules = _module_data(run)
+    if not modules:
+        raise ValueError('No detector data in the selected trains')
+
+    with ThreadPoolExecutor(workers or len(modules)) as pool:
+        results = dict(zip(modules, pool.map(
+            lambda item: _reduce_module_cells(item[1], item[0]),
+            modules.items())))
+
+    cells = sorted({cell for sums in results.values() for cell in sums})
+    if not cells:
+        raise ValueError('No detector data in the selected trains')
+    shape = next(total.shape for sums in results.values()
+                 for total, _ in sums.values())
+    out = np.full((len(cells), n_modules) + shape, np.nan, dtype=np.float32)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for modno, sums in results.items():
+            for row, cell in enumerate(cells):
+                if cell in sums:
+                    total, count = sums[cell]
+                    out[row, modno] = total / count
+    return out, np.array(cells)
+
+
+def frame_intensity(frames):
+    """Mean intensity of every frame of a stack, ignoring NaN.
+
+    The frames are summed module by module, so the temporary arrays stay
+    small for the (pulses, modules, ss, fs) views of read_train.
+
+    Parameters:
+        frames (numpy.ndarray): (frames, modules, slow_scan, fast_scan)
+
+    Returns:
+        numpy.ndarray: Mean intensity of each frame, NaN for empty frames
+    """
+    total = np.zeros(len(frames))
+    count = np.zeros(len(frames))
+    for modno in range(frames.shape[1]):
+        module = frames[:, modno]
+        valid = np.isfinite(module)
+        total += np.sum(module, axis=(1, 2), where=valid, dtype=np.float64)
+        count += valid.sum(axis=(1, 2))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / count
+
+
+def select_hits(intensity, top_n=None, threshold=None):
+    """Indices of the brightest frames.
+
+    Parameters:
+        intensity (numpy.ndarray): Intensity of every frame
+    Keywords:
+        top_n (int): Keep only the top_n brightest frames (default all)
+        threshold (float): Keep only frames at least this bright
+                           (default all)
+
+    Returns:
+        numpy.ndarray: Increasing indices of the selected frames
+    """
+    intensity = np.asarray(intensity, dtype=float)
+    selected = np.nonzero(np.isfinite(intensity))[0]
+    if threshold is not None:
+        selected = selected[intensity[selected] >= threshold]
+    if top_n is not None and len(selected) > top_n:
+        brightest = np.argpartition(-intensity[selected], top_n - 1)[:top_n]
+        selected = selected[brightest]
+    return np.sort(selected)
+
+
+def hit_mean(frames, top_n=None, threshold=None):
+    """Average only the brightest frames of a stack.
+
+    Weak or empty frames dilute the rings in the mean of all frames.
+
+    Parameters:
+        frames (numpy.ndarray): (frames, modules, slow_scan, fast_scan)
+    Keywords:
+        top_n (int): Average the top_n brightest frames (default all)
+        threshold (float): Average the frames at least this bright
+                           (default all)
+
+    Returns:
+        numpy.ndarray: (modules, slow_scan, fast_scan)
+    """
+    selected = select_hits(frame_intensity(frames), top_n, threshold)
+    if not len(selected):
+        raise ValueError('No frames above the threshold')
+    with warnings.catch_warnings():
+        # All NaN pixels stay NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmean(frames[selected], axis=0)
+
+
+def _module_intensity(key_data, modno, preprocess):
+    """Sum and count of the valid pixels of every frame of one module."""
+    sums = {}
+    for train in key_data.split_trains(trains_per_part=1):
+        frames = _load_frames(train, modno, preprocess)
+        valid = np.isfinite(frames)
+        sums[int(train.train_ids[0])] = (
+            np.sum(frames, axis=(1, 2), where=valid, dtype=np.float64),
+            valid.sum(axis=(1, 2)))
+    return sums
+
+
+def _module_hit_sum(key_data, modno, hits, preprocess):
+    """Sum and count of the selected frames of one module."""
+    total = count = None
+    for tid, pulses in hits.items():
+        train = key_data.select_trains(by_id[[tid]])
+        if not train.shape[0]:
+            continue
+        frames = _load_frames(train, modno, preprocess, pulses)
+        frame_sum = np.nansum(frames, axis=0, dtype=np.float64)
+        frame_count = np.isfinite(frames).sum(axis=0)
+        if total is None:
+            total, count = frame_sum, frame_count
+        else:
+            total += frame_sum
+            count += frame_count
+    return total, count
+
+
+def reduce_hits(run, top_n=None, threshold=None, trains=None, n_modules=16,
+                workers=None, preprocess=None):
+    """Average the brightest frames of a run, or a range of its trains.
+
+    The frame intensities of all modules are streamed over the trains
+    first, then only the selected frames are read again and averaged. Both
+    passes run in parallel over the modules.
+
+    Parameters:
+        run (DataCollection): Run (or selection) containing the detector
+    Keywords:
+        top_n (int): Average the top_n brightest frames (default all)
+        threshold (float): Average the frames whose mean intensity is at
+                           least this (default all)
+        trains: Train selection, e.g. by_id[10000:10100] or by_index[:50]
+                (default all trains)
+        n_modules (int): Number of detector modules (default 16)
+        workers (int): Number of modules read in parallel
+                       (default all modules)
+        preprocess (Preprocessor): Preprocessing of the frames before their
+                                   intensity is measured (default None)
+
+    Returns:
+        tuple: (modules, slow_scan, fast_scan) float32 mean of the selected
+               frames and a list of their (train id, pulse index)
+    """
+    if trains is not None:
+        run = run.select_trains(trains)
+    modules = _module_data(run)
+    if not modules:
+        raise ValueError('No detector data in the selected trains')
+
+    with ThreadPoolExecutor(workers or len(modules)) as pool:
+        module_sums = list(pool.map(
+            lambda item: _module_intensity(item[1], item[0], preprocess),
+            modules.items()))
+
+    # Combine the modules to the mean intensity of every frame
+    frame_ids, intensity = [], []
+    for tid in sorted(set().union(*module_sums)):
+        parts = [sums[tid] for sums in module_sums if tid in sums]
+        if len({len(total) for total, _ in parts}) != 1:
+            raise ValueError('Modules have different numbers of frames in '
+                             'train {}'.format(tid))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            intensity.append(sum(total for total, _ in parts)
+                             / sum(count for _, count in parts))
+        frame_ids += [(tid, pulse) for pulse in range(len(parts[0][0]))]
+    selected = select_hits(np.concatenate(intensity), top_n, threshold)
+    if not len(selected):
+        raise ValueError('No frames above the threshold')
+
+    hits = {}
+    for idx in selected:
+        tid, pulse = frame_ids[idx]
+        hits.setdefault(tid, []).append(pulse)
+    hits = {tid: np.array(pulses) for tid, pulses in hits.items()}
+
+    with ThreadPoolExecutor(workers or len(modules)) as pool:
+        results = dict(zip(modules, pool.map(
+            lambda item: _module_hit_sum(item[1], item[0], hits, preprocess),
+            modules.items())))
+
+    module_shape = next(iter(modules.values())).entry_shape[-2:]
+    out = np.full((n_modules,) + module_shape, np.nan, dtype=np.float32)
+    for modno, (total, count) in results.items():
+        if total is not None:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                out[modno] = total / count
+    return out, [frame_ids[idx] for idx in selected]
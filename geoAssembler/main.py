@@ -5,6 +5,7 @@ from argparse import ArgumentParser
 import logging
 from pathlib import Path
 
+from .defaults import DefaultGeometryConfig as Defaults
 from .nb import create_nb, NB_FILE, NB_DIR
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
@@ -38,6 +39,10 @@ def main(argv=None):
                     help='Select a cfel geometry file (default None)')
     ap.add_argument('--level', nargs=2, default=[0, 10000], type=float,
                     help='Pre defined display range for plotting')
+    ap.add_argument('--cache_size', default=None, type=float,
+                    help='Memory budget of the train cache in GB '
+                         '(default {})'.format(
+                             Defaults.train_cache_size / 1024**3))
     ap.add_argument('--test', default=False, action='store_true',
                     help='Test mode')
     ap.add_argument('--det', default='AGIPD', choices=('AGIPD', 'LPD'),
@@ -54,6 +59,9 @@ def main(argv=None):
         )
     else:
         from .qt import run_gui
+        cache_size = None
+        if args.cache_size is not None:
+            cache_size = int(args.cache_size * 1024**3)
         if args.test:
             from tempfile import TemporaryDirectory
             from geoAssembler.tests.utils import create_test_directory
@@ -61,9 +69,11 @@ def main(argv=None):
                 log.info('Creating temp data in {}...'.format(td))
                 create_test_directory(td, det=args.det)
                 log.info('...done')
-                run_gui(td, args.geometry, levels=args.level)
+                run_gui(td, args.geometry, levels=args.level,
+                        cache_size=cache_size)
         else:
-            run_gui(args.rundir, args.geometry, levels=args.level)
+            run_gui(args.rundir, args.geometry, levels=args.level,
+                    cache_size=cache_size)
 
 
 if __name__ == '__main__':
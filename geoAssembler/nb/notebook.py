@@ -207,10 +207,10 @@ class MainWidget:
         else:
             self.geom = geometry
 
-        data, _ = self.geom.position_all_modules(self.raw_data)
-        # Create a canvas
-        self.canvas = np.full(np.array(data.shape) + Defaults.canvas_margin,
-                              np.nan)
+        # Create a canvas, reused by every update of the plot
+        canvas_shape, _ = self.geom.canvas_geometry(
+            margin=Defaults.canvas_margin)
+        self.canvas = np.empty(canvas_shape, dtype=self.raw_data.dtype)
         self._add_widgets()
         self.update_plot(plot_range=(self.vmin, self.vmax), **kwargs)
         self.rect = None
@@ -221,12 +221,11 @@ class MainWidget:
     @property
     def centre(self):
         """Return the centre of the image (beam)."""
-        return self.geom.position_all_modules(self.raw_data)[1]
+        return self.geom.canvas_geometry()[1]
 
     def draw_shape(self, shape_type, size, num, angle=0):
         """Draw helper object and add it to the shapess collection."""
-        _, centre = self.geom.position_all_modules(self.raw_data,
-                                                canvas=self.canvas.shape)
+        _, centre = self.geom.canvas_geometry(self.canvas.shape)
         if shape_type.lower() == 'circle':
             self.shapes[num] = CircleShape(centre, size,
                                        self.ax, self.aspect,
@@ -321,7 +320,8 @@ class MainWidget:
                     cmap=Defaults.cmaps[0], **kwargs):
         """Update the plotted image."""
         self.data, cnt = self.geom.position_all_modules(self.raw_data,
-                                                        self.canvas.shape)
+                                                        self.canvas.shape,
+                                                        out=self.canvas)
         cy, cx = cnt
         if self.im is not None:
             if plot_range is not None:
@@ -1,6 +1,5 @@
 """Define the Widget tabs that are using in CalibrateNb."""
 
-import os
 import logging
 
 from ipywidgets import widgets, Layout
@@ -11,7 +10,7 @@ import pyFAI.calibrant
 from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
 from scipy import constants
 
-from ..calibrants import calibrants, celldir
+from ..calibrants import calibrants, get_calibrant
 log = logging.getLogger(__name__)
 
 
@@ -386,18 +385,11 @@ class MaterialTab(widgets.VBox):
         """Draw the ring structure with pyFAI."""
         if self.calibrant is 'None':
             return
-        try:
-            cal = pyFAI.calibrant.get_calibrant(self.calibrant)
-            cal.set_wavelength(self.wave_length)
-        except KeyError:
-            cal_file = os.path.join(celldir, self.calibrant+'.D')
-            cal = pyFAI.calibrant.Calibrant(cal_file,
-                                            wavelength=self.wave_length)
-        data, centre = self.parent.geom.position_all_modules(self.parent.raw_data,
-                                                             canvas=self.parent.canvas.shape)
+        cal = get_calibrant(self.calibrant, self.wave_length)
+        shape, centre = self.parent.geom.canvas_geometry(self.parent.canvas.shape)
         det = pyFAI.detectors.Detector(self.pxsize * self.parent.aspect,
                                        self.pxsize)
-        det.shape = data.shape
+        det.shape = shape
         det.max_shape = det.shape
         cx, cy = centre
         ai = AzimuthalIntegrator(dist=self.cdist,
@@ -1 +1,3 @@
 from .centre import CentreOptimiser
+from .drift import track_centre
+from .mask import detect_bad_pixels, edge_mask, load_mask
@@ -1,11 +1,19 @@
 from collections import namedtuple
-from typing import Union, Tuple
+from typing import Sequence, Tuple, Union
 
 import numpy as np
+from extra_data.reader import DataCollection
 from extra_geom.detectors import DetectorGeometryBase
-from scipy.optimize import differential_evolution
+from scipy import constants
+from scipy.optimize import OptimizeResult, differential_evolution, minimize
+from scipy.signal import find_peaks, peak_widths
 
-from .utility import Integrator
+from .mask import detect_bad_pixels, edge_mask, load_mask
+from .trace import LossStages, LossTracer, OptimisationCancelled
+from .utility import Integrator, RadialProfiler
+from ..calibrants import get_calibrant
+from ..geometry import GeometryAssembler
+from ..io_utils import reduce_run
 
 
 class CentreOptimiser:
@@ -17,29 +25,127 @@ class CentreOptimiser:
     value at a radial bin should be the one where the diffraction
     rings form as straight a line as possible, and the rings becoming
     straight lines in polar coordinates indicates an accurate centre.
+
+    If the expected ring positions are known, either directly or from a
+    calibrant and the photon energy, the optimisation can instead score the
+    intensity at those positions. The sample distance can then be optimised
+    together with the centre. The in-plane pixel coordinates are cached
+    once, so each candidate distance only rescales the radii.
+
+    Bad pixels, given as a static mask, detected automatically, or along the
+    tile edges, are excluded from the assembled frame and the cached pixels.
     """
-    def __init__(self, geom: DetectorGeometryBase,
+    def __init__(self, geom: Union[DetectorGeometryBase, GeometryAssembler],
                  module_stack: np.ndarray, sample_dist_m: Union[int, float],
-                 unit: str = "2th_deg"):
+                 unit: str = "2th_deg",
+                 ring_2th_deg: Sequence[float] = None,
+                 calibrant: str = None, energy_ev: Union[int, float] = None,
+                 annulus_deg: float = 0.1, n_peaks: int = 4,
+                 peak_window_deg: float = None,
+                 peak_window_sigmas: float = 4,
+                 mask: Union[np.ndarray, str] = None, edge_width: int = 0,
+                 bad_pixel_sigma: float = None):
         """Init function
 
         Parameters
         ----------
-        geom : DetectorGeometryBase
-            Initial geometry used for the optimisation
+        geom : Union[DetectorGeometryBase, GeometryAssembler]
+            Initial geometry used for the optimisation, either an extra_geom
+            geometry or the `GeometryAssembler` edited in the GUI/notebook,
+            whose cached assembly map is then reused
         module_stack : np.ndarray
-            Stack of module data, returned by `stack_detector_data`
+            Stack of module data, returned by `stack_detector_data`. It is
+            only used for the assembly and not kept by the optimiser
         sample_dist_m : Union[int, float]
             Distance from the detector to the sample
         unit : str, optional
             Units used for the pyFAI integrator, by default "2th_deg"
+        ring_2th_deg : Sequence[float], optional
+            Expected 2theta positions of the rings in degrees, required for
+            the ring based losses, by default None
+        calibrant : str, optional
+            Name of the calibrant (see `geoAssembler.calibrants`) used to
+            compute `ring_2th_deg`, requires `energy_ev`, by default None
+        energy_ev : Union[int, float], optional
+            Photon energy in eV, by default None
+        annulus_deg : float, optional
+            Half width of the annuli around the expected rings used by the
+            "annuli" loss, in degrees 2theta, by default 0.1
+        n_peaks : int, optional
+            Number of the strongest rings whose width is scored by the
+            "width" loss, by default 4
+        peak_window_deg : float, optional
+            Half width of the window around each ring used to estimate its
+            width, in degrees 2theta, by default None to choose it from
+            `peak_window_sigmas`
+        peak_window_sigmas : float, optional
+            Half width of the window around each ring in units of the ring
+            width (standard deviation), which is measured in narrow
+            azimuthal sectors. At most half the distance to the next scored
+            ring, by default 4
+        mask : Union[np.ndarray, str], optional
+            Static mask in the module data layout, True for bad pixels, or
+            the path of a mask file (see `mask.load_mask`), by default None
+        edge_width : int, optional
+            Also mask this many pixels along the edges of every tile, by
+            default 0
+        bad_pixel_sigma : float, optional
+            If set, also mask dead pixels and hot pixels deviating by more
+            than this many standard deviations from their neighbours (see
+            `mask.detect_bad_pixels`), by default None
         """
-        self.module_stack = module_stack
-        self.frame, _ = geom.position_modules_fast(self.module_stack)
+        if calibrant is not None:
+            if energy_ev is None:
+                raise ValueError("A calibrant requires the photon energy")
+            wavelength = constants.h * constants.c / (energy_ev * constants.eV)
+            ring_2th_deg = np.degrees(
+                get_calibrant(calibrant, wavelength).get_2th()
+            )
+
+        masks = []
+        if mask is not None:
+            masks.append(load_mask(mask) if isinstance(mask, str) else mask)
+        if edge_width:
+            masks.append(edge_mask(geom, edge_width))
+        if bad_pixel_sigma is not None:
+            masks.append(detect_bad_pixels(module_stack, bad_pixel_sigma))
 
-        self.integrator = Integrator(geom, sample_dist_m, unit)
+        self.mask = np.logical_or.reduce(masks) if masks else None
+        if self.mask is not None:
+            #  Masked pixels become NaN, so that pyFAI ignores them and the
+            #  profiler drops them from its pixel arrays once
+            module_stack = np.where(self.mask, np.nan, module_stack)
+
+        if isinstance(geom, GeometryAssembler):
+            self.frame, _ = geom.position_all_modules(module_stack)
+        else:
+            self.frame, _ = geom.position_modules_fast(module_stack)
+
+        #  pyFAI skips the masked pixels, and the gaps, of every evaluation
+        self.integrator = Integrator(
+            geom, sample_dist_m, unit,
+            mask=None if self.mask is None else ~np.isfinite(self.frame)
+        )
         self.integrate2d = self.integrator.integrate2d
 
+        self.sample_dist_m = sample_dist_m
+        self.ring_2th_deg = ring_2th_deg
+        self.annulus_deg = annulus_deg
+        self.n_peaks = n_peaks
+        self.peak_window_deg = peak_window_deg
+        self.peak_window_sigmas = peak_window_sigmas
+        if isinstance(geom, GeometryAssembler):
+            self.profiler = RadialProfiler.from_modules(
+                module_stack, geom.assembly_map, geom.pixel_size
+            )
+        else:
+            self.profiler = RadialProfiler.from_frame(
+                self.frame, self.integrator.centre, geom.pixel_size
+            )
+        self._profile_bins = None  # (npt, tth_range, ring_bin_idx)
+        self._annuli = None  # (profiler, ring_2th_deg)
+        self._peak_windows = None  # (region_idx, region_valid, half_width)
+
         #  Slightly dodgy way to pull the quadrant corner positions out of geom
         #  TODO: Suggest adding this in to extra-geom?
         self.original_quadrant_pos = [
@@ -48,6 +154,40 @@ class CentreOptimiser:
             in geom.modules
         ][::4]
 
+    @classmethod
+    def from_run(cls, geom: Union[DetectorGeometryBase, GeometryAssembler],
+                 run: DataCollection, sample_dist_m: Union[int, float],
+                 method: str = "mean", trains=None, workers: int = None,
+                 **kwargs) -> "CentreOptimiser":
+        """
+        Create the optimiser for the frames of a run reduced to one image,
+        which shows weak rings far more clearly than a single train.
+
+        Parameters
+        ----------
+        geom : Union[DetectorGeometryBase, GeometryAssembler]
+            Initial geometry used for the optimisation
+        run : DataCollection
+            extra_data run (or selection) containing the detector
+        sample_dist_m : Union[int, float]
+            Distance from the detector to the sample
+        method : str, optional
+            Reduction of the frames, "mean", "sum", "max" or "median", by
+            default "mean"
+        trains : optional
+            Train selection, e.g. `by_id[10000:10100]`, by default all trains
+        workers : int, optional
+            Number of modules read in parallel, by default all modules
+        **kwargs
+            Passed on to `CentreOptimiser`
+
+        Returns
+        -------
+        CentreOptimiser
+        """
+        module_stack = reduce_run(run, method, trains, workers=workers)
+        return cls(geom, module_stack, sample_dist_m, **kwargs)
+
     def _loss_function(self, centre_offset: Tuple[float, float]):
         """
         Simple cost function which computes the 1d azimuthal integration
@@ -67,49 +207,534 @@ class CentreOptimiser:
         float
             Value of the cost function, 1/max(1d_integration_value[100:-100])
         """
-        res = self.integrator.integrate2d(
+        return self._reduce_max(self._integrate_pyfai(centre_offset))
+
+    def _integrate_pyfai(self, centre_offset: Tuple[float, float]):
+        """2d pyFAI integration result for a centre offset."""
+        return self.integrator.integrate2d(
             self.frame,
             centre_offset=centre_offset
         ).intensity
 
+    @staticmethod
+    def _reduce_max(res: np.ndarray):
+        """One over the peak of the azimuthal mean of a 2d integration."""
         #  Slice off the ends as they are not reliable
         return 1/np.max(np.nanmean(res, axis=0)[100:-100])
 
-    def optimise(self, bounds=[(-50, 50), (-50, 50)], workers=1, verbose=False):
+    def _split_params(self, params):
+        """Centre offset and sample distance of a candidate solution."""
+        if len(params) > 2:
+            return params[:2], params[2]
+        return params, self.sample_dist_m
+
+    def _nominal_radii(self, bounds):
+        """Pixel radii at the nominal centre and the largest offset within
+        the search bounds, both in pixels."""
+        max_offset = np.hypot(*[max(abs(b[0]), abs(b[1])) for b in bounds])
+        radii = np.hypot(self.profiler.x, self.profiler.y)
+        return radii, max_offset
+
+    def _set_profile_bins(self, bounds, distance_bounds):
+        """
+        Fix the 2theta binning used by the "profile" and "rings" loss
+        functions, so that the bins containing the expected rings are only
+        looked up once.
+
+        The bins are about one pixel wide at the largest distance, and the
+        range covers every pixel at the smallest distance and largest offset.
+        """
+        dist_min, dist_max = distance_bounds
+        radii, max_offset = self._nominal_radii(bounds)
+        max_radius = (radii.max() + max_offset) * self.profiler.pixel_size
+
+        width = np.degrees(np.arctan2(self.profiler.pixel_size, dist_max))
+        npt = int(np.ceil(np.degrees(np.arctan2(max_radius, dist_min)) / width))
+        tth_range = (0, npt * width)
+
+        ring_bin_idx = None
+        if self.ring_2th_deg is not None:
+            ring_bin_idx = (np.asarray(self.ring_2th_deg) / width).astype(int)
+            ring_bin_idx = ring_bin_idx[ring_bin_idx < npt]
+        self._profile_bins = (npt, tth_range, ring_bin_idx)
+
+    def _integrate_profile(self, params: Tuple[float, ...]):
+        """Radial profile of a candidate in the bins fixed by
+        `_set_profile_bins`."""
+        centre_offset, sample_dist_m = self._split_params(params)
+        npt, tth_range, _ = self._profile_bins
+        _, profile = self.profiler.profile(
+            npt, tth_range, sample_dist_m, centre_offset=centre_offset
+        )
+        return profile
+
+    @staticmethod
+    def _reduce_profile_max(profile: np.ndarray):
+        """One over the peak of a radial profile."""
+        #  Slice off the ends as they are not reliable
+        return 1/np.nanmax(profile[100:-100])
+
+    def _reduce_rings(self, profile: np.ndarray):
+        """One over the summed profile in the bins of the expected rings."""
+        ring_sum = np.nansum(profile[self._profile_bins[2]])
+        return 1/ring_sum if ring_sum > 0 else np.inf
+
+    def _profile_loss_function(self, params: Tuple[float, ...]):
+        """
+        Equivalent of `_loss_function` using the cached pixel coordinates
+        instead of pyFAI, so that it can also run on a subset of the pixels.
+
+        Parameters
+        ----------
+        params : Tuple[float, ...]
+            Centre offset (x, y), optionally followed by the sample distance
+
+        Returns
+        -------
+        float
+            Value of the cost function, 1/max(1d_profile[100:-100])
+        """
+        return self._reduce_profile_max(self._integrate_profile(params))
+
+    def _ring_loss_function(self, params: Tuple[float, ...]):
+        """
+        Cost function scoring the expected ring positions, one over the
+        summed mean intensity of the 2theta bins containing the rings.
+
+        Parameters
+        ----------
+        params : Tuple[float, ...]
+            Centre offset (x, y), optionally followed by the sample distance
+
+        Returns
+        -------
+        float
+            Value of the cost function, 1/sum(1d_profile[ring_bins])
+        """
+        return self._reduce_rings(self._integrate_profile(params))
+
+    def _set_peak_windows(self, bounds, distance_bounds):
+        """
+        Choose the rings scored by the "width" loss, and the range of 2theta
+        bins each of them can move to within the search bounds.
+
+        The rings are the expected ones if known, otherwise the most
+        prominent peaks of the profile at the nominal centre, and the
+        `n_peaks` strongest are kept.
+        """
+        self._set_profile_bins(bounds, distance_bounds)
+        npt, tth_range, ring_bin_idx = self._profile_bins
+        bin_width = (tth_range[1] - tth_range[0]) / npt
+        dist_min, dist_max = distance_bounds
+        dist_mid = (dist_min + dist_max) / 2
+
+        _, profile = self.profiler.profile(npt, tth_range, dist_mid)
+        profile = np.nan_to_num(profile)
+        if ring_bin_idx is None:
+            peaks, props = find_peaks(profile, prominence=0)
+            peaks = peaks[np.argsort(props["prominences"])[::-1]]
+        else:
+            peaks = ring_bin_idx[np.argsort(profile[ring_bin_idx])[::-1]]
+        peaks = np.sort(peaks[:self.n_peaks])
+
+        #  Bins a ring can move to for any candidate distance and offset
+        _, max_offset = self._nominal_radii(bounds)
+        pixel_size = self.profiler.pixel_size
+        radii = dist_mid * np.tan(np.radians((peaks + 0.5) * bin_width))
+        low = np.degrees(np.arctan2(
+            np.clip(radii - max_offset * pixel_size, 0, None), dist_max
+        )) / bin_width
+        high = np.degrees(np.arctan2(
+            radii + max_offset * pixel_size, dist_min
+        )) / bin_width
+
+        low = np.floor(low).astype(int)
+        length = int(np.ceil(high - low).max()) + 1
+        region_idx = low[:, None] + np.arange(length)
+        region_valid = (region_idx <= high[:, None]) & (region_idx < npt)
+        region_idx = np.clip(region_idx, 0, npt - 1)
+
+        if self.peak_window_deg is not None:
+            half_width = int(round(self.peak_window_deg / bin_width))
+        else:
+            #  Several ring widths, but not reaching the next scored ring
+            sigma = self._ring_sigma(region_idx, region_valid, npt, tth_range,
+                                     dist_mid)
+            half_width = int(np.ceil(self.peak_window_sigmas * sigma))
+            if len(peaks) > 1:
+                half_width = min(half_width, np.diff(peaks).min() // 2)
+        half_width = max(half_width, 2)
+
+        self._peak_windows = (region_idx, region_valid, half_width)
+
+    def _ring_sigma(self, region_idx: np.ndarray, region_valid: np.ndarray,
+                    npt: int, tth_range: Tuple[float, float],
+                    sample_dist_m: float, n_sectors: int = 36) -> float:
+        """
+        Median width (standard deviation) of the scored rings in 2theta
+        bins, measured in narrow azimuthal sectors around the nominal centre.
+        Within a sector a misaligned centre shifts the rings, while it
+        broadens them in the full profile.
+
+        Every ring is measured against the background of a window around its
+        peak, rings crossing a gap of a sector are skipped, and if no ring
+        can be measured the width is one bin.
+        """
+        profiler = self.profiler
+        azimuth = np.arctan2(profiler.y, profiler.x) / (2 * np.pi) + 0.5
+        sector = (azimuth * n_sectors).astype(int) % n_sectors
+        #  Wide enough to reach the background around a ring
+        half_window = max(region_idx.shape[1], 10)
+
+        fwhm = []
+        for i in range(n_sectors):
+            _, profile = profiler.select(sector == i).profile(
+                npt, tth_range, sample_dist_m
+            )
+            regions = np.where(region_valid, profile[region_idx], -np.inf)
+            regions[np.isnan(regions)] = -np.inf
+            peaks = region_idx[np.arange(len(regions)),
+                               np.argmax(regions, axis=1)]
+            for peak in peaks:
+                window = profile[peak - half_window:peak + half_window + 1]
+                if (len(window) < 2 * half_window + 1
+                        or np.isnan(window).any()):
+                    continue
+                #  Only a local maximum, not a ring running out of its region
+                if window[half_window] > window[[half_window - 1,
+                                                 half_window + 1]].max():
+                    fwhm.append(peak_widths(window, [half_window],
+                                            rel_height=0.5)[0][0])
+
+        if not fwhm:
+            return 1.
+        return np.median(fwhm) / (2 * np.sqrt(2 * np.log(2)))
+
+    def _reduce_width(self, profile: np.ndarray):
+        """
+        Mean width of the scored rings, in degrees 2theta.
+
+        Every ring is located at the peak of its region, and its width is the
+        standard deviation (second moment) of the baseline subtracted
+        profile in a fixed window around the peak, for all rings at once.
+        """
+        region_idx, region_valid, half_width = self._peak_windows
+        bin_width = self._profile_bins[1][1] / self._profile_bins[0]
+
+        regions = np.where(region_valid, profile[region_idx], -np.inf)
+        regions[np.isnan(regions)] = -np.inf
+        peaks = region_idx[np.arange(len(regions)), np.argmax(regions, axis=1)]
+
+        offsets = np.arange(-half_width, half_width + 1)
+        windows = np.clip(peaks[:, None] + offsets, 0, len(profile) - 1)
+        values = profile[windows]
+        weights = np.clip(values - np.nanmin(values, axis=1)[:, None], 0, None)
+        weights[np.isnan(weights)] = 0
+
+        total = weights.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = (weights * offsets).sum(axis=1) / total
+            var = (weights * (offsets - mean[:, None])**2).sum(axis=1) / total
+
+        width = np.nanmean(np.sqrt(var)) * bin_width
+        return width if np.isfinite(width) else np.inf
+
+    def _width_loss_function(self, params: Tuple[float, ...]):
+        """
+        Cost function scoring the sharpness of the strongest rings, their
+        mean width in the radial profile. Unlike the peak based losses it
+        depends on every bin around the rings, so it is smooth enough for a
+        local optimiser.
+
+        Parameters
+        ----------
+        params : Tuple[float, ...]
+            Centre offset (x, y), optionally followed by the sample distance
+
+        Returns
+        -------
+        float
+            Value of the cost function, mean(ring_widths) in degrees
+        """
+        return self._reduce_width(self._integrate_profile(params))
+
+    def _set_annuli(self, bounds, distance_bounds):
+        """
+        Index the pixels which fall into an annulus around an expected ring
+        for at least one candidate within the search bounds. The "annuli"
+        loss function then only evaluates this subset of the detector.
+        """
+        dist_min, dist_max = distance_bounds
+        radii, max_offset = self._nominal_radii(bounds)
+        pixel_size = self.profiler.pixel_size
+
+        tth_low = np.degrees(np.arctan2(
+            np.clip(radii - max_offset, 0, None) * pixel_size, dist_max
+        )) - self.annulus_deg
+        tth_high = np.degrees(np.arctan2(
+            (radii + max_offset) * pixel_size, dist_min
+        )) + self.annulus_deg
+
+        rings = np.sort(np.asarray(self.ring_2th_deg, dtype=float))
+        rings = rings[rings <= tth_high.max()]
+
+        #  A pixel is needed if the first ring above its lowest reachable
+        #  angle is still below its highest reachable angle
+        idx = np.searchsorted(rings, tth_low)
+        reachable = idx < len(rings)
+        reachable[reachable] = rings[idx[reachable]] <= tth_high[reachable]
+
+        self._annuli = (self.profiler.select(reachable), rings)
+
+    def _integrate_annuli(self, params: Tuple[float, ...]):
+        """Mean intensity in the annulus around every expected ring."""
+        centre_offset, sample_dist_m = self._split_params(params)
+        profiler, rings = self._annuli
+        tth = profiler.two_theta(sample_dist_m, centre_offset)
+
+        #  Assign every pixel to its nearest expected ring
+        upper = np.minimum(np.searchsorted(rings, tth), len(rings) - 1)
+        lower = np.maximum(upper - 1, 0)
+        nearest = np.where(
+            np.abs(tth - rings[lower]) < np.abs(tth - rings[upper]),
+            lower, upper
+        )
+        inside = np.abs(tth - rings[nearest]) < self.annulus_deg
+        nearest = nearest[inside]
+
+        sums = np.bincount(
+            nearest, profiler.intensity[inside], minlength=len(rings)
+        )
+        counts = np.bincount(nearest, minlength=len(rings))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / counts
+
+    @staticmethod
+    def _reduce_annuli(ring_means: np.ndarray):
+        """One over the summed mean intensity of the annuli."""
+        ring_sum = np.nansum(ring_means)
+        return 1/ring_sum if ring_sum > 0 else np.inf
+
+    def _annuli_loss_function(self, params: Tuple[float, ...]):
+        """
+        Cost function which only evaluates narrow annuli around the expected
+        rings, one over the sum of the mean intensity in each annulus.
+
+        Parameters
+        ----------
+        params : Tuple[float, ...]
+            Centre offset (x, y), optionally followed by the sample distance
+
+        Returns
+        -------
+        float
+            Value of the cost function, 1/sum(annuli_mean_intensity)
+        """
+        return self._reduce_annuli(self._integrate_annuli(params))
+
+    def optimise(self, bounds=[(-50, 50), (-50, 50)], workers=1, verbose=False,
+                 distance_bounds=None, loss=None, subsample=None, seed=None,
+                 report=True, callback=None, method="global"):
         """
         Find the optimal centre position via Scipy's `differential_evolution`
-        global optimiser.
+        global optimiser, or a local optimiser started at the centre of the
+        search area.
 
         Parameters
         ----------
         bounds : list, optional
             Set the search area for the optimiser, by default [(-50, 50), (-50, 50)]
         workers : int, optional
-            Set the number of workers (cores) to use, -1 for auto, by default 1
+            Set the number of workers (cores) to use, -1 for auto, by default
+            1. Only the global method can use several
         verbose : bool, optional
             Print scipy optimise progress output, by default False
+        distance_bounds : Tuple[float, float], optional
+            If set, optimise the sample distance within these limits (in m)
+            together with the centre, requires a ring based loss, by default
+            None
+        loss : str, optional
+            Cost function to minimise: "max" for the peak of the pyFAI
+            integration result, "profile" for the same computed without
+            pyFAI, "rings" for the profile at the expected rings, "annuli"
+            to only evaluate the pixels around the expected rings, or "width"
+            for the mean width of the strongest rings. By default
+            "max", "profile" if `subsample` is set, or "rings" if
+            `distance_bounds` is set
+        subsample : int, optional
+            If set, score the candidates on a fixed, stratified random subset
+            of one in `subsample` pixels. The best candidate is then refined
+            on all pixels. Not supported by the "max" loss, by default None
+        seed : int, optional
+            Seed for the pixel subset and the optimiser, by default None
+        report : bool, optional
+            Print the optimal quad positions, by default True
+        callback : Callable, optional
+            Called with a `trace.EvaluationInfo` after every loss evaluation,
+            e.g. to show progress. If it returns True the optimisation stops
+            and the best candidate so far is returned, by default None
+        method : str, optional
+            "global" for differential evolution, or "local" for the
+            Nelder-Mead simplex method started at the centre of the search
+            area, which needs far fewer evaluations but only finds the
+            nearest minimum, best combined with the "width" loss. By default
+            "global"
 
         Returns
         -------
         OptimiseResult : namedtuple
-            Named tuple of: optimal_quad_positions, optimal_offset, results
+            Named tuple of: optimal_quad_positions, optimal_offset, results,
+            optimal_sample_dist_m, trace. The trace is a DataFrame with one
+            row per loss evaluation, see `trace.LossTracer.to_dataframe`
         """
         res_tuple = namedtuple(
-            "OptimiseResult", "optimal_quad_positions optimal_offset results"
+            "OptimiseResult",
+            "optimal_quad_positions optimal_offset results "
+            "optimal_sample_dist_m trace"
         )
 
-        #  This actually passes a list of two values to the loss function, not
-        #  a tuple as the type hint suggests, but that's just an implementation
-        #  detail of the differential evolution function. Conceptually a tuple
-        #  of (x, y) is what should be passed
-        results = differential_evolution(
-            self._loss_function,
-            bounds,
-            workers=workers,
-            disp=verbose
-        )
+        #  Integration stage, reduction stage, setup function, whether it
+        #  needs the ring positions
+        loss_functions = {
+            "max": (self._integrate_pyfai, self._reduce_max, None, False),
+            "profile": (
+                self._integrate_profile, self._reduce_profile_max,
+                self._set_profile_bins, False
+            ),
+            "rings": (
+                self._integrate_profile, self._reduce_rings,
+                self._set_profile_bins, True
+            ),
+            "annuli": (
+                self._integrate_annuli, self._reduce_annuli,
+                self._set_annuli, True
+            ),
+            "width": (
+                self._integrate_profile, self._reduce_width,
+                self._set_peak_windows, False
+            ),
+        }
+        if loss is None:
+            if distance_bounds is not None:
+                loss = "rings"
+            elif subsample is not None:
+                loss = "profile"
+            else:
+                loss = "max"
+        if loss not in loss_functions:
+            raise ValueError(f"Unknown loss function: {loss}")
+        integrate, reduce, setup, needs_rings = loss_functions[loss]
+
+        if setup is None and subsample is not None:
+            raise ValueError(
+                f"Subsampling is not supported by the {loss} loss, use the "
+                f"profile loss instead"
+            )
+
+        search_bounds = list(bounds)
+        if distance_bounds is not None:
+            #  Only the expected ring positions pin down the distance, the
+            #  other losses improve monotonically towards one of the limits
+            if not needs_rings:
+                raise ValueError(
+                    f"The sample distance can not be optimised with the "
+                    f"{loss} loss, use the rings or annuli loss"
+                )
+            search_bounds.append(tuple(distance_bounds))
+        else:
+            distance_bounds = (self.sample_dist_m, self.sample_dist_m)
+
+        if method not in ("global", "local"):
+            raise ValueError(f"Unknown optimisation method: {method}")
+        if method == "local" and workers != 1:
+            #  The simplex evaluates one candidate after the other
+            raise ValueError(
+                "The local method runs in one process, use workers=1"
+            )
+
+        if needs_rings and self.ring_2th_deg is None:
+            raise ValueError(
+                f"The {loss} loss requires the expected ring positions, "
+                f"set `ring_2th_deg` or a calibrant"
+            )
+
+        param_names = ["x", "y", "sample_dist_m"][:len(search_bounds)]
+        stages = LossStages(integrate, reduce)
+        tracer = LossTracer(stages, param_names, callback)
+
+        full_profiler = self.profiler
+        if subsample is not None:
+            self.profiler = full_profiler.subsample(1/subsample, seed=seed)
 
-        centre_offset = results.x
+        pool = None
+        cancelled = False
+        try:
+            if setup is not None:
+                setup(bounds, distance_bounds)
+
+            if workers != 1 and method == "global":
+                #  Evaluate in a pool, but keep the trace in this process. The
+                #  workers start after the setup, which they need
+                pool = stages.pool(workers if workers > 0 else None)
+
+            if method == "local":
+                #  The simplex starts around the centre of the search area,
+                #  bounded Powell would search the whole bounds along each
+                #  direction and can end up in a worse minimum far away
+                x0 = np.mean(search_bounds, axis=1)
+                step = np.diff(search_bounds, axis=1)[:, 0] / 10
+                results = minimize(
+                    tracer, x0, method="Nelder-Mead", bounds=search_bounds,
+                    options=dict(
+                        disp=verbose, xatol=1e-2, fatol=np.inf,
+                        initial_simplex=np.vstack([x0, x0 + np.diag(step)]),
+                    ),
+                )
+            else:
+                #  This actually passes a list of two values to the loss
+                #  function, not a tuple as the type hint suggests, but that's
+                #  just an implementation detail of the differential evolution
+                #  function. Conceptually a tuple of (x, y) is what should be
+                #  passed
+                results = differential_evolution(
+                    tracer,
+                    search_bounds,
+                    workers=1 if pool is None else tracer.map(pool),
+                    updating="immediate" if pool is None else "deferred",
+                    disp=verbose,
+                    polish=subsample is None,
+                    seed=seed,
+                )
+        except OptimisationCancelled:
+            cancelled = True
+        finally:
+            self.profiler = full_profiler
+            if pool is not None:
+                pool.terminate()
+
+        if subsample is not None and not cancelled:
+            #  Verify and refine the best candidate on all pixels, updating
+            #  the result the same way scipy's own polishing does
+            setup(bounds, distance_bounds)
+            tracer.stage = "refine"
+            try:
+                refined = minimize(
+                    tracer, results.x, method="Powell", bounds=search_bounds
+                )
+                results.x = refined.x
+                results.fun = refined.fun
+                results.nfev += refined.nfev
+            except OptimisationCancelled:
+                cancelled = True
+
+        if cancelled:
+            results = OptimizeResult(
+                x=np.array(tracer.best_params), fun=tracer.best_loss,
+                nfev=tracer.nfev, success=False,
+                message="Optimisation cancelled by the callback",
+            )
+
+        centre_offset, sample_dist_m = self._split_params(results.x)
 
         #  Subtract the centre offset to move the modules in the correct
         #  way to shift the centre
@@ -119,11 +744,17 @@ class CentreOptimiser:
             in self.original_quadrant_pos
         ]
 
-        oqp = (
-            "[",
-            "".join([f"\n    {c}," for c in optimal_quad_positions]),
-            "\n]"
-        )
-        print("Optimal quad positions: ", "".join(oqp))
+        if report:
+            oqp = (
+                "[",
+                "".join([f"\n    {c}," for c in optimal_quad_positions]),
+                "\n]"
+            )
+            print("Optimal quad positions: ", "".join(oqp))
+            if len(results.x) > 2:
+                print("Optimal sample distance: ", sample_dist_m)
 
-        return res_tuple(optimal_quad_positions, centre_offset, results)
+        return res_tuple(
+            optimal_quad_positions, centre_offset, results, sample_dist_m,
+            tracer.to_dataframe()
+        )
@@ -0,0 +1,211 @@
+from concurrent.futures import ProcessPoolExecutor
+import copy
+from itertools import islice
+import os
+from typing import Iterable, Iterator, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from extra_data.reader import DataCollection
+from extra_geom.detectors import DetectorGeometryBase
+
+from .centre import CentreOptimiser
+from ..geometry import GeometryAssembler
+from ..io_utils import read_train
+
+COLUMNS = ["x", "y", "sample_dist_m", "loss", "nfev"]
+
+#  Geometry of the current worker process, see `_init_worker`
+_worker_geom = None
+
+
+def _iter_run_frames(run: DataCollection, per_pulse: bool):
+    """
+    Yield (id, module_stack) pairs from an extra_data run selection, either
+    one per train (mean over the pulses) or one per pulse.
+    """
+    run = run.select("*/DET/*", "image.data")
+    for tid in run.train_ids:
+        #  Modules are read by a thread pool, straight into one train buffer
+        try:
+            train_stack = read_train(run, tid)
+        except ValueError:
+            #  No detector data in this train
+            continue
+
+        if per_pulse:
+            for pulse, module_stack in enumerate(train_stack):
+                yield (tid, pulse), module_stack
+        else:
+            yield tid, np.nanmean(train_stack, axis=0)
+
+
+def _iter_frames(frames, ids, per_pulse):
+    """Yield (id, module_stack) pairs for any of the supported inputs."""
+    if isinstance(frames, DataCollection):
+        yield from _iter_run_frames(frames, per_pulse)
+        return
+
+    if ids is None:
+        ids = range(len(frames)) if hasattr(frames, "__len__") else None
+    if ids is None:
+        yield from enumerate(frames)
+    else:
+        yield from zip(ids, frames)
+
+
+def _worker_geometry(geom: Union[DetectorGeometryBase, GeometryAssembler]
+                     ) -> DetectorGeometryBase:
+    """
+    The extra_geom geometry to send to worker processes. It is pickled
+    whatever the start method, and the snapped geometry cached by extra_geom
+    cannot be pickled, so a copy without the cache is sent.
+    """
+    geom = getattr(geom, "exgeom_obj", geom)
+    if getattr(geom, "_snapped_cache", None) is not None:
+        geom = copy.copy(geom)
+        geom._snapped_cache = None
+    return geom
+
+
+def _init_worker(geom: DetectorGeometryBase):
+    """
+    Hand the geometry to a worker process once, instead of with every
+    chunk.
+    """
+    global _worker_geom
+    _worker_geom = geom
+
+
+def _track_chunk(geom: DetectorGeometryBase, chunk: Sequence[Tuple],
+                 sample_dist_m: Union[int, float], bounds, window: float,
+                 optimiser_kwargs: dict, optimise_kwargs: dict):
+    """
+    Optimise the centre of consecutive frames. Only the first frame uses the
+    full search bounds, every later frame is searched within `window` pixels
+    of the previous solution.
+
+    Returns a list of (id, row) pairs, with rows ordered as `COLUMNS`.
+    """
+    if geom is None:
+        geom = _worker_geom
+    rows = []
+    search_bounds = bounds
+    for frame_id, module_stack in chunk:
+        optimiser = CentreOptimiser(
+            geom, module_stack, sample_dist_m, **optimiser_kwargs
+        )
+        res = optimiser.optimise(
+            search_bounds, report=False, **optimise_kwargs
+        )
+
+        x, y = res.optimal_offset
+        rows.append((
+            frame_id,
+            (x, y, res.optimal_sample_dist_m, res.results.fun, res.results.nfev)
+        ))
+
+        search_bounds = [(x - window, x + window), (y - window, y + window)]
+
+    return rows
+
+
+def _chunks(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def track_centre(geom: Union[DetectorGeometryBase, GeometryAssembler],
+                 frames: Union[np.ndarray, Iterable[np.ndarray], DataCollection],
+                 sample_dist_m: Union[int, float],
+                 bounds=[(-50, 50), (-50, 50)], window: float = 5,
+                 ids: Sequence = None, per_pulse: bool = False,
+                 workers: int = 1, chunk_size: int = 16,
+                 optimiser_kwargs: dict = None,
+                 optimise_kwargs: dict = None) -> pd.DataFrame:
+    """
+    Track the drift of the beam centre over a sequence of frames.
+
+    Each frame is optimised with `CentreOptimiser`, warm-started from the
+    previous solution: after the first frame only a narrow window around
+    the last optimal offset is searched. The frames are split into chunks
+    of consecutive frames which run in parallel across a process pool, the
+    first frame of every chunk is searched within the full bounds.
+
+    Parameters
+    ----------
+    geom : Union[DetectorGeometryBase, GeometryAssembler]
+        Geometry used for all frames, the offsets are relative to it
+    frames : Union[np.ndarray, Iterable[np.ndarray], DataCollection]
+        Module stacks, either an array of shape (frames, modules, ss, fs),
+        an iterable of module stacks, or an extra_data run selection
+    sample_dist_m : Union[int, float]
+        Distance from the detector to the sample
+    bounds : list, optional
+        Search area of the first frame of every chunk, by default
+        [(-50, 50), (-50, 50)]
+    window : float, optional
+        Half width, in pixels, of the search area around the previous
+        solution, by default 5
+    ids : Sequence, optional
+        Label of each frame, by default the frame number. Ignored for run
+        selections, which are labelled by train ID (and pulse)
+    per_pulse : bool, optional
+        For run selections, optimise every pulse instead of the mean of
+        each train, by default False
+    workers : int, optional
+        Number of processes, -1 for one per core, by default 1. Each
+        process receives a pickled copy of the extra_geom geometry, so they
+        can be started by any multiprocessing start method
+    chunk_size : int, optional
+        Number of consecutive frames handled by one process, by default 16
+    optimiser_kwargs : dict, optional
+        Extra keyword arguments for `CentreOptimiser`, by default None
+    optimise_kwargs : dict, optional
+        Extra keyword arguments for `CentreOptimiser.optimise`, by default
+        None
+
+    Returns
+    -------
+    pd.DataFrame
+        Optimal offset (x, y), sample distance, final loss and number of
+        loss evaluations per frame
+    """
+    optimiser_kwargs = optimiser_kwargs or {}
+    optimise_kwargs = optimise_kwargs or {}
+    if workers == -1:
+        workers = os.cpu_count()
+
+    chunks = _chunks(_iter_frames(frames, ids, per_pulse), chunk_size)
+    args = (sample_dist_m, bounds, window, optimiser_kwargs, optimise_kwargs)
+
+    rows = []
+    if workers == 1:
+        for chunk in chunks:
+            rows += _track_chunk(geom, chunk, *args)
+    else:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(_worker_geometry(geom),)) as pool:
+            #  Keep a bounded number of chunks in flight, so that frames are
+            #  only read shortly before they are needed
+            pending = []
+            for chunk in chunks:
+                pending.append(pool.submit(_track_chunk, None, chunk, *args))
+                if len(pending) >= 2 * workers:
+                    rows += pending.pop(0).result()
+            for future in pending:
+                rows += future.result()
+
+    frame_ids = [frame_id for frame_id, _ in rows]
+    if frame_ids and isinstance(frame_ids[0], tuple):
+        index = pd.MultiIndex.from_tuples(frame_ids, names=["train_id", "pulse"])
+    else:
+        name = "train_id" if isinstance(frames, DataCollection) else "frame"
+        index = pd.Index(frame_ids, name=name)
+
+    return pd.DataFrame([row for _, row in rows], index=index, columns=COLUMNS)
@@ -0,0 +1,130 @@
+import os.path
+from typing import Union
+
+import h5py
+import numpy as np
+from extra_geom.detectors import DetectorGeometryBase
+from scipy.ndimage import median_filter
+
+from ..geometry import GeometryAssembler
+
+#  Masks follow the module data layout, (modules, slow_scan, fast_scan), and
+#  are True for every pixel which should be ignored
+
+
+def load_mask(path: str, dataset: str = "mask",
+              bad_value: int = None) -> np.ndarray:
+    """
+    Read a static pixel mask from a .npy or HDF5 file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the mask file
+    dataset : str, optional
+        Path of the mask dataset in an HDF5 file, by default "mask"
+    bad_value : int, optional
+        If set, only pixels with exactly this value are masked. By default
+        every non zero pixel is masked
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask, True for bad pixels
+    """
+    if os.path.splitext(path)[1] == ".npy":
+        mask = np.load(path)
+    else:
+        with h5py.File(path, "r") as f:
+            mask = f[dataset][()]
+
+    if bad_value is not None:
+        return mask == bad_value
+    return mask != 0
+
+
+def edge_mask(geom: Union[DetectorGeometryBase, GeometryAssembler],
+              width: int = 1) -> np.ndarray:
+    """
+    Mask the outer pixels of every tile (ASIC group) of the detector, which
+    are larger or less reliable than the inner pixels.
+
+    Parameters
+    ----------
+    geom : Union[DetectorGeometryBase, GeometryAssembler]
+        Geometry defining the module and tile shapes
+    width : int, optional
+        Number of pixels to mask along each tile edge, by default 1
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask, True for the tile edges
+    """
+    if isinstance(geom, GeometryAssembler):
+        geom = geom.exgeom_obj
+
+    n_modules, n_ss, n_fs = geom.expected_data_shape
+    ss = np.arange(n_ss) % geom.frag_ss_pixels
+    fs = np.arange(n_fs) % geom.frag_fs_pixels
+    edge_ss = (ss < width) | (ss >= geom.frag_ss_pixels - width)
+    edge_fs = (fs < width) | (fs >= geom.frag_fs_pixels - width)
+
+    edges = edge_ss[:, None] | edge_fs[None, :]
+    return np.broadcast_to(edges, (n_modules, n_ss, n_fs)).copy()
+
+
+def detect_bad_pixels(data: np.ndarray, n_sigma: float = 10,
+                      size: int = 5, zero_is_dead: bool = False) -> np.ndarray:
+    """
+    Find dead and hot pixels in module data.
+
+    Dead pixels are non finite or, given several frames, constant over all
+    frames. Exact zeros are only dead if asked for, as corrected or clipped
+    data has many of them in the background between rings. Hot pixels stand out from the local median of
+    their module by more than `n_sigma` robust standard deviations, which
+    leaves smooth features such as diffraction rings unmasked.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Module data, either a single module stack (modules, ss, fs) or a
+        stack of frames (frames, modules, ss, fs)
+    n_sigma : float, optional
+        Threshold for hot pixels, by default 10
+    size : int, optional
+        Size of the median filter window, in pixels, by default 5
+    zero_is_dead : bool, optional
+        Also mark pixels which are exactly zero as dead, e.g. for raw data
+        of a single frame, by default False
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of shape (modules, ss, fs), True for bad pixels
+    """
+    if data.ndim == 4:
+        with np.errstate(invalid="ignore"):
+            dead = ~(np.nanmax(data, axis=0) > np.nanmin(data, axis=0))
+        image = np.nanmean(data, axis=0)
+    else:
+        image = data
+        dead = np.zeros(image.shape, dtype=bool)
+
+    dead |= ~np.isfinite(image)
+    if zero_is_dead:
+        dead |= image == 0
+
+    #  Fill the dead pixels with the module median, so that they do not
+    #  drag down the local median of their neighbours
+    filled = np.where(dead, np.nanmedian(image, axis=(1, 2), keepdims=True),
+                      image)
+    residual = filled - median_filter(filled, size=(1, size, size))
+
+    #  Robust standard deviation per module, from the median absolute
+    #  deviation of the residual
+    valid = np.where(dead, np.nan, residual)
+    mad = np.nanmedian(np.abs(valid), axis=(1, 2), keepdims=True)
+    hot = np.abs(residual) > n_sigma * 1.4826 * mad
+
+    return dead | (hot & (mad > 0))
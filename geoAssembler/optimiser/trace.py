@@ -0,0 +1,158 @@
+from collections import namedtuple
+from multiprocessing import Pool
+import time
+from typing import Callable, Sequence
+
+import numpy as np
+import pandas as pd
+
+#  Passed to the user callback after every loss evaluation
+EvaluationInfo = namedtuple(
+    "EvaluationInfo",
+    "nfev params loss best_loss best_params elapsed_s integrate_s reduce_s stage"
+)
+
+
+#  Loss stages of the current worker process, see `LossStages.pool`
+_worker_stages = None
+
+
+def _init_worker(stages: "LossStages"):
+    global _worker_stages
+    _worker_stages = stages
+
+
+def _evaluate(params):
+    return _worker_stages(params)
+
+
+class OptimisationCancelled(Exception):
+    """Raised when the user callback asks to stop the optimisation."""
+
+
+class LossStages:
+    """
+    Loss function made of an integration stage, which turns a candidate into
+    a radial profile (or ring intensities), and a reduction stage, which
+    turns that into the scalar loss. Calling it times both stages.
+
+    Kept separate from `LossTracer` so that only the stages, and not the
+    growing trace, are sent to worker processes.
+    """
+
+    def __init__(self, integrate: Callable, reduce: Callable):
+        self.integrate = integrate
+        self.reduce = reduce
+
+    def __call__(self, params):
+        """Returns (loss, integrate_s, reduce_s) for one candidate."""
+        t0 = time.perf_counter()
+        intermediate = self.integrate(params)
+        t1 = time.perf_counter()
+        loss = self.reduce(intermediate)
+        t2 = time.perf_counter()
+        return loss, t1 - t0, t2 - t1
+
+    def pool(self, workers: int = None) -> Pool:
+        """
+        Process pool evaluating these stages. The stages, with the optimiser
+        they belong to, are handed to each worker once when it starts, so
+        that only the candidates are sent with every map.
+        """
+        return Pool(workers, initializer=_init_worker, initargs=(self,))
+
+
+class LossTracer:
+    """
+    Callable loss function for the scipy optimisers which records every
+    evaluation: the candidate, its loss, the running best loss, a timestamp
+    and the time spent integrating and reducing.
+
+    An optional callback receives an `EvaluationInfo` after every
+    evaluation, e.g. to report progress in the GUI. Returning True from the
+    callback stops the optimisation by raising `OptimisationCancelled`.
+    """
+
+    def __init__(self, stages: LossStages, param_names: Sequence[str],
+                 callback: Callable = None):
+        """Init function
+
+        Parameters
+        ----------
+        stages : LossStages
+            Integration and reduction stages of the loss function
+        param_names : Sequence[str]
+            Names of the parameters of a candidate, used for the trace columns
+        callback : Callable, optional
+            Called with an `EvaluationInfo` after every evaluation, returning
+            True cancels the optimisation, by default None
+        """
+        self.stages = stages
+        self.param_names = list(param_names)
+        self.callback = callback
+        self.stage = "search"
+
+        self.best_loss = np.inf
+        self.best_params = None
+        self._records = []
+        self._start = time.perf_counter()
+
+    def __call__(self, params):
+        loss, integrate_s, reduce_s = self.stages(params)
+        self.record(params, loss, integrate_s, reduce_s)
+        return loss
+
+    def map(self, pool: Pool):
+        """
+        Map-like callable for the `workers` argument of
+        `differential_evolution`. The candidates are evaluated in a pool
+        made by `LossStages.pool`, but recorded here, so that the trace and
+        the callback stay in this process.
+        """
+        def _map(_, candidates):
+            candidates = list(candidates)
+            results = pool.map(_evaluate, candidates)
+            for params, result in zip(candidates, results):
+                self.record(params, *result)
+            return [loss for loss, _, _ in results]
+        return _map
+
+    def record(self, params, loss: float, integrate_s: float,
+               reduce_s: float):
+        """Add one evaluation to the trace and call the callback."""
+        params = tuple(np.asarray(params, dtype=float))
+        if loss < self.best_loss:
+            self.best_loss = loss
+            self.best_params = params
+
+        self._records.append(
+            params + (loss, self.best_loss, time.time(),
+                      integrate_s, reduce_s, self.stage)
+        )
+
+        if self.callback is not None:
+            info = EvaluationInfo(
+                len(self._records), params, loss, self.best_loss,
+                self.best_params, time.perf_counter() - self._start,
+                integrate_s, reduce_s, self.stage
+            )
+            if self.callback(info):
+                raise OptimisationCancelled
+
+    @property
+    def nfev(self):
+        return len(self._records)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Trace of all evaluations, one row per evaluation in the order they
+        were recorded. Columns are the parameter names, followed by loss,
+        best_loss, timestamp (seconds since the epoch), integrate_s,
+        reduce_s and stage ("search" or "refine").
+        """
+        columns = self.param_names + [
+            "loss", "best_loss", "timestamp", "integrate_s", "reduce_s", "stage"
+        ]
+        trace = pd.DataFrame(self._records, columns=columns)
+        trace.index.name = "evaluation"
+        return trace
@@ -8,6 +8,8 @@ from extra_geom.detectors import DetectorGeometryBase
 from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
 from pyFAI.detectors import Detector
 
+from ..geometry import GeometryAssembler
+
 
 class Integrator:
     """
@@ -23,14 +25,34 @@ class Integrator:
     integration result.
     """
 
-    def __init__(self, geom: DetectorGeometryBase,
-                 sample_dist_m: Union[int, float], unit: str = "2th_deg"):
+    def __init__(self, geom: Union[DetectorGeometryBase, GeometryAssembler],
+                 sample_dist_m: Union[int, float], unit: str = "2th_deg",
+                 mask: np.ndarray = None):
+        """Init function
+
+        Parameters
+        ----------
+        geom : Union[DetectorGeometryBase, GeometryAssembler]
+            Geometry of the assembled images
+        sample_dist_m : Union[int, float]
+            Distance from the detector to the sample
+        unit : str, optional
+            Radial unit of the integration, by default "2th_deg"
+        mask : np.ndarray, optional
+            Mask of the assembled image, True for pixels to skip. It is set
+            once and applies to every integration, by default None
+        """
         self.unit = unit
         self.sample_dist_m = sample_dist_m
+        self.mask = mask
 
-        fakedata = np.zeros(geom.expected_data_shape)
-        fakeimage, centre_geom = geom.position_modules_fast(fakedata)
-        self.size = fakeimage.shape
+        if isinstance(geom, GeometryAssembler):
+            self.size = geom.assembly_map.size_yx
+            centre_geom = geom.assembly_map.centre
+        else:
+            fakedata = np.zeros(geom.expected_data_shape)
+            fakeimage, centre_geom = geom.position_modules_fast(fakedata)
+            self.size = fakeimage.shape
 
         self.centre = [centre_geom[0], centre_geom[1]]
 
@@ -41,6 +63,8 @@ class Integrator:
             poni1=self.centre[0] * geom.pixel_size,
             poni2=self.centre[1] * geom.pixel_size,
         )
+        if mask is not None:
+            ai.set_mask(mask)
         self.ai = ai
 
         self.radius = ((self.size[0]/2)**2 + (self.size[1]/2)**2)**(1/2)
@@ -84,6 +108,9 @@ class Integrator:
                 poni1=(centre_offset[1] + self.centre[0]) * ai.pixel1,
                 poni2=(centre_offset[0] + self.centre[1]) * ai.pixel2,
             )
+            #  A new pyFAI geometry forgets the mask
+            if self.mask is not None:
+                ai.set_mask(self.mask)
 
         return ai.integrate2d(
             frame,
@@ -93,3 +120,233 @@ class Integrator:
             dummy=np.nan,
             method='cython'
         )
+
+
+class RadialProfiler:
+    """
+    Object caching the in-plane coordinates of the valid pixels of an
+    assembled frame, relative to the geometry centre.
+
+    Evaluating a radial profile for a shifted centre, or for a different
+    sample distance, then only needs to rescale the precomputed radii
+    instead of setting up a new pyFAI geometry. Centre offsets follow the
+    same (x, y) pixel convention as `Integrator.integrate2d`.
+
+    Use `from_frame` to create the profiler from an assembled image,
+    `from_modules` to create it from module data and the assembly map of a
+    `GeometryAssembler`, and `select` to restrict it to a subset of its
+    pixels.
+    """
+
+    def __init__(self, x: np.ndarray, y: np.ndarray, intensity: np.ndarray,
+                 pixel_size: float):
+        """Init function
+
+        Parameters
+        ----------
+        x, y : np.ndarray
+            1d arrays of the pixel coordinates relative to the centre, in
+            pixels
+        intensity : np.ndarray
+            1d array of the pixel values
+        pixel_size : float
+            Size of a pixel in m
+        """
+        self.x = x
+        self.y = y
+        self.intensity = intensity
+        self.pixel_size = pixel_size
+
+        self._cached_radii = (None, None)  # (centre_offset, radii)
+
+    @classmethod
+    def from_frame(cls, frame: np.ndarray, centre: Tuple[float, float],
+                   pixel_size: float):
+        """
+        Create the profiler from the finite pixels of an assembled frame.
+
+        Parameters
+        ----------
+        frame : np.ndarray
+            A 2d detector image
+        centre : Tuple[float, float]
+            (y, x) pixel position of the geometry centre in the frame
+        pixel_size : float
+            Size of a pixel in m
+        """
+        valid = np.isfinite(frame)
+        rows, cols = np.nonzero(valid)
+
+        #  Coordinates of the pixel centres, as pyFAI uses them
+        return cls(
+            cols + 0.5 - centre[1],
+            rows + 0.5 - centre[0],
+            frame[valid],
+            pixel_size,
+        )
+
+    @classmethod
+    def from_modules(cls, module_stack: np.ndarray, assembly_map,
+                     pixel_size: float):
+        """
+        Create the profiler from the finite pixels of module data, using the
+        pixel positions of an assembly map instead of an assembled frame.
+
+        Parameters
+        ----------
+        module_stack : np.ndarray
+            Stack of module data, (modules, slow_scan, fast_scan)
+        assembly_map : geoAssembler.geometry.AssemblyMap
+            Assembly map of the geometry, `GeometryAssembler.assembly_map`
+        pixel_size : float
+            Size of a pixel in m
+        """
+        valid = np.isfinite(module_stack)
+
+        #  Coordinates of the pixel centres, as pyFAI uses them
+        return cls(
+            assembly_map.x[valid] + 0.5,
+            assembly_map.y[valid] + 0.5,
+            module_stack[valid],
+            pixel_size,
+        )
+
+    def __len__(self):
+        return len(self.intensity)
+
+    def select(self, selection: np.ndarray):
+        """
+        New profiler holding only a subset of the pixels of this one.
+
+        Parameters
+        ----------
+        selection : np.ndarray
+            Boolean mask or integer index into the pixels of this profiler
+
+        Returns
+        -------
+        RadialProfiler
+        """
+        return type(self)(
+            self.x[selection],
+            self.y[selection],
+            self.intensity[selection],
+            self.pixel_size,
+        )
+
+    def subsample(self, fraction: float, seed: int = None):
+        """
+        Stratified random subset of the pixels. The same fraction of pixels
+        is drawn from every one pixel wide ring around the centre, so that
+        the subset keeps the shape of the radial profile.
+
+        Parameters
+        ----------
+        fraction : float
+            Fraction of the pixels to keep
+        seed : int, optional
+            Seed for the random number generator, by default None
+
+        Returns
+        -------
+        RadialProfiler
+        """
+        rng = np.random.default_rng(seed)
+        strata = np.hypot(self.x, self.y).astype(np.intp)
+
+        #  Sort by stratum, and randomly within each stratum, then keep the
+        #  first pixels of every stratum
+        order = np.lexsort((rng.random(len(self)), strata))
+        counts = np.bincount(strata)
+        starts = np.cumsum(counts) - counts
+        rank = np.arange(len(self)) - np.repeat(starts, counts)
+        keep = rank < np.ceil(counts * fraction)[strata[order]]
+
+        return self.select(np.sort(order[keep]))
+
+    def radii(self, centre_offset: Tuple[float, float]=None):
+        """
+        Distance of every valid pixel to the (shifted) centre in m. The
+        result for the last offset is cached, so that changing only the
+        sample distance does not recompute it.
+
+        Parameters
+        ----------
+        centre_offset : Tuple[float, float], optional
+            Centre offset in pixels, (x, y), by default None
+
+        Returns
+        -------
+        np.ndarray
+            1d array of radii, one per valid pixel
+        """
+        offset = (0., 0.) if centre_offset is None else tuple(centre_offset)
+        if offset == self._cached_radii[0]:
+            return self._cached_radii[1]
+
+        radii = np.hypot(self.x - offset[0], self.y - offset[1])
+        radii *= self.pixel_size
+
+        self._cached_radii = (offset, radii)
+        return radii
+
+    def two_theta(self, sample_dist_m: Union[int, float],
+                  centre_offset: Tuple[float, float]=None):
+        """
+        Scattering angle, in degrees, of every valid pixel.
+
+        Parameters
+        ----------
+        sample_dist_m : Union[int, float]
+            Distance from the detector to the sample
+        centre_offset : Tuple[float, float], optional
+            Centre offset in pixels, (x, y), by default None
+
+        Returns
+        -------
+        np.ndarray
+            1d array of 2theta values, one per valid pixel
+        """
+        return np.degrees(np.arctan2(self.radii(centre_offset), sample_dist_m))
+
+    def profile(self, npt: int, tth_range: Tuple[float, float],
+                sample_dist_m: Union[int, float],
+                centre_offset: Tuple[float, float]=None):
+        """
+        Mean intensity in evenly spaced 2theta bins, equivalent to the
+        azimuthal mean of `Integrator.integrate2d` but without the 2d
+        histogram.
+
+        Parameters
+        ----------
+        npt : int
+            Number of 2theta bins
+        tth_range : Tuple[float, float]
+            Lower and upper edge of the 2theta bins in degrees
+        sample_dist_m : Union[int, float]
+            Distance from the detector to the sample
+        centre_offset : Tuple[float, float], optional
+            Centre offset in pixels, (x, y), by default None
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            Bin centres in degrees and the mean intensity of each bin, NaN
+            for bins without any pixel
+        """
+        low, high = tth_range
+        width = (high - low) / npt
+
+        idx = np.floor(
+            (self.two_theta(sample_dist_m, centre_offset) - low) / width
+        ).astype(np.intp)
+        in_range = (idx >= 0) & (idx < npt)
+        idx = idx[in_range]
+
+        sums = np.bincount(idx, self.intensity[in_range], minlength=npt)
+        counts = np.bincount(idx, minlength=npt)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = sums / counts
+
+        return low + width * (np.arange(npt) + 0.5), mean
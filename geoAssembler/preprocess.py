@@ -0,0 +1,207 @@
+"""Preprocessing of detector frames read from a run."""
+
+from functools import lru_cache
+import hashlib
+import os
+import os.path as op
+import warnings
+
+from extra_data import RunDirectory
+import numpy as np
+
+from .io_utils import reduce_cells, run_fingerprint
+
+
+class Preprocessor:
+    """Prepare module frames for display and analysis, in place.
+
+    The frames are converted to float32 while they are read, and all steps
+    (dark subtraction, common mode correction, clipping, NaN filling) are
+    applied to small blocks of frames in turn, so the data passes through
+    memory once and no temporary copies of the whole train are made.
+
+    Raw data can be corrected well enough to see the rings with the dark
+    offset of a dark run (see load_dark) and the common mode correction,
+    which subtracts the median of every ASIC in every frame. The offsets of
+    AGIPD and DSSC differ between the memory cells, every frame gets the
+    offset of the cell it was stored in.
+    """
+
+    # Frames processed at once, a few MB that stay in the CPU cache
+    block_frames = 16
+
+    def __init__(self, clip_min=0, nan_value=None, dark=None, gain_index=0,
+                 common_mode=False, asic_shape=(64, 64), dark_cells=None):
+        """Define the preprocessing steps.
+
+        Parameters:
+            clip_min (float): Lower limit of the values, None to keep
+                              negative values (default 0)
+            nan_value (float): Value replacing NaN, None to keep NaN
+                               (default None)
+            dark (numpy.ndarray): Dark offset of every memory cell,
+                                  (cells, modules, slow_scan, fast_scan),
+                                  or one offset of all frames (modules,
+                                  slow_scan, fast_scan) (default None)
+            gain_index (int): Index of the data in the gain dimension of raw
+                              data (default 0)
+            common_mode (bool): Subtract the median of every ASIC from its
+                                pixels (default False)
+            asic_shape (tuple): Pixels of an ASIC along the slow and fast
+                                scan directions (default AGIPD (64, 64))
+            dark_cells (list): Memory cell ids of the dark offsets (default
+                               the cells 0, 1, ...)
+        """
+        self.clip_min = clip_min
+        self.nan_value = nan_value
+        self.dark = None if dark is None else np.asarray(dark, np.float32)
+        if self.dark is not None and self.dark.ndim == 3:
+            self.dark = self.dark[None]
+        if dark_cells is None and self.dark is not None:
+            dark_cells = range(len(self.dark))
+        self._dark_rows = (None if dark_cells is None else
+                           {int(cell): row for row, cell in
+                            enumerate(dark_cells)})
+        self.gain_index = gain_index
+        self.common_mode = common_mode
+        self.asic_shape = tuple(asic_shape)
+        self.dtype = np.float32
+
+    @property
+    def per_cell(self):
+        """Whether the dark offset depends on the memory cell of a frame."""
+        return self.dark is not None and len(self.dark) > 1
+
+    def _dark_index(self, n_frames, cells):
+        """Rows of the dark offsets of the frames of a train."""
+        if cells is None:
+            # The pulses of a train fill the cells in order
+            cells = np.arange(n_frames)
+        try:
+            return np.array([self._dark_rows[int(cell)] for cell in cells],
+                            dtype=int)
+        except KeyError as err:
+            raise ValueError('No dark offset of memory cell {}'.format(
+                err.args[0])) from None
+
+    def process_module(self, frames, modno, cells=None):
+        """Process the frames of one module in place.
+
+        Parameters:
+            frames (numpy.ndarray): float32 frames (frames, slow_scan,
+                                    fast_scan) of the module
+            modno (int): Module number, selecting its dark offset
+        Keywords:
+            cells (numpy.ndarray): Memory cell ids of the frames, selecting
+                                   their dark offsets (default the pulse
+                                   index in the train)
+
+        Returns:
+            numpy.ndarray: frames
+        """
+        dark = dark_rows = None
+        if self.per_cell:
+            dark_rows = self._dark_index(len(frames), cells)
+        elif self.dark is not None:
+            dark = self.dark[0, modno]
+        for start in range(0, len(frames), self.block_frames):
+            block = frames[start:start + self.block_frames]
+            if dark_rows is not None:
+                # (frames, slow_scan, fast_scan) offsets of the block
+                dark = self.dark[dark_rows[start:start + self.block_frames],
+                                 modno]
+            if dark is not None:
+                np.subtract(block, dark, out=block)
+            if self.common_mode:
+                self._subtract_common_mode(block)
+            if self.clip_min is not None:
+                # np.maximum keeps NaN, like np.clip
+                np.maximum(block, self.clip_min, out=block)
+            if self.nan_value is not None:
+                np.nan_to_num(block, copy=False, nan=self.nan_value)
+        return frames
+
+    def _subtract_common_mode(self, block):
+        """Subtract the median of every ASIC of every frame, in place."""
+        n_frames, n_ss, n_fs = block.shape
+        asic_ss, asic_fs = self.asic_shape
+        # (frames, ASIC rows, ss in ASIC, ASIC columns, fs in ASIC), a view
+        # for contiguous blocks
+        asics = block.reshape(n_frames, n_ss // asic_ss, asic_ss,
+                              n_fs // asic_fs, asic_fs)
+        with warnings.catch_warnings():
+            # All NaN ASICs stay NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            offset = np.nanmedian(asics, axis=(2, 4), keepdims=True)
+        np.subtract(asics, offset, out=asics)
+        if not np.shares_memory(asics, block):
+            block[...] = asics.reshape(block.shape)
+
+    def process_modules(self, module_stack, cells=None):
+        """Process a stack with the modules first in place.
+
+        Parameters:
+            module_stack (numpy.ndarray): float32 (modules, ...) stack
+        Keywords:
+            cells (numpy.ndarray): Memory cell ids of the frames of every
+                                   module (default the pulse index)
+
+        Returns:
+            numpy.ndarray: module_stack
+        """
+        if cells is not None:
+            cells = np.atleast_1d(cells)
+        for modno, frames in enumerate(module_stack):
+            if frames.ndim == 2:
+                frames = frames[None]
+            self.process_module(frames, modno, cells)
+        return module_stack
+
+
+@lru_cache(maxsize=4)
+def _load_dark(run_path, fingerprint, cache_dir, n_modules):
+    cache_file = None
+    if cache_dir:
+        name = hashlib.sha1(run_path.encode()).hexdigest()
+        cache_file = op.join(cache_dir, name + '-dark.npz')
+        try:
+            with np.load(cache_file) as f:
+                if str(f['fingerprint']) == fingerprint:
+                    return f['dark'], f['cells']
+        except (OSError, KeyError, ValueError):
+            pass
+
+    dark, cells = reduce_cells(RunDirectory(run_path), n_modules=n_modules)
+    if cache_file:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(cache_file, dark=dark, cells=cells,
+                     fingerprint=fingerprint)
+        except OSError:
+            pass  # Only slower next time
+    return dark, cells
+
+
+def load_dark(run_path, cache_dir=None, n_modules=16):
+    """Dark offset of every memory cell, the mean of its frames in a dark run.
+
+    AGIPD offsets also differ between the gain stages, the dark run should
+    be taken in the gain stage of the data, usually high gain.
+    The offsets are cached in memory and, with cache_dir, on disk, as long
+    as the files of the dark run are unchanged.
+
+    Parameters:
+        run_path (str): Directory of the dark run
+    Keywords:
+        cache_dir (str): Directory of the cached dark offsets (default
+                         None, only cached in memory)
+        n_modules (int): Number of detector modules (default 16)
+
+    Returns:
+        tuple: (cells, modules, slow_scan, fast_scan) float32 offsets and
+               the cell ids of their first axis, see Preprocessor dark and
+               dark_cells
+    """
+    run_path = op.abspath(run_path)
+    return _load_dark(run_path, run_fingerprint(run_path), cache_dir,
+                      n_modules)
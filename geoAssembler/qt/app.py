@@ -1,5 +1,7 @@
 """Qt Version of the detector geometry calibration."""
 import logging
+import threading
+import time
 
 import numpy as np
 import pyqtgraph as pg
@@ -13,6 +15,42 @@ from ..defaults import DefaultGeometryConfig as Defaults
 from .utils import get_icon
 
 
+class _AssemblySignals(QtCore.QObject):
+    """Hand assembly results from worker threads to the GUI thread."""
+
+    done = QtCore.pyqtSignal(int, object)
+    failed = QtCore.pyqtSignal(int, str)
+
+
+class _AssemblyTask(QtCore.QRunnable):
+    """Read and assemble the selected data in a worker thread."""
+
+    def __init__(self, main_widget, request, selection, geom):
+        super().__init__()
+        self.main_widget = main_widget
+        self.request = request
+        self.selection = selection
+        self.geom = geom
+
+    def run(self):
+        signals = self.main_widget.assembly_signals
+        try:
+            result = self.main_widget.assemble(self.request, self.selection,
+                                               self.geom)
+        except _AssemblyError as err:
+            signals.failed.emit(self.request, str(err))
+        except Exception as err:
+            signals.failed.emit(self.request,
+                                'Error while assembling data: {}'.format(err))
+        else:
+            if result is not None:
+                signals.done.emit(self.request, result)
+
+
+class _AssemblyError(Exception):
+    """Assembly failure that is shown to the user."""
+
+
 def run_gui(*args, **kwargs):
     """Run the Qt calibration windows in a QtGui application"""
     app = QtGui.QApplication([])
@@ -28,7 +66,8 @@ class QtMainWidget(QtGui.QMainWindow):
     log = logging.getLogger(__name__)
     log.setLevel(logging.DEBUG)
 
-    def __init__(self, app, run_dir=None, geofile=None, levels=None):
+    def __init__(self, app, run_dir=None, geofile=None, levels=None,
+                 cache_size=None):
         """Display detector data and arrange panels.
 
         Parameters:
@@ -40,6 +79,10 @@ class QtMainWidget(QtGui.QMainWindow):
 
             levels : (tuple)
               min/max values to be displayed (default: -1000)
+
+            cache_size : (int)
+              Memory budget of the train cache in bytes
+              (default: Defaults.train_cache_size)
         """
         super().__init__()
 
@@ -55,15 +98,45 @@ class QtMainWidget(QtGui.QMainWindow):
 
         self.raw_data = None
         self.canvas = None
+        self.data = None
+        self.centre = None
         self.rect = None
         self.quad = -1  # The selected quadrants (-1 none selected)
         self.is_displayed = False
 
+        # Quadrant moves are collected and applied at once on a timer, so
+        # that held keys cause one update per tick instead of a backlog
+        self._pending_moves = {}  # quadrant: increment (x, y) in pixels
+        self._move_burst = 0  # moves in quick succession, for acceleration
+        self._last_move = None
+        self._move_timer = QtCore.QTimer(self)
+        self._move_timer.setSingleShot(True)
+        self._move_timer.setInterval(Defaults.move_interval_ms)
+        self._move_timer.timeout.connect(self._apply_moves)
+
         # This is hooked up to the Python logging system outside the class
         self.log_capturer = LogCapturer(self)
 
+        # Data is read and assembled in a worker thread, only the result of
+        # the latest request is displayed
+        self._assembly_request = 0
+        self._assembly_pool = QtCore.QThreadPool(self)
+        self._assembly_pool.setMaxThreadCount(1)
+        self.assembly_signals = _AssemblySignals(self)
+        self.assembly_signals.done.connect(self._assembled)
+        self.assembly_signals.failed.connect(self._assembly_failed)
+        # The canvas buffers are reused by the assemblies. The displayed one
+        # is only written in the GUI thread, workers take one of the others.
+        self._free_canvases = []
+        self._canvas_lock = threading.Lock()
+
         # Create new image view
         self.imv = pg.ImageView()
+        # Show the detector pixel under the cursor, looked up at most at
+        # about the display refresh rate
+        self._hover_proxy = pg.SignalProxy(self.imv.scene.sigMouseMoved,
+                                           rateLimit=Defaults.hover_rate,
+                                           slot=self._hover)
         self.log.info('Creating main window')
         # Circle Points by Quadrant
         for action, keys in ((self._move_left, ('left', 'H')),
@@ -81,7 +154,7 @@ class QtMainWidget(QtGui.QMainWindow):
         self.geom_selector = GeometryWidget(self, self.geofile)
         self.geom_selector.new_geometry.connect(self.assemble_draw)
 
-        self.run_selector = RunDataWidget(self)
+        self.run_selector = RunDataWidget(self, cache_size)
         self.run_selector.run_changed.connect(self.draw_reset_levels)
         self.run_selector.selection_changed.connect(self.assemble_draw)
 
@@ -134,7 +207,7 @@ class QtMainWidget(QtGui.QMainWindow):
     @property
     def run_dir(self):
         """Get the currently set run directory from the run dir widget."""
-        return self.run_selector.rundir
+        return self.run_selector.run_path
 
     @property
     def geom_file(self):
@@ -150,38 +223,112 @@ class QtMainWidget(QtGui.QMainWindow):
     def draw_reset_levels(self):
         """Reset the image low/high levels to their initial values"""
         level_low, level_high = self.initial_levels
-        self.assemble_draw()
+        self.assemble_draw(wait=True)
         self.imv.setLevels(level_low, level_high)
         self.imv.setHistogramRange(min(level_low, 0), level_high * 2)
         self.imv.autoRange()
 
     @QtCore.pyqtSlot()
-    def assemble_draw(self):
-        """Read the geometry file and position all modules."""
-        if self.run_dir is None:
+    def assemble_draw(self, wait=False):
+        """Read the selected data and position all modules.
+
+        The reading and assembly run in a worker thread, a new request
+        cancels all earlier ones that are not displayed yet.
+
+        Parameters:
+            wait : (bool)
+              Assemble in the GUI thread and display the result before
+              returning (default: False)
+        """
+        if self.run_dir is None and self.run_selector.live_source is None:
             warning('Click the Run-dir button to select a run directory')
             self.log.error(' No data to assemble loaded ... ')
             return
+        geom = self.geom_obj
+        if geom is None:
+            return
         self.log.info(' Starting to assemble ... ')
+
+        self._assembly_request += 1
+        self._assembly_pool.clear()
+        task = _AssemblyTask(self, self._assembly_request,
+                             self.run_selector.selection(), geom)
+        if wait:
+            QtGui.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
+            try:
+                task.run()
+            finally:
+                QtGui.QApplication.restoreOverrideCursor()
+        else:
+            self._assembly_pool.start(task)
+
+    def assemble(self, request, selection, geom):
+        """Read and assemble a selection, without touching any widget.
+
+        Returns None if a newer request came in meanwhile.
+
+        Parameters:
+            request : (int)
+              Number of the request
+            selection : (tuple)
+              Data selection, see RunDataWidget.selection
+            geom : (GeometryAssembler)
+              Geometry used for the assembly
+        """
         try:
-            self.raw_data = self.run_selector.get()
+            raw_data = self.run_selector.read_selection(selection)
         except ValueError:
-            warning('No data in trainId, select a different trainId')
-            return
+            raise _AssemblyError('No data in trainId, select a different '
+                                 'trainId')
+        if request != self._assembly_request:
+            return None
 
+        version = geom.version
+        canvas = None
         try:
-            data, self.centre = self.geom_obj.position_all_modules(self.raw_data)
+            canvas_shape, _ = geom.canvas_geometry(
+                margin=Defaults.canvas_margin)
+            canvas = self._take_canvas(canvas_shape, raw_data.dtype)
+            data, centre = geom.position_all_modules(
+                raw_data, canvas=canvas_shape, out=canvas)
         except ValueError:
-            warning('Error while applying geometry, check Detector Settings')
+            self._release_canvas(canvas)
+            raise _AssemblyError('Error while applying geometry, check '
+                                 'Detector Settings')
+        return raw_data, data, centre, geom, version
+
+    def _take_canvas(self, shape, dtype):
+        """A free canvas buffer of a shape and dtype, or a new one."""
+        with self._canvas_lock:
+            while self._free_canvases:
+                canvas = self._free_canvases.pop()
+                if canvas.shape == shape and canvas.dtype == dtype:
+                    return canvas
+        return np.empty(shape, dtype=dtype)
+
+    def _release_canvas(self, canvas):
+        """Keep a canvas buffer that is not displayed for reuse."""
+        if canvas is None or canvas is self.canvas:
             return
-        self.canvas = np.full(np.array(data.shape) + Defaults.canvas_margin,
-                              np.nan)
-        try:
-            self.data, _ = self.geom_obj.position_all_modules(self.raw_data,
-                                                              canvas=self.canvas.shape)
-        except ValueError:
-            warning('Error while applying geometry, check Detector Settings')
+        with self._canvas_lock:
+            self._free_canvases.append(canvas)
+            # One is enough for the single worker, a second one covers the
+            # results on their way to the GUI thread
+            del self._free_canvases[:-2]
+
+    @QtCore.pyqtSlot(int, object)
+    def _assembled(self, request, result):
+        """Display an assembled image, unless a newer one was requested."""
+        if request != self._assembly_request:
+            self._release_canvas(result[1])
             return
+        self.raw_data, data, self.centre, geom, version = result
+        if version != geom.version:
+            # The geometry was moved while assembling
+            geom.position_all_modules(self.raw_data, canvas=data.shape,
+                                      out=data)
+        self._release_canvas(self.canvas)
+        self.canvas = self.data = data
 
         # Display the data and assign each frame a time value from 1.0 to 3.0
         self._draw_rect(None)
@@ -194,6 +341,14 @@ class QtMainWidget(QtGui.QMainWindow):
         self.quad = -1
         self.fit_widget.bt_add_shape.setEnabled(True)
 
+    @QtCore.pyqtSlot(int, str)
+    def _assembly_failed(self, request, msg):
+        """Show why the latest assembly failed."""
+        if request != self._assembly_request:
+            return
+        self.log.error(msg)
+        warning(msg)
+
     def redraw_image(self):
         img = self.data[::-1, ::self._flip_lr]
         self.imv.setImage(
@@ -211,17 +366,44 @@ class QtMainWidget(QtGui.QMainWindow):
         if self.quad > 0:
             self._draw_rect(self.quad)
 
+    def _move_step(self):
+        """The step of a move in pixels, growing while a key is held."""
+        now = time.monotonic()
+        if (self._last_move is not None
+                and now - self._last_move < Defaults.move_burst_ms / 1000):
+            self._move_burst += 1
+        else:
+            self._move_burst = 0
+        self._last_move = now
+        step = int(Defaults.move_acceleration ** self._move_burst)
+        return min(step, Defaults.move_max_step)
+
     def _move(self, d):
-        """Move the quadrant."""
+        """Move the quadrant, on the next tick of the move timer."""
         quad = self.quad
         if quad <= 0:
             return
-        inc = np.array(Defaults.direction[d])*np.array([self._flip_lr, 1])
-        self.geom_obj.move_quad(quad, inc)
-        self.data, self.centre =\
-            self.geom_obj.position_all_modules(self.raw_data,
-                                               canvas=self.canvas.shape)
-        self._draw_rect(quad)
+        inc = (np.array(Defaults.direction[d]) * np.array([self._flip_lr, 1])
+               * self._move_step())
+        self._pending_moves[quad] = self._pending_moves.get(quad, 0) + inc
+        if not self._move_timer.isActive():
+            self._move_timer.start()
+
+    @QtCore.pyqtSlot()
+    def _apply_moves(self):
+        """Apply all collected quadrant moves and redraw once."""
+        moves, self._pending_moves = self._pending_moves, {}
+        moves = {quad: inc for quad, inc in moves.items() if np.any(inc)}
+        if not moves or self.raw_data is None:
+            return
+        geom = self.geom_obj
+        for quad, inc in moves.items():
+            geom.move_quad(quad, inc)
+        # The displayed canvas is only written here, in the GUI thread
+        self.data, self.centre = geom.position_all_modules(
+            self.raw_data, canvas=self.canvas.shape, out=self.canvas)
+        if self.quad > 0:
+            self._draw_rect(self.quad)
         self.redraw_image()
 
     def _draw_shape(self):
@@ -233,19 +415,46 @@ class QtMainWidget(QtGui.QMainWindow):
         for num in self.shapes:
             self.image.removeItem(self.shapes[num])
 
-    def _get_quadrant(self, x, y):
-        """Return the quadrant for a given set of coordinates."""
-        x1, x2, x3 = 0, self.data.shape[-2]/2, self.data.shape[-2]
-        y1, y2, y3 = 0, self.data.shape[-1]/2, self.data.shape[-1]
-
-        self.bounding_boxes = {1: (x2, x3, y1, y2),
-                               2: (x1, x2, y1, y2),
-                               3: (x1, x2, y2, y3),
-                               4: (x2, x3, y2, y3)}
+    def _data_index(self, pos):
+        """Row and column of self.data at a position of the displayed image,
+        which is upside down and mirrored in the front view."""
+        Y, X = self.data.shape
+        y = Y - 1 - int(np.floor(pos.y()))
+        x = int(np.floor(pos.x()))
+        if self.frontview:
+            x = X - 1 - x
+        return y, x
 
-        for quadrant, bbox in self.bounding_boxes.items():
-            if bbox[0] <= x < bbox[1] and bbox[2] <= y < bbox[3]:
-                return quadrant
+    def _hover(self, event):
+        """Show the pixel under the cursor in the status bar."""
+        if self.data is None or self.raw_data is None:
+            return
+        pos = self.imv.getImageItem().mapFromScene(event[0])
+        self.statusBar().showMessage(self._pixel_info(*self._data_index(pos)))
+
+    def _pixel_info(self, y, x):
+        """Describe the detector pixel at a position of the image."""
+        info = 'y: {}, x: {}'.format(y, x)
+        label = self.geom_obj.pixel_at(y, x, canvas=self.data.shape)
+        if label is None:
+            return info
+        # The tile is from the geometry, the block is the common mode block
+        # of the preprocessing, an ASIC of AGIPD and DSSC but a tile of LPD
+        n_fs = self.raw_data.shape[-1]
+        block_ss, block_fs = Defaults.common_mode_blocks[self.det]
+        block = ((label.ss // block_ss) * (n_fs // block_fs)
+                 + label.fs // block_fs)
+        value = self.raw_data[label.module, label.ss, label.fs]
+        return ('{}  |  quadrant {}, module {}, tile {}, '
+                'common mode block {}, ss {}, fs {}  |  value {:g}').format(
+                    info, label.quadrant, label.module, label.tile, block,
+                    label.ss, label.fs, value)
+
+    def _get_quadrant(self, y, x):
+        """Return the quadrant of the pixel at a position of the image."""
+        label = self.geom_obj.pixel_at(y, x, canvas=self.data.shape)
+        if label is not None:
+            return label.quadrant
 
     def _draw_rect(self, quad):
         """Draw rectangle around quadrant."""
@@ -280,14 +489,7 @@ class QtMainWidget(QtGui.QMainWindow):
         if self.quad == 0:
             return
         event.accept()
-        # Get postion of mouse-click and display it
-        Y, X = self.data.shape
-        pos = event.pos()
-        x = int(pos.x())
-        if self.frontview:
-            x = X - x
-        y = int(Y - pos.y())
-        quad = self._get_quadrant(y, x)
+        quad = self._get_quadrant(*self._data_index(event.pos()))
         if quad is None:
             self.imv.getView().removeItem(self.rect)
             self.rect = None
@@ -311,3 +513,12 @@ class QtMainWidget(QtGui.QMainWindow):
     @QtCore.pyqtSlot()
     def show_log(self):
         LogDialog(self).open()
+
+    def closeEvent(self, event):
+        """Stop reading data in the background before closing."""
+        self.run_selector.stop_live()
+        self._assembly_request += 1
+        self._assembly_pool.clear()
+        self._assembly_pool.waitForDone()
+        self.run_selector.stop_prefetch()
+        super().closeEvent(event)
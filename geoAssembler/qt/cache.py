@@ -0,0 +1,200 @@
+"""Caches of detector data read from a run, in memory and on disk."""
+
+from collections import OrderedDict
+import hashlib
+import os
+import os.path as op
+import threading
+
+import h5py
+import numpy as np
+
+from ..io_utils import run_fingerprint
+
+
+class TrainCache:
+    """Least recently used cache of arrays under a memory budget.
+
+    Entries are keyed by anything hashable, e.g. (train_id, 'stack') for the
+    full train and (train_id, 'mean') for its mean, so that small reductions
+    survive when the large train stacks are evicted. The cache can be
+    shared between the GUI and background reader threads.
+    """
+
+    def __init__(self, max_bytes):
+        """Create an empty cache.
+
+        Parameters:
+            max_bytes (int): Memory budget of all cached arrays in bytes
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def nbytes(self):
+        """Memory used by all cached arrays in bytes."""
+        return self._nbytes
+
+    def get(self, key):
+        """Return the cached array, or None, and count the hit or miss.
+
+        Parameters:
+            key : Key of the entry
+        """
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Add an array and evict the least recently used ones over budget.
+
+        Arrays larger than the whole budget are not cached.
+
+        Parameters:
+            key : Key of the entry
+            value (numpy.ndarray): Array to cache
+        """
+        if value.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= self._entries.pop(key).nbytes
+            self._entries[key] = value
+            self._nbytes += value.nbytes
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """Summary of the counters for the log."""
+        return 'Train cache: {} hits, {} misses, {} entries, {:.0f} MB'.format(
+            self.hits, self.misses, len(self), self.nbytes / 1024**2)
+
+
+class RunSummary:
+    """Summary of a run kept on local disk, to reopen the run quickly.
+
+    The summary holds the train ids, the number of frames per train and the
+    per-train reductions (e.g. the mean module stacks) computed so far. It is
+    stored in one HDF5 file per run, named after the run path, and is only
+    valid as long as the names, sizes and modification times of the run
+    files are unchanged.
+    """
+
+    def __init__(self, run_path, cache_dir):
+        """Find the summary of a run, which need not exist yet.
+
+        Parameters:
+            run_path (str): Directory of the run
+            cache_dir (str): Directory of the summary files
+        """
+        self.run_path = op.abspath(run_path)
+        name = hashlib.sha1(self.run_path.encode()).hexdigest()
+        self.filename = op.join(cache_dir, name + '.h5')
+        self._fingerprint = run_fingerprint(self.run_path)
+        self._lock = threading.Lock()
+
+    def _is_valid(self, f):
+        return (f.attrs.get('run_path') == self.run_path
+                and f.attrs.get('fingerprint') == self._fingerprint)
+
+    def load(self):
+        """Read the train ids and frames per train of a valid summary.
+
+        Returns:
+            tuple: (list of train ids, frames per train), or None if there is
+                   no valid summary
+        """
+        if self._fingerprint == '[]':
+            return None
+        with self._lock:
+            try:
+                with h5py.File(self.filename, 'r') as f:
+                    if not self._is_valid(f):
+                        return None
+                    return (f['train_ids'][()].tolist(),
+                            int(f.attrs['frames_per_train']))
+            except (OSError, KeyError):
+                return None
+
+    def save(self, train_ids, frames_per_train):
+        """Start a new summary, dropping the reductions of an old one.
+
+        Raises OSError if the summary cannot be written.
+
+        Parameters:
+            train_ids (list): Train ids of the run
+            frames_per_train (int): Number of frames in every train
+        """
+        with self._lock:
+            os.makedirs(op.dirname(self.filename), exist_ok=True)
+            tmp_file = self.filename + '.{}.tmp'.format(os.getpid())
+            with h5py.File(tmp_file, 'w') as f:
+                f.attrs['run_path'] = self.run_path
+                f.attrs['fingerprint'] = self._fingerprint
+                f.attrs['frames_per_train'] = frames_per_train
+                f['train_ids'] = np.asarray(train_ids, dtype=np.uint64)
+            os.replace(tmp_file, self.filename)
+
+    def get(self, tid, name):
+        """Read a reduction of a train, or None if it is not in the summary.
+
+        Parameters:
+            tid (int): Train id
+            name (str): Name of the reduction, e.g. nanmean
+        """
+        with self._lock:
+            try:
+                with h5py.File(self.filename, 'r') as f:
+                    dset = f.get('{}/{}'.format(name, tid))
+                    if dset is None or not self._is_valid(f):
+                        return None
+                    return dset[()]
+            except OSError:
+                return None
+
+    def put(self, tid, name, data):
+        """Add a reduction of a train to the summary, if it has been saved.
+
+        Raises OSError if the summary cannot be written.
+
+        Parameters:
+            tid (int): Train id
+            name (str): Name of the reduction, e.g. nanmean
+            data (numpy.ndarray): Reduced module stack
+        """
+        with self._lock:
+            if not op.exists(self.filename):
+                return
+            with h5py.File(self.filename, 'a') as f:
+                if not self._is_valid(f):
+                    return
+                path = '{}/{}'.format(name, tid)
+                if path in f:
+                    del f[path]
+                f.create_dataset(path, data=data, compression='lzf')
@@ -0,0 +1,226 @@
+"""Live detector data from a karabo-bridge ZeroMQ stream."""
+
+from collections import deque
+import re
+import threading
+
+from extra_data import stack_detector_data
+import numpy as np
+
+from ..preprocess import Preprocessor
+
+
+def module_stack_from_bridge(data, n_modules=16, module_shape=None):
+    """Stack the detector data of a karabo-bridge message.
+
+    Both per-module sources (.../DET/<n>CH0:xtdf) and a single source with
+    all modules (e.g. .../CAL/APPEND_CORRECTED) are understood. The latter
+    can have the online layout (modules, fast_scan, slow_scan, pulses) or
+    the file layout (pulses, modules, slow_scan, fast_scan).
+
+    Parameters:
+        data (dict): Data of the message, keyed by source name
+    Keywords:
+        n_modules (int): Number of detector modules (default 16)
+        module_shape (tuple): Slow and fast scan pixels of a module, needed to
+                              recognise the online layout (default None)
+
+    Returns:
+        numpy.ndarray: (pulses, modules, slow_scan, fast_scan), raw data
+                       has an extra gain dimension after the modules
+    """
+    modules = {src: d for src, d in data.items()
+               if re.search(r'/DET/\d+CH', src) and 'image.data' in d}
+    if modules:
+        return stack_detector_data(modules, 'image.data')
+
+    for src_data in data.values():
+        arr = src_data.get('image.data') if isinstance(src_data, dict) else None
+        if arr is None or np.ndim(arr) != 4:
+            continue
+        arr = np.asarray(arr)
+        if (module_shape is not None and arr.shape[0] == n_modules
+                and arr.shape[1:3] == tuple(module_shape)[::-1]):
+            # Online layout (modules, fs, ss, pulses)
+            return arr.transpose(3, 0, 2, 1)
+        return arr
+    raise ValueError('No detector image data in the message')
+
+
+def cells_from_bridge(data):
+    """Memory cell ids of the pulses of a karabo-bridge message.
+
+    Parameters:
+        data (dict): Data of the message, keyed by source name
+
+    Returns:
+        numpy.ndarray: Cell id of every pulse, or None without cell ids
+    """
+    for src_data in data.values():
+        if isinstance(src_data, dict) and 'image.cellId' in src_data:
+            return np.asarray(src_data['image.cellId']).ravel()
+    return None
+
+
+class RollingMean:
+    """Mean of the last n images, updated in constant time per image.
+
+    Every pixel is averaged over the images in which it is finite, pixels
+    missing from some trains are not pulled towards zero.
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self._images = deque()
+        self._sum = None
+        self._count = None
+
+    def __len__(self):
+        return len(self._images)
+
+    def add(self, image):
+        """Add an image and forget the oldest beyond n images."""
+        if self._sum is None:
+            self._sum = np.zeros(image.shape)
+            self._count = np.zeros(image.shape, dtype=np.int64)
+        self._images.append(image)
+        self._update(image, 1)
+        while len(self._images) > self.n:
+            self._update(self._images.popleft(), -1)
+
+    def _update(self, image, sign):
+        finite = np.isfinite(image)
+        self._sum += sign * np.where(finite, image, 0)
+        self._count += sign * finite
+
+    def mean(self):
+        """The mean image as float32, NaN where no image has the pixel."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self._sum / self._count
+        return np.where(self._count > 0, mean, np.nan).astype(np.float32)
+
+
+class LiveSource:
+    """Receive detector data from a karabo-bridge in a background thread.
+
+    Every train is averaged over its pulses and added to the rolling mean of
+    the last n_average trains. The rolling means wait in a bounded queue,
+    the oldest are dropped if the GUI cannot keep up, and the GUI only
+    displays the newest one; older ones are stale and dropped as well.
+    """
+
+    def __init__(self, endpoint, sock='REQ', n_average=1, queue_size=4,
+                 preprocessor=None, module_shape=None, timeout=0.5):
+        """Connect to a stream, receiving starts with start.
+
+        Parameters:
+            endpoint (str): ZeroMQ endpoint, e.g. tcp://host:port
+        Keywords:
+            sock (str): Socket type, REQ, SUB or PULL (default REQ)
+            n_average (int): Number of trains in the rolling mean (default 1)
+            queue_size (int): Number of images waiting for the GUI
+                              (default 4)
+            preprocessor (Preprocessor): Preprocessing of the frames
+                                         (default: clip negative values)
+            module_shape (tuple): Slow and fast scan pixels of a module
+            timeout (float): Seconds to wait for data before checking if
+                             the source is stopped (default 0.5)
+        """
+        self.endpoint = endpoint
+        self.sock = sock
+        self.preprocessor = preprocessor or Preprocessor()
+        self.module_shape = module_shape
+        self.timeout = timeout
+        self.received = 0
+        self.dropped = 0
+        self.error = None
+        self._rolling = RollingMean(n_average)
+        self._queue = deque(maxlen=queue_size)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def n_average(self):
+        """Number of trains in the rolling mean."""
+        return self._rolling.n
+
+    @n_average.setter
+    def n_average(self, n):
+        with self._lock:
+            self._rolling.n = n
+
+    def start(self):
+        """Start receiving data."""
+        # Only needed for live data, so only imported here
+        try:
+            from karabo_bridge import Client
+        except ImportError:
+            raise ImportError('Live data needs the karabo-bridge package, '
+                              'install geoAssembler[live]')
+        self._thread = threading.Thread(target=self._run, args=(Client,),
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop receiving data and wait for the receiving thread."""
+        self._stop.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self, Client):
+        try:
+            with Client(self.endpoint, sock=self.sock,
+                        timeout=self.timeout) as client:
+                while not self._stop.is_set():
+                    try:
+                        data, meta = client.next()
+                    except TimeoutError:
+                        continue
+                    self._receive(data, meta)
+        except Exception as err:
+            self.error = err
+
+    def _receive(self, data, meta):
+        """Average a train over its pulses and queue the rolling mean."""
+        preprocessor = self.preprocessor
+        stack = module_stack_from_bridge(data, module_shape=self.module_shape)
+        if stack.ndim == 5:
+            # Raw data has an extra gain dimension - only take the data
+            stack = stack[:, :, preprocessor.gain_index]
+        stack = np.array(stack, dtype=preprocessor.dtype)
+        cells = cells_from_bridge(data) if preprocessor.per_cell else None
+        if cells is not None and len(cells) != len(stack):
+            cells = None  # Not one per pulse, fall back to the pulse index
+        # Module-major view, so the preprocessor finds every module's dark
+        preprocessor.process_modules(stack.swapaxes(0, 1), cells)
+        with np.errstate(invalid='ignore'):
+            image = np.nanmean(stack, axis=0)
+
+        tid = self.received
+        for src_meta in meta.values():
+            tid = src_meta.get('timestamp.tid', tid)
+            break
+        with self._lock:
+            self.received += 1
+            self._rolling.add(image)
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+            self._queue.append((int(tid), self._rolling.mean()))
+
+    def latest(self):
+        """The newest (train id, rolling mean image), or None.
+
+        Older images waiting in the queue are stale and dropped.
+        """
+        with self._lock:
+            if not self._queue:
+                return None
+            self.dropped += len(self._queue) - 1
+            item = self._queue.pop()
+            self._queue.clear()
+            return item
@@ -2,18 +2,23 @@
 
 import os
 from os import path as op
+import threading
 
-from extra_data import RunDirectory, stack_detector_data
+from extra_data import RunDirectory, by_id, by_index
 from extra_data.components import AGIPD1M, LPD1M, DSSC1M
 import numpy as np
 from PyQt5 import uic
 from pyqtgraph.Qt import (QtCore, QtGui, QtWidgets)
 
+from .cache import RunSummary, TrainCache
+from .live import LiveSource
 from .objects import (CircleShape, DetectorHelper, SquareShape, warning)
 from .utils import get_icon
 
 from ..defaults import DefaultGeometryConfig as Defaults
-from ..io_utils import read_geometry, write_geometry
+from ..io_utils import (REDUCTIONS, hit_mean, read_geometry, read_train,
+                        reduce_run, write_geometry)
+from ..preprocess import Preprocessor, load_dark
 
 
 Slot = QtCore.pyqtSlot
@@ -165,17 +170,32 @@ class FitObjectWidget(QtWidgets.QFrame):
         self.shapes = {}
 
 
+class _TrainReader(QtCore.QRunnable):
+    """Read train data into the cache of a RunDataWidget in a worker thread."""
+
+    def __init__(self, run_widget, key, generation):
+        super().__init__()
+        self.run_widget = run_widget
+        self.key = key
+        self.generation = generation
+
+    def run(self):
+        self.run_widget._prefetch(self.key, self.generation)
+
+
 class RunDataWidget(QtWidgets.QFrame):
     """A widget that defines run-directory, trainId and self.rb_pulse selection."""
 
     run_changed = Signal()
     selection_changed = Signal()
 
-    def __init__(self, main_widget):
+    def __init__(self, main_widget, cache_size=None):
         """Create a btn for run-dir select and 2 spin boxes for train, self.rb_pulse.
 
         Parameters:
             main_widget : Parent widget
+            cache_size : Memory budget of the train cache in bytes
+                         (default Defaults.train_cache_size)
         """
         super().__init__(main_widget)
 
@@ -183,14 +203,41 @@ class RunDataWidget(QtWidgets.QFrame):
         uic.loadUi(ui_file, self)
 
         self.main_widget = main_widget
-        self.rundir = None
-        self._cached_train_stack = (None, None)  # (tid, data)
+        self.train_cache = TrainCache(cache_size or Defaults.train_cache_size)
+        self.preprocessor = Preprocessor()
+        self._custom_preprocessor = False
+        self._dark = None
+        self.summary = None
+        self.run_path = None
+        self._rundir = None
+        self._det = None
+        self._open_lock = threading.RLock()
+        self._train_ids = []
+
+        # Background readers of the trains around the current one. Trains
+        # being read are tracked by (run generation, train id), so that the
+        # GUI waits for them instead of reading them twice, and readers of a
+        # previous run do not fill the cache of the current one.
+        self._prefetch_pool = QtCore.QThreadPool(self)
+        self._prefetch_pool.setMaxThreadCount(Defaults.prefetch_threads)
+        self._pending = {}  # (generation, tid): threading.Event
+        self._pending_lock = threading.Lock()
+        self._generation = 0
 
         self.bt_select_run_dir.clicked.connect(self._sel_run)
         self.bt_select_run_dir.setIcon(get_icon('open.png'))
+        self.bt_select_dark.clicked.connect(self._sel_dark)
+        self.cb_common_mode.toggled.connect(self._update_preprocessor)
 
-        for radio_btn in (self.rb_pulse, self.rb_mean):
+        for radio_btn in (self.rb_pulse, self.rb_mean, self.rb_hits,
+                          self.rb_run):
             radio_btn.clicked.connect(self._set_sel_method)
+        self.sb_top_n.setValue(Defaults.hit_frames)
+        self.sb_top_n.valueChanged.connect(self._options_changed)
+        self.cb_run_method.addItems(REDUCTIONS)
+        self.sb_n_trains.setValue(Defaults.run_trains)
+        self.cb_run_method.currentIndexChanged.connect(self._options_changed)
+        self.sb_n_trains.valueChanged.connect(self._options_changed)
 
         # Apply no selection method (sum, mean) to select self.rb_pulses by default
         self._sel_method = None
@@ -199,23 +246,70 @@ class RunDataWidget(QtWidgets.QFrame):
         self.sb_train_id.valueChanged.connect(self.selection_changed.emit)
         self.sb_pulse_id.valueChanged.connect(self.selection_changed.emit)
 
+        # Live data replaces the run while it is received. Only the newest
+        # image is shown at every tick of the timer, older ones are dropped.
+        self.live_source = None
+        self._live_image = None
+        self._live_timer = QtCore.QTimer(self)
+        self._live_timer.setInterval(Defaults.live_interval_ms)
+        self._live_timer.timeout.connect(self._show_live)
+        self.le_endpoint.setText(Defaults.live_endpoint)
+        self.sb_live_average.setValue(Defaults.live_average)
+        self.sb_live_average.valueChanged.connect(self._set_live_average)
+        self.bt_live.toggled.connect(self._toggle_live)
+
     def get_train_id(self):
         return self.sb_train_id.value()
 
-    def run_loaded(self):
-        """Update the UI after a run is successfully loaded"""
-        det = det_data_classes[self.main_widget.det](self.rundir, min_modules=9)
-        self.sb_train_id.setMinimum(det.data.train_ids[0])
-        self.sb_train_id.setMaximum(det.data.train_ids[-1])
-        self.sb_train_id.setValue(det.data.train_ids[0])
+    @property
+    def rundir(self):
+        """The run, which is only opened on first use if it was loaded from
+        its summary."""
+        with self._open_lock:
+            if self._rundir is None and self.run_path is not None:
+                self._rundir = RunDirectory(self.run_path)
+            return self._rundir
 
-        self.sb_pulse_id.setMaximum(det.frames_per_train - 1)
+    @property
+    def det_data(self):
+        """The extra_data detector component of the run."""
+        with self._open_lock:
+            if self._det is None and self.rundir is not None:
+                self._det = det_data_classes[self.main_widget.det](
+                    self.rundir, min_modules=9)
+            return self._det
+
+    def run_loaded(self, index=None):
+        """Update the UI after a run is successfully loaded
+
+        Parameters:
+            index : (train ids, frames per train) from the run summary, by
+                    default they are taken from the run, which is summarised
+        """
+        if index is None:
+            det = self.det_data
+            index = (list(det.data.train_ids), det.frames_per_train)
+            try:
+                self.summary.save(*index)
+            except OSError as err:
+                self.main_widget.log.warning(
+                    'Could not write the run summary: %s', err)
+        train_ids, frames_per_train = index
+        self._train_ids = list(train_ids)
+        self.sb_train_id.setMinimum(train_ids[0])
+        self.sb_train_id.setMaximum(train_ids[-1])
+        self.sb_train_id.setValue(train_ids[0])
+
+        self.sb_pulse_id.setMaximum(frames_per_train - 1)
 
         # Enable spin boxes and radio buttons
         self.sb_train_id.setEnabled(True)
         self.sb_pulse_id.setEnabled(True)
-        for radio_btn in (self.rb_pulse, self.rb_mean):
+        for radio_btn in (self.rb_pulse, self.rb_mean, self.rb_hits,
+                          self.rb_run):
             radio_btn.setEnabled(True)
+        self.sb_top_n.setMaximum(frames_per_train)
+        self.sb_n_trains.setMaximum(len(self._train_ids))
 
         self.run_changed.emit()
 
@@ -224,14 +318,26 @@ class RunDataWidget(QtWidgets.QFrame):
         select_pulse = False
         if self.rb_mean.isChecked():
             self._sel_method = np.nanmean
+        elif self.rb_hits.isChecked():
+            self._sel_method = hit_mean
+        elif self.rb_run.isChecked():
+            self._sel_method = reduce_run
         else:
             # Single Pulse
             self._sel_method = None
             select_pulse = True
 
         self.sb_pulse_id.setEnabled(select_pulse)
+        self.sb_top_n.setEnabled(self.rb_hits.isChecked())
+        self.cb_run_method.setEnabled(self.rb_run.isChecked())
+        self.sb_n_trains.setEnabled(self.rb_run.isChecked())
         self.selection_changed.emit()
 
+    @QtCore.pyqtSlot()
+    def _options_changed(self):
+        if self._sel_method in (hit_mean, reduce_run):
+            self.selection_changed.emit()
+
     @QtCore.pyqtSlot()
     def _sel_run(self):
         """Select a run directory."""
@@ -244,39 +350,408 @@ class RunDataWidget(QtWidgets.QFrame):
         """Read a selected run directory."""
         self.main_widget.log.info('Opening run directory {}'.format(rfolder))
         QtGui.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
+        # A valid summary of the run saves opening and indexing its files
+        # until data is read that is not summarised
+        summary = RunSummary(rfolder, Defaults.summary_cache_dir)
+        index = summary.load()
+        rundir = None
+        if index is None:
+            try:
+                rundir = RunDirectory(rfolder)
+            except Exception:
+                QtGui.QApplication.restoreOverrideCursor()
+                self.main_widget.log.info('Could not find HDF5-Files')
+                warning('No HDF5-Files found', title='Info')
+                return
+        else:
+            self.main_widget.log.info('Using the run summary {}'.format(
+                summary.filename))
+
+        self.le_run_directory.setText(rfolder)
+        self._cancel_prefetch()
+        self._generation += 1
+        self.train_cache.clear()
+        with self._open_lock:
+            self.run_path = rfolder
+            self._rundir = rundir
+            self._det = None
+        self.summary = summary
+        self.run_loaded(index)
+        QtGui.QApplication.restoreOverrideCursor()
+
+    def read_train_stack(self, tid):
+        """Read a train from the run, without using the cache.
+
+        Returns 4D array (pulses, modules, slow_scan, fast_scan)
+        """
+        return read_train(self.rundir, tid, preprocess=self.preprocessor)
+
+    def read_pulse(self, tid, pulse):
+        """Read a single pulse of a train from the run, without the cache.
+
+        Only the selected frame of every module is read from the files.
+
+        Returns 3D array (modules, slow_scan, fast_scan)
+        """
+        train = self.det_data.select_trains(by_id[[tid]])
+        data = train['image.data']
+        # Raw data has an extra gain dimension - only read the data
+        roi = (self.preprocessor.gain_index,) if data.ndim == 5 else ()
+        img = data.select_pulses(by_index[[pulse]]).ndarray(roi=roi)[:, 0]
+        img = img.astype(self.preprocessor.dtype, copy=False)
+        cells = [pulse]
+        if self.preprocessor.per_cell:
+            # The memory cell of the pulse selects its dark offset, the
+            # same in all modules that have data
+            cells = train['image.cellId'].select_pulses(by_index[[pulse]])
+            cells = np.max(cells.ndarray(fill_value=0), axis=0).ravel()
+        return self.preprocessor.process_modules(img, cells)
+
+    def set_preprocessor(self, preprocessor=None):
+        """Change the preprocessing of the data read from the run.
+
+        Parameters:
+            preprocessor : Preprocessor, by default only negative values are
+                           clipped
+        """
+        self._cancel_prefetch()
+        self._generation += 1
+        self.train_cache.clear()
+        self._custom_preprocessor = preprocessor is not None
+        self.preprocessor = preprocessor or Preprocessor()
+        if self.live_source is not None:
+            self.live_source.preprocessor = self.preprocessor
+        self.selection_changed.emit()
+
+    @QtCore.pyqtSlot()
+    def _sel_dark(self):
+        """Select a dark run directory."""
+        rfolder = QtGui.QFileDialog.getExistingDirectory(
+            self, 'Select dark run directory')
+        if rfolder:
+            self.read_dark(rfolder)
+
+    def read_dark(self, rfolder):
+        """Subtract the dark offset of a dark run from the data."""
+        self.main_widget.log.info('Reading dark run {}'.format(rfolder))
+        QtGui.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
         try:
-            self.rundir = RunDirectory(rfolder)
-        except Exception:
+            self._dark = load_dark(rfolder, Defaults.summary_cache_dir)
+        except Exception as err:
+            self.main_widget.log.warning('Could not read the dark run: %s',
+                                         err)
+            warning('Could not read the dark run', title='Info')
+            return
+        finally:
             QtGui.QApplication.restoreOverrideCursor()
-            self.main_widget.log.info('Could not find HDF5-Files')
-            warning('No HDF5-Files found', title='Info')
+        self._update_preprocessor()
+
+    @QtCore.pyqtSlot()
+    def _update_preprocessor(self):
+        """Apply the dark offset and common mode settings."""
+        if self._dark is None and not self.cb_common_mode.isChecked():
+            self.set_preprocessor()
             return
+        dark, dark_cells = self._dark or (None, None)
+        self.set_preprocessor(Preprocessor(
+            dark=dark, dark_cells=dark_cells,
+            common_mode=self.cb_common_mode.isChecked(),
+            asic_shape=Defaults.common_mode_blocks[self.main_widget.det]))
+
+    @QtCore.pyqtSlot(bool)
+    def _toggle_live(self, checked):
+        if checked:
+            self.start_live()
+        else:
+            self.stop_live()
 
-        self.le_run_directory.setText(rfolder)
-        self.run_loaded()
-        QtGui.QApplication.restoreOverrideCursor()
+    def start_live(self, endpoint=None, sock='REQ'):
+        """Show live data of a karabo-bridge instead of the run.
+
+        Parameters:
+            endpoint : ZeroMQ endpoint (default the one in the text field)
+            sock : Socket type, REQ, SUB or PULL (default REQ)
+        """
+        self.stop_live()
+        endpoint = endpoint or self.le_endpoint.text()
+        self.le_endpoint.setText(endpoint)
+        self.main_widget.log.info('Receiving live data from {}'.format(
+            endpoint))
+        source = LiveSource(
+            endpoint, sock, n_average=self.sb_live_average.value(),
+            queue_size=Defaults.live_queue_size,
+            preprocessor=self.preprocessor,
+            module_shape=det_data_classes[self.main_widget.det].module_shape)
+        try:
+            source.start()
+        except ImportError as err:
+            self.main_widget.log.error(str(err))
+            warning(str(err), title='Info')
+            self._set_live_checked(False)
+            return
+        self.live_source = source
+        self._live_image = None
+        self._set_live_checked(True)
+        self.le_endpoint.setEnabled(False)
+        self._live_timer.start()
+
+    def stop_live(self):
+        """Stop receiving live data."""
+        self._live_timer.stop()
+        source, self.live_source = self.live_source, None
+        if source is not None:
+            source.stop()
+            self.main_widget.log.info(
+                'Live data stopped: {} trains received, {} dropped'.format(
+                    source.received, source.dropped))
+        self._live_image = None
+        self._set_live_checked(False)
+        self.le_endpoint.setEnabled(True)
+
+    def _set_live_checked(self, checked):
+        self.bt_live.blockSignals(True)
+        self.bt_live.setChecked(checked)
+        self.bt_live.blockSignals(False)
+
+    @QtCore.pyqtSlot(int)
+    def _set_live_average(self, n_average):
+        if self.live_source is not None:
+            self.live_source.n_average = n_average
 
-    def get_train_stack(self):
+    @QtCore.pyqtSlot()
+    def _show_live(self):
+        """Show the newest live image, if there is a new one."""
+        source = self.live_source
+        if source is None:
+            return
+        if source.error is not None:
+            self.main_widget.log.error('Live data failed: %s', source.error)
+            self.stop_live()
+            warning('Live data failed: {}'.format(source.error))
+            return
+        item = source.latest()
+        if item is None:
+            return
+        first = self._live_image is None
+        self._live_image = item
+        if first:
+            self.run_changed.emit()
+        else:
+            self.selection_changed.emit()
+
+    def _read(self, key):
+        """Read the data of a cache key from the run."""
+        if key[1] == 'pulse':
+            self.main_widget.log.info('Reading pulse %s of train #: %s',
+                                      key[2], key[0])
+            return self.read_pulse(key[0], key[2])
+        self.main_widget.log.info('Reading train #: %s', key[0])
+        return self.read_train_stack(key[0])
+
+    def _get_cached(self, key):
+        """Get the data of a cache key, reading it if it is not cached.
+
+        Parameters:
+            key : (tid, 'stack') for a train or (tid, 'pulse', pulse) for a
+                  single pulse
+        """
+        with self._pending_lock:
+            reading = self._pending.get((self._generation,) + key)
+        if reading is not None:
+            # Already being prefetched, wait for it instead of reading twice
+            reading.wait()
+
+        arr = self.train_cache.get(key)
+        if arr is None:
+            arr = self._read(key)
+            self.train_cache.put(key, arr)
+
+        self.prefetch(key, arr.nbytes)
+        return arr
+
+    def get_train_stack(self, tid=None):
         """Get a 4D array representing detector data in a train
 
         (pulses, modules, slow_scan, fast_scan)
+
+        Parameters:
+            tid : Train id (default the selected train)
         """
-        tid = self.sb_train_id.value()
-        if tid == self._cached_train_stack[0]:
-            return self._cached_train_stack[1]
+        if tid is None:
+            tid = self.sb_train_id.value()
+        return self._get_cached((tid, 'stack'))
 
-        self.main_widget.log.info('Reading train #: %s', tid)
-        _, data = self.rundir.select('*/DET/*', 'image.data').train_from_id(tid)
-        img = stack_detector_data(data, 'image.data')
+    def get_pulse(self, tid=None, pulse=None):
+        """Get a 3D array of a pulse (modules, slow_scan, fast_scan).
 
-        # Probaply raw data with gain dimension - take the data dim
-        if len(img.shape) == 5:
-            img = img[:, 0]  # TODO: confirm if first gain dim is data
-        arr = np.clip(img, 0, None)
+        The pulse is taken from the train if that is cached already,
+        otherwise only the pulse itself is read.
 
-        self._cached_train_stack = (tid, arr)
-        return arr
+        Parameters:
+            tid : Train id (default the selected train)
+            pulse : Pulse index within the train (default the selected pulse)
+        """
+        if tid is None:
+            tid = self.sb_train_id.value()
+        if pulse is None:
+            pulse = self.sb_pulse_id.value()
+        if (tid, 'stack') in self.train_cache:
+            train_stack = self.train_cache.get((tid, 'stack'))
+            if train_stack is not None:
+                return train_stack[pulse]
+        return self._get_cached((tid, 'pulse', pulse))
+
+    def prefetch(self, key, nbytes):
+        """Read the same data of the trains around a train into the cache in
+        the background.
+
+        Up to Defaults.prefetch_trains trains on either side are read,
+        nearest first, but only as many as fit into the cache next to the
+        current train.
+
+        Parameters:
+            key : Cache key of the current data, see _get_cached
+            nbytes : Size of the data of one train in bytes
+        """
+        tid = key[0]
+        if tid not in self._train_ids:
+            return
+        idx = self._train_ids.index(tid)
+        neighbours = []
+        for step in range(1, Defaults.prefetch_trains + 1):
+            for i in (idx + step, idx - step):
+                if 0 <= i < len(self._train_ids):
+                    neighbours.append((self._train_ids[i],) + key[1:])
+        room = int(self.train_cache.max_bytes // max(nbytes, 1)) - 1
+        for neighbour in neighbours[:max(room, 0)]:
+            if neighbour in self.train_cache:
+                continue
+            pending_key = (self._generation,) + neighbour
+            with self._pending_lock:
+                if pending_key in self._pending:
+                    continue
+                self._pending[pending_key] = threading.Event()
+            self._prefetch_pool.start(
+                _TrainReader(self, neighbour, self._generation))
+
+    def _prefetch(self, key, generation):
+        """Read data into the cache, run by a _TrainReader."""
+        try:
+            if generation == self._generation:
+                arr = self._read(key)
+                if generation == self._generation:
+                    self.train_cache.put(key, arr)
+        except Exception as err:
+            self.main_widget.log.warning('Could not prefetch train #: %s (%s)',
+                                         key[0], err)
+        finally:
+            with self._pending_lock:
+                reading = self._pending.pop((generation,) + key, None)
+            if reading is not None:
+                reading.set()
+
+    def _cancel_prefetch(self):
+        """Drop queued prefetches and release anyone waiting for them."""
+        self._prefetch_pool.clear()
+        with self._pending_lock:
+            for reading in self._pending.values():
+                reading.set()
+            self._pending.clear()
+
+    def stop_prefetch(self):
+        """Drop queued prefetches and wait for the running ones."""
+        self._cancel_prefetch()
+        self._prefetch_pool.waitForDone()
+
+    def selection(self):
+        """The current selection as (train id, pulse, reduction method).
+
+        The reduction method is None for single pulses, ('hits', number of
+        pulses) for the mean of the brightest pulses and ('run', method,
+        number of trains) for reductions over several trains, see
+        read_run_reduction. Taking the selection from the widgets first
+        allows read_selection to run in a worker thread. While live data is
+        shown, it is ('live', image) with the newest live image.
+        """
+        if self.live_source is not None and self._live_image is not None:
+            tid, image = self._live_image
+            return (tid, 0, ('live', image))
+        sel_method = self._sel_method
+        if sel_method is hit_mean:
+            sel_method = ('hits', self.sb_top_n.value())
+        elif sel_method is reduce_run:
+            sel_method = ('run', self.cb_run_method.currentText(),
+                          self.sb_n_trains.value())
+        return (self.sb_train_id.value(), self.sb_pulse_id.value(),
+                sel_method)
+
+    def read_run_reduction(self, tid, method, n_trains):
+        """Reduce all pulses of several trains, without using the cache.
+
+        Parameters:
+            tid : First train id
+            method : Reduction, one of io_utils.REDUCTIONS
+            n_trains : Number of trains from tid on
+
+        Returns 3D array (modules, slow_scan, fast_scan)
+        """
+        idx = self._train_ids.index(tid)
+        train_ids = self._train_ids[idx:idx + n_trains]
+        self.main_widget.log.info('Reducing {} trains from #{} ({})'.format(
+            len(train_ids), tid, method))
+        return reduce_run(self.det_data.data, method, by_id[train_ids],
+                          preprocess=self.preprocessor)
+
+    def read_selection(self, selection):
+        """Read the image of a selection without touching the widgets.
 
+        Parameters:
+            selection : (train id, pulse, reduction method), see selection
+
+        Returns 3D array (modules, slow_scan, fast_scan)
+        """
+        tid, pulse, sel_method = selection
+        if sel_method is None:
+            # Only read the selected pulse
+            raw_data = self.get_pulse(tid, pulse)
+        elif isinstance(sel_method, tuple) and sel_method[0] == 'live':
+            # Live images are not cached, they are only shown once
+            return sel_method[1]
+        elif isinstance(sel_method, tuple):
+            key = (tid,) + sel_method
+            raw_data = self.train_cache.get(key)
+            if raw_data is None:
+                if sel_method[0] == 'hits':
+                    raw_data = hit_mean(self.get_train_stack(tid),
+                                        top_n=sel_method[1])
+                else:
+                    raw_data = self.read_run_reduction(tid, *sel_method[1:])
+                self.train_cache.put(key, raw_data)
+        else:
+            # Reductions of a train are cached on their own, they are
+            # small enough to outlive the train stack they came from
+            key = (tid, sel_method.__name__)
+            raw_data = self.train_cache.get(key)
+            # Also kept in the run summary for the next session, unless the
+            # data is preprocessed differently
+            summary = None if self._custom_preprocessor else self.summary
+            if raw_data is None:
+                raw_data = summary.get(*key) if summary else None
+                if raw_data is None:
+                    raw_data = sel_method(self.get_train_stack(tid), axis=0)
+                    try:
+                        if summary:
+                            summary.put(*key, raw_data)
+                    except OSError as err:
+                        self.main_widget.log.warning(
+                            'Could not write the run summary: %s', err)
+                self.train_cache.put(key, raw_data)
+
+        self.main_widget.log.info(self.train_cache.stats())
+        if np.isnan(raw_data).any():
+            # Only copy the cached data if there is anything to replace
+            raw_data = np.nan_to_num(raw_data)
+        return raw_data
 
     def get(self):
         """Get the image of selected train & pulse (or mean/sum).
@@ -285,15 +760,7 @@ class RunDataWidget(QtWidgets.QFrame):
         """
         QtGui.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
         try:
-            train_stack = self.get_train_stack()
-            if self._sel_method is None:
-                # Read the selected train number
-                pulse_num = self.sb_pulse_id.value()
-                raw_data = train_stack[pulse_num]
-            else:
-                raw_data = self._sel_method(train_stack, axis=0)
-
-            return np.nan_to_num(raw_data)
+            return self.read_selection(self.selection())
         finally:
             QtGui.QApplication.restoreOverrideCursor()
 
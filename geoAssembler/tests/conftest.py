@@ -1,7 +1,13 @@
+from collections import namedtuple
 import os.path
+
+import numpy as np
 import pytest
 from unittest import mock
 
+# Synthetic powder rings around a beam offset from the geometry centre
+RingFrame = namedtuple('RingFrame', 'geom stack rings offset sample_dist_m')
+
 @pytest.fixture(scope='session', autouse=True)
 def gui_app():
     import sys
@@ -9,6 +15,36 @@ def gui_app():
     app = QtGui.QApplication(sys.argv)
     yield app
 
+@pytest.fixture(scope='session', autouse=True)
+def summary_cache_dir():
+    """Keep the run summaries of the tests out of the user's cache."""
+    from tempfile import TemporaryDirectory
+    from geoAssembler.defaults import DefaultGeometryConfig as Defaults
+
+    with TemporaryDirectory() as td:
+        with mock.patch.object(Defaults, 'summary_cache_dir', td):
+            yield td
+
+@pytest.fixture(scope='session')
+def ring_frame():
+    """Create AGIPD module data with rings around a beam offset by (3, -2)
+    pixels from the geometry centre, at 0.2 m."""
+    from extra_geom import AGIPD_1MGeometry
+    from .utils import create_ring_stack
+
+    geom = AGIPD_1MGeometry.from_quad_positions(quad_pos=[
+        (-525, 625),
+        (-550, -10),
+        (520, -160),
+        (542.5, 475),
+    ])
+    rings = [10, 15, 20, 25]
+    offset = (3, -2)
+    stack = create_ring_stack(geom, rings, 0.2,
+                              beam_centre=np.multiply(offset, geom.pixel_size))
+    stack.flags.writeable = False  # Shared by all tests
+    return RingFrame(geom, stack, rings, offset, 0.2)
+
 @pytest.fixture(scope='session')
 def mock_run():
     """Create a test run with predev ring data."""
@@ -19,6 +55,16 @@ def mock_run():
          create_test_directory(td)
          yield td
 
+@pytest.fixture(scope='session')
+def mock_long_run():
+    """Create a test run with several trains."""
+    from .utils import create_test_directory
+    from tempfile import TemporaryDirectory
+
+    with TemporaryDirectory() as td:
+         create_test_directory(td, ntrains=4)
+         yield td
+
 @pytest.fixture(scope='module')
 def mock_dialog(mock_run):
     """Create a mock dialog for opening a mock_run."""
@@ -0,0 +1,44 @@
+"""Test the synthetic benchmark suite."""
+import json
+
+import numpy as np
+
+from geoAssembler.benchmark import compare, main, run_benchmarks
+from geoAssembler.defaults import DefaultGeometryConfig as Defaults
+
+
+def test_benchmark(tmp_path):
+    output = tmp_path / 'results.json'
+    assert main(['--output', str(output), '--det', 'AGIPD', '--frames', '1',
+                 '--optimise', 'annuli:global', '--repeat', '1']) == 0
+
+    with open(output) as f:
+        results = json.load(f)['results']
+    benchmarks = [r['benchmark'] for r in results]
+    assert benchmarks == ['position_all_modules', 'integrate2d', 'optimise']
+
+    optimise = results[-1]
+    assert optimise['loss'] == 'annuli'
+    assert optimise['error_px'] < 0.5
+    #  Every quadrant keeps its 1 pixel shift from the mean of the quadrants
+    np.testing.assert_allclose(optimise['quad_error_px'], 1, atol=0.5)
+    assert optimise['frames_per_second'] > 0
+
+    #  Twice as slow as the baseline is a regression, as fast is not
+    slower = [dict(r, seconds=2 * r['seconds']) if 'seconds' in r else r
+              for r in results]
+    regressions = compare(slower, results)
+    assert len(regressions) == len([r for r in results if 'seconds' in r])
+    assert compare(results, results) == []
+
+
+def test_zero_misalignment():
+    """The synthetic rings of every detector are centred on its geometry."""
+    results = run_benchmarks(frame_counts=(1,),
+                             optimise_cases=[('annuli', 'global')],
+                             misalignment=(0, 0), quad_shifts=None,
+                             repeat=1)
+    optimise = [r for r in results if r['benchmark'] == 'optimise']
+    assert [r['detector'] for r in optimise] == list(Defaults.detectors)
+    for record in optimise:
+        assert record['error_px'] < 0.5, record['detector']
@@ -1,13 +1,15 @@
 import geoAssembler.optimiser as centreOptimiser
 import geoAssembler
 
-from extra_data import RunDirectory, stack_detector_data
 from extra_geom import AGIPD_1MGeometry
 
 import numpy as np
+import pytest
 
 import os.path
 
+from .utils import create_ring_stack
+
 geom = AGIPD_1MGeometry.from_quad_positions(quad_pos=[
         (-525, 625),
         (-550, -10),
@@ -17,6 +19,8 @@ geom = AGIPD_1MGeometry.from_quad_positions(quad_pos=[
 
 stacked_mean_path = os.path.dirname(geoAssembler.__file__) + "/tests/optimiser-test-frame.npy"
 
+bounds = [(-10, 10), (-10, 10)]
+
 
 def test_integrator():
     stacked_mean = np.load(stacked_mean_path)
@@ -38,3 +42,224 @@ def test_integrator():
     ))[0][0]
 
     assert 100 < brightest_ring_idx < 110
+
+
+def test_joint_optimise(ring_frame):
+    """The rings loss should find the centre and the sample distance."""
+    optimiser = centreOptimiser.CentreOptimiser(
+        ring_frame.geom, ring_frame.stack, sample_dist_m=0.18,
+        ring_2th_deg=ring_frame.rings
+    )
+    res = optimiser.optimise(bounds, distance_bounds=(0.15, 0.25),
+                             loss="rings", subsample=10, seed=0, report=False)
+
+    np.testing.assert_allclose(res.optimal_offset, ring_frame.offset, atol=0.5)
+    assert res.optimal_sample_dist_m == pytest.approx(0.2, abs=1e-3)
+    assert list(res.trace.columns[:3]) == ["x", "y", "sample_dist_m"]
+
+
+def test_joint_optimise_requires_rings(ring_frame):
+    optimiser = centreOptimiser.CentreOptimiser(
+        ring_frame.geom, ring_frame.stack, sample_dist_m=0.2
+    )
+
+    with pytest.raises(ValueError):
+        optimiser.optimise(distance_bounds=(0.1, 0.3))
+    with pytest.raises(ValueError):
+        optimiser.optimise(loss="annuli")
+
+
+def test_annuli_optimise(ring_frame):
+    """The annuli around calibrant rings should pin down the centre."""
+    calibrant = dict(calibrant='LiTiO2', energy_ev=9300)
+    geom = ring_frame.geom
+    rings = centreOptimiser.CentreOptimiser(
+        geom, ring_frame.stack, 0.2, **calibrant
+    ).ring_2th_deg
+    stack = create_ring_stack(
+        geom, rings, 0.2,
+        beam_centre=np.multiply(ring_frame.offset, geom.pixel_size)
+    )
+
+    optimiser = centreOptimiser.CentreOptimiser(geom, stack, 0.2, **calibrant)
+    res = optimiser.optimise(bounds, loss="annuli", seed=0, report=False)
+    np.testing.assert_allclose(res.optimal_offset, ring_frame.offset, atol=0.5)
+
+
+def test_stratified_subsample(ring_frame):
+    """Every radial stratum should keep the requested fraction of pixels."""
+    optimiser = centreOptimiser.CentreOptimiser(
+        ring_frame.geom, ring_frame.stack, sample_dist_m=0.2
+    )
+    profiler = optimiser.profiler
+
+    subset = profiler.subsample(0.1, seed=0)
+    assert abs(len(subset) / len(profiler) - 0.1) < 0.01
+
+    strata = np.bincount(np.hypot(profiler.x, profiler.y).astype(int))
+    sub_strata = np.bincount(np.hypot(subset.x, subset.y).astype(int),
+                             minlength=len(strata))
+    np.testing.assert_array_equal(sub_strata, np.ceil(strata * 0.1))
+
+    with pytest.raises(ValueError):
+        optimiser.optimise(loss="max", subsample=10)
+
+
+def test_track_centre(ring_frame):
+    """Follow a drifting beam centre with warm-started optimisations."""
+    geom, rings = ring_frame.geom, ring_frame.rings
+    drift = [(2, -1), (3, -1), (4, -2)]
+    frames = np.stack([
+        create_ring_stack(geom, rings, 0.2,
+                          beam_centre=np.multiply(offset, geom.pixel_size))
+        for offset in drift
+    ])
+
+    table = centreOptimiser.track_centre(
+        geom, frames, 0.2, bounds=bounds, window=2,
+        ids=[10, 11, 12], chunk_size=3,
+        optimiser_kwargs=dict(ring_2th_deg=rings),
+        optimise_kwargs=dict(loss="annuli", seed=0),
+    )
+
+    assert list(table.index) == [10, 11, 12]
+    np.testing.assert_allclose(table[["x", "y"]].values, drift, atol=0.5)
+
+
+def test_geometry_assembler_input(ring_frame):
+    """A GeometryAssembler should give the same results as extra_geom."""
+    from ..geometry import AGIPDGeometry
+
+    geom, stack, rings = ring_frame.geom, ring_frame.stack, ring_frame.rings
+    reference = centreOptimiser.CentreOptimiser(
+        geom, stack, 0.2, ring_2th_deg=rings
+    )
+    optimiser = centreOptimiser.CentreOptimiser(
+        AGIPDGeometry(geom), stack, 0.2, ring_2th_deg=rings
+    )
+
+    assert not hasattr(optimiser, "module_stack")
+    np.testing.assert_array_equal(optimiser.frame, reference.frame)
+    assert optimiser.integrator.centre == reference.integrator.centre
+    assert len(optimiser.profiler) == len(reference.profiler)
+
+    kwargs = dict(loss="rings", method="local", report=False)
+    res = optimiser.optimise(bounds, **kwargs)
+    ref = reference.optimise(bounds, **kwargs)
+    #  The first evaluations are the same candidates
+    np.testing.assert_allclose(res.trace["loss"].values[:5],
+                               ref.trace["loss"].values[:5], rtol=1e-9)
+    np.testing.assert_allclose(res.optimal_offset, ref.optimal_offset,
+                               atol=0.1)
+
+
+def test_optimise_trace_and_cancel(ring_frame):
+    """Every evaluation should be traced, and the callback can cancel."""
+    optimiser = centreOptimiser.CentreOptimiser(
+        ring_frame.geom, ring_frame.stack, 0.2, ring_2th_deg=ring_frame.rings
+    )
+    kwargs = dict(bounds=[(-5, 5), (-5, 5)], loss="annuli", seed=0,
+                  report=False)
+
+    res = optimiser.optimise(**kwargs)
+    trace = res.trace
+    assert len(trace) == res.results.nfev
+    assert list(trace.columns[:2]) == ["x", "y"]
+    assert trace["best_loss"].is_monotonic_decreasing
+    assert trace["best_loss"].iloc[-1] == pytest.approx(res.results.fun)
+    assert (trace[["integrate_s", "reduce_s"]] >= 0).all(axis=None)
+    np.testing.assert_allclose(res.optimal_offset, ring_frame.offset, atol=0.5)
+
+    seen = []
+    def stop_after_20(info):
+        seen.append(info)
+        return info.nfev >= 20
+
+    res = optimiser.optimise(callback=stop_after_20, **kwargs)
+    assert not res.results.success
+    assert len(seen) == len(res.trace) == 20
+    assert res.results.fun == seen[-1].best_loss
+    np.testing.assert_array_equal(res.optimal_offset, seen[-1].best_params)
+
+
+def test_optimise_workers(ring_frame):
+    """Candidates evaluated by worker processes are traced here."""
+    optimiser = centreOptimiser.CentreOptimiser(
+        ring_frame.geom, ring_frame.stack, 0.2, ring_2th_deg=ring_frame.rings
+    )
+    res = optimiser.optimise(bounds, loss="annuli", seed=0, workers=2,
+                             report=False)
+
+    assert len(res.trace) == res.results.nfev
+    assert res.trace["integrate_s"].gt(0).all()
+    np.testing.assert_allclose(res.optimal_offset, ring_frame.offset, atol=0.5)
+
+
+def test_masking(ring_frame, tmp_path):
+    """Masked pixels should be dropped from the profiler once."""
+    geom = ring_frame.geom
+    stack = ring_frame.stack + np.random.default_rng(0).normal(
+        10, 1, ring_frame.stack.shape)
+    n_pixels = stack.size
+
+    edges = centreOptimiser.edge_mask(geom, 1)
+    #  AGIPD tiles are 64 x 128 pixels
+    assert edges.sum() == 16 * 8 * (64 * 128 - 62 * 126)
+
+    stack[0, 100, 50] = 1e6  # hot
+    stack[1, 200:210, 20] = np.nan  # dead
+    bad = centreOptimiser.detect_bad_pixels(stack)
+    assert bad[0, 100, 50] and bad[1, 200:210, 20].all()
+    assert bad.sum() == 11
+
+    #  Exact zeros, like the background of the rings, are only dead on request
+    zeros = ring_frame.stack == 0
+    assert zeros.sum() > n_pixels / 2
+    assert not centreOptimiser.detect_bad_pixels(ring_frame.stack).any()
+    assert centreOptimiser.detect_bad_pixels(ring_frame.stack,
+                                             zero_is_dead=True)[zeros].all()
+
+    static = np.zeros(geom.expected_data_shape, dtype=np.uint8)
+    static[5] = 1
+    np.save(tmp_path / "mask.npy", static)
+
+    optimiser = centreOptimiser.CentreOptimiser(
+        geom, stack, 0.2, mask=str(tmp_path / "mask.npy"), edge_width=1,
+        bad_pixel_sigma=10,
+    )
+    expected = static.astype(bool) | edges | bad
+    np.testing.assert_array_equal(optimiser.mask, expected)
+    assert len(optimiser.profiler) == n_pixels - expected.sum()
+    assert np.isnan(optimiser.frame).sum() > expected.sum()
+    #  The pyFAI integration skips them as well
+    np.testing.assert_array_equal(optimiser.integrator.ai.mask.astype(bool),
+                                  np.isnan(optimiser.frame))
+
+
+def test_width_optimise(ring_frame):
+    """The ring width loss should be smooth enough for a local optimiser."""
+    optimiser = centreOptimiser.CentreOptimiser(
+        ring_frame.geom, ring_frame.stack, 0.2
+    )
+    res = optimiser.optimise(bounds, loss="width", method="local",
+                             report=False)
+    np.testing.assert_allclose(res.optimal_offset, ring_frame.offset, atol=0.5)
+    assert res.results.nfev < 200
+
+    with pytest.raises(ValueError):
+        optimiser.optimise(loss="width", distance_bounds=(0.1, 0.3))
+    with pytest.raises(ValueError):
+        optimiser.optimise(loss="width", method="local", workers=2)
+
+
+def test_width_optimise_lpd():
+    """The ring windows should follow the ring width on large LPD pixels."""
+    from ..benchmark import create_geometry, synthetic_rings
+
+    geom = create_geometry("LPD")
+    frames, _ = synthetic_rings(geom, misalignment=(4.5, -3), seed=0)
+    optimiser = centreOptimiser.CentreOptimiser(geom, frames[0], 0.2)
+    res = optimiser.optimise([(-20, 20), (-20, 20)], loss="width",
+                             method="local", report=False)
+    #  The profile bins are one of the large pixels wide
+    np.testing.assert_allclose(res.optimal_offset, (4.5, -3), atol=1)
@@ -1,4 +1,5 @@
 import numpy as np
+import pytest
 
 from ..geometry import AGIPDGeometry
 
@@ -85,3 +86,229 @@ def get_quad_corners():
     assert width == 530
     assert height == 603
 
+
+def test_assembly_map_canvas():
+    """Assemble into a canvas and rebuild the map after moving a quad."""
+    geom = AGIPDGeometry.from_quad_positions(quad_pos=[
+        (-525, 625),
+        (-550, -10),
+        (520, -160),
+        (542.5, 475),
+    ])
+    stacked_data = np.random.random((16, 512, 128))
+    img, centre = geom.position_all_modules(stacked_data)
+    canvas, cv_centre = geom.position_all_modules(stacked_data,
+                                                 canvas=(1556, 1392))
+    assert tuple(cv_centre) == (778, 696)
+    shift = cv_centre - centre
+    np.testing.assert_array_equal(
+        canvas[shift[0]:shift[0] + img.shape[0],
+               shift[1]:shift[1] + img.shape[1]], img)
+
+    assembly_map = geom.assembly_map
+    geom.move_quad(1, np.array((2, 0)))
+    assert geom.assembly_map is not assembly_map
+    np.testing.assert_array_equal(geom.assembly_map.x[:4],
+                                  assembly_map.x[:4] + 2)
+
+def test_canvas_geometry():
+    """The canvas is known from the geometry and reused for assembly."""
+    geom = AGIPDGeometry.from_quad_positions(quad_pos=[
+        (-525, 625),
+        (-550, -10),
+        (520, -160),
+        (542.5, 475),
+    ])
+    stacked_data = np.random.random((16, 512, 128)).astype(np.float32)
+    img, centre = geom.position_all_modules(stacked_data)
+    shape, geom_centre = geom.canvas_geometry()
+    assert shape == img.shape
+    np.testing.assert_array_equal(geom_centre, centre)
+
+    shape, cv_centre = geom.canvas_geometry(margin=300)
+    assert shape == (img.shape[0] + 300, img.shape[1] + 300)
+    canvas = np.zeros(shape, dtype=np.float32)
+    out, centre = geom.position_all_modules(stacked_data, canvas=shape,
+                                            out=canvas)
+    assert out is canvas
+    np.testing.assert_array_equal(centre, cv_centre)
+    np.testing.assert_array_equal(
+        out, geom.position_all_modules(stacked_data, canvas=shape)[0])
+    with pytest.raises(ValueError):
+        geom.position_all_modules(stacked_data, out=canvas)
+
+def test_pixel_at():
+    """Positions in the assembled image map back to module pixels."""
+    geom = AGIPDGeometry.from_quad_positions(quad_pos=[
+        (-525, 625),
+        (-550, -10),
+        (520, -160),
+        (542.5, 475),
+    ])
+    pixel_ids = np.arange(16 * 512 * 128, dtype=np.float64)
+    canvas_shape = (1556, 1392)
+    img, _ = geom.position_all_modules(pixel_ids.reshape(16, 512, 128),
+                                       canvas=canvas_shape)
+    rng = np.random.default_rng(0)
+    filled = np.argwhere(~np.isnan(img))
+    for y, x in filled[rng.choice(len(filled), 200)]:
+        label = geom.pixel_at(y, x, canvas=canvas_shape)
+        module, ss, fs = np.unravel_index(int(img[y, x]), (16, 512, 128))
+        assert label[1:] == (module, ss // 64, ss, fs)
+        assert label.quadrant == module // 4 + 1
+    y, x = np.argwhere(np.isnan(img))[0]
+    assert geom.pixel_at(y, x, canvas=canvas_shape) is None
+    assert geom.pixel_at(-1, 0) is None
+
+    label_map = geom.label_map
+    assert geom.label_map is label_map
+    geom.move_quad(1, np.array((2, 0)))
+    assert geom.label_map is not label_map
+
+def test_read_train(mock_long_run):
+    """Parallel module reads should match stack_detector_data."""
+    from extra_data import RunDirectory, stack_detector_data
+    from ..io_utils import read_train
+
+    run = RunDirectory(mock_long_run)
+    tid = run.train_ids[1]
+    _, data = run.select('*/DET/*', 'image.data').train_from_id(tid)
+    expected = stack_detector_data(data, 'image.data')
+
+    train = read_train(run, tid, workers=4)
+    assert train.shape == expected.shape
+    np.testing.assert_array_equal(train, expected)
+
+def test_reduce_run(mock_long_run):
+    """Streaming reductions should match the reductions of all frames."""
+    from extra_data import RunDirectory, by_index
+    from ..io_utils import read_train, reduce_run
+
+    run = RunDirectory(mock_long_run)
+    frames = np.concatenate([read_train(run, tid)
+                             for tid in run.train_ids[1:]])
+    for method, func in (('mean', np.nanmean), ('sum', np.nansum),
+                         ('max', np.nanmax), ('median', np.nanmedian)):
+        reduced = reduce_run(run, method, trains=by_index[1:], workers=4)
+        assert reduced.shape == frames.shape[1:]
+        np.testing.assert_allclose(reduced, func(frames, axis=0), rtol=1e-5)
+
+def test_memmap_frames(mock_long_run, tmpdir):
+    """Contiguous datasets should be memory mapped, chunked ones read."""
+    from extra_data import RunDirectory, by_id
+    from ..io_utils import memmap_frames, read_train, reduce_run
+    from .utils import create_test_directory
+
+    create_test_directory(str(tmpdir), ntrains=4, contiguous=True)
+    chunked, contiguous = RunDirectory(mock_long_run), RunDirectory(str(tmpdir))
+    source = 'SPB_DET_AGIPD1M-1/DET/3CH0:xtdf'
+    for run, mapped in ((chunked, False), (contiguous, True)):
+        key_data = run[source, 'image.data'].select_trains(by_id[[10002]])
+        frames = memmap_frames(key_data)
+        assert (frames is not None) == mapped
+        if mapped:
+            np.testing.assert_array_equal(frames, key_data.ndarray())
+
+    np.testing.assert_array_equal(read_train(contiguous, 10002),
+                                  read_train(chunked, 10002))
+    np.testing.assert_allclose(reduce_run(contiguous, 'mean'),
+                               reduce_run(chunked, 'mean'))
+
+def test_reduce_hits(mock_long_run):
+    """Only the brightest frames of the run should be averaged."""
+    from extra_data import RunDirectory, by_index
+    from ..io_utils import frame_intensity, read_train, reduce_hits
+
+    run = RunDirectory(mock_long_run)
+    frames = np.concatenate([read_train(run, tid)
+                             for tid in run.train_ids[1:]])
+    intensity = frame_intensity(frames)
+    # Between two intensities, so that rounding does not decide about the
+    # frames (every train of the test run has the same pulses)
+    levels = np.unique(intensity)
+    threshold = levels[len(levels) // 2 - 1:][:2].mean()
+
+    mean, hits = reduce_hits(run, threshold=threshold, trains=by_index[1:])
+    selected = np.nonzero(intensity >= threshold)[0]
+    assert hits == [(run.train_ids[1 + idx // 5], idx % 5) for idx in selected]
+    np.testing.assert_allclose(mean, np.nanmean(frames[selected], axis=0),
+                               rtol=1e-5)
+
+def test_preprocess(mock_run):
+    """Preprocessing should run in place on float32 module data."""
+    from extra_data import RunDirectory
+    from ..io_utils import read_train
+    from ..preprocess import Preprocessor
+
+    run = RunDirectory(mock_run)
+    train = read_train(run, 10000)
+    dark = np.random.default_rng(0).normal(0, 5, train.shape[1:])
+    processed = read_train(run, 10000, preprocess=Preprocessor(dark=dark))
+    assert processed.dtype == np.float32
+    np.testing.assert_allclose(
+        processed, np.clip(train - dark.astype(np.float32), 0, None),
+        rtol=1e-6)
+
+    frames = np.array([[[np.nan, -3], [1, 4]]], dtype=np.float32)
+    preprocess = Preprocessor(clip_min=0, nan_value=-1)
+    assert preprocess.process_module(frames, 0) is frames
+    np.testing.assert_array_equal(frames, [[[-1, 0], [1, 4]]])
+
+def test_dark_common_mode(mock_run, tmpdir):
+    """Dark offsets should be cached and common modes removed per ASIC."""
+    from extra_data import RunDirectory
+    from ..io_utils import read_train
+    from ..preprocess import Preprocessor, load_dark
+
+    run = RunDirectory(mock_run)
+    dark, cells = load_dark(mock_run, str(tmpdir))
+    # The test run has one frame of each of the cells 0 to 4
+    np.testing.assert_array_equal(cells, np.arange(5))
+    np.testing.assert_allclose(dark, read_train(run, 10000), rtol=1e-5)
+    assert [f.basename.endswith('-dark.npz') for f in tmpdir.listdir()] == [True]
+    assert load_dark(mock_run, str(tmpdir))[0] is dark
+    # Every frame gets the offset of its own cell
+    processed = read_train(run, 10000, preprocess=Preprocessor(
+        clip_min=None, dark=dark, dark_cells=cells))
+    np.testing.assert_allclose(np.nan_to_num(processed), 0, atol=1e-3)
+
+    # Cells are looked up by id, the pulse index only stands in without ids
+    offsets = np.arange(3, dtype=np.float32).reshape(3, 1, 1, 1)
+    offsets = np.tile(offsets, (1, 2, 2, 2))
+    preprocess = Preprocessor(clip_min=None, dark=offsets,
+                              dark_cells=[4, 8, 12])
+    frames = np.full((2, 2, 2), 10, dtype=np.float32)
+    preprocess.process_module(frames, 1, cells=[12, 4])
+    np.testing.assert_array_equal(frames[:, 0, 0], [8, 10])
+    with pytest.raises(ValueError):
+        preprocess.process_module(frames, 1)
+
+    rng = np.random.default_rng(0)
+    frames = rng.normal(0, 1, (3, 128, 256)).astype(np.float32)
+    common_modes = rng.normal(100, 20, (3, 2, 4))
+    frames += np.kron(common_modes, np.ones((64, 64))).astype(np.float32)
+    Preprocessor(clip_min=None, common_mode=True).process_module(frames, 0)
+    asics = frames.reshape(3, 2, 64, 4, 64)
+    np.testing.assert_allclose(np.median(asics, axis=(2, 4)), 0, atol=1e-4)
+    assert abs(frames.std() - 1) < 0.05
+
+def test_pickle():
+    """The geometry can be sent to worker processes with its caches."""
+    import pickle
+
+    geom = AGIPDGeometry.from_quad_positions(quad_pos=[
+        (-525, 625),
+        (-550, -10),
+        (520, -160),
+        (542.5, 475),
+    ])
+    assembly_map = geom.assembly_map
+    restored = pickle.loads(pickle.dumps(geom))
+    assert restored.version == geom.version
+    assert restored._lock is not geom._lock
+    np.testing.assert_array_equal(restored.assembly_map.x, assembly_map.x)
+
+    restored.move_quad(1, np.array((2, 0)))
+    np.testing.assert_array_equal(restored.assembly_map.x[:4],
+                                  assembly_map.x[:4] + 2)
+    assert geom.assembly_map is assembly_map
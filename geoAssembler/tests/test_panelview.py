@@ -1,13 +1,22 @@
 import os
+import time
 
 import numpy as np
+import pytest
 from pyqtgraph import QtCore
 from PyQt5.QtTest import QTest
 
+from ..defaults import DefaultGeometryConfig as Defaults
 from ..geometry import AGIPDGeometry
 from geoAssembler.qt.app import QtMainWidget
 
 
+def wait_for_assembly(calib):
+    """Wait for the assembly worker and display its result."""
+    calib._assembly_pool.waitForDone()
+    QtCore.QCoreApplication.processEvents()
+
+
 def test_defaults(mock_dialog, gui_app):
     """Test default settings."""
     # Click add circle btn when no image is selected, check for circles
@@ -101,3 +110,274 @@ def test_save_geo(mock_dialog, mock_save, mock_warning, save_geo, calib):
         QTest.mouseClick(calib.geom_selector.bt_save, QtCore.Qt.LeftButton)
     geom = AGIPDGeometry.from_crystfel_geom(save_geo)
     assert isinstance(geom, AGIPDGeometry)
+
+def test_train_cache(mock_dialog, calib):
+    """Test that trains and their means are cached within the budget."""
+    from geoAssembler.qt.cache import TrainCache
+
+    with mock_dialog:
+        QTest.mouseClick(calib.run_selector.bt_select_run_dir, QtCore.Qt.LeftButton)
+    cache = calib.run_selector.train_cache
+    assert (10000, 'pulse', 0) in cache
+    assert (10000, 'stack') not in cache
+    misses = cache.misses
+    calib.run_selector.get()
+    assert cache.misses == misses and cache.hits > 0
+    QTest.mouseClick(calib.run_selector.rb_mean, QtCore.Qt.LeftButton)
+    wait_for_assembly(calib)
+    assert (10000, 'stack') in cache and (10000, 'nanmean') in cache
+    # Pulses are taken from the cached train now
+    QTest.mouseClick(calib.run_selector.rb_pulse, QtCore.Qt.LeftButton)
+    calib.run_selector.sb_pulse_id.setValue(3)
+    wait_for_assembly(calib)
+    assert (10000, 'pulse', 3) not in cache
+
+    # Least recently used entries are evicted first
+    cache = TrainCache(max_bytes=3 * 800)
+    for key in range(3):
+        cache.put(key, np.zeros(100))
+    cache.get(0)
+    cache.put(3, np.zeros(100))
+    assert 1 not in cache and 0 in cache and len(cache) == 3
+    cache.put(4, np.zeros(1000))
+    assert 4 not in cache and cache.nbytes == 3 * 800
+
+def test_prefetch(mock_long_run, calib):
+    """Test that the trains around the current one are read ahead."""
+    selector = calib.run_selector
+    selector.read_rundir(mock_long_run)
+    selector.stop_prefetch()
+    cache = selector.train_cache
+    assert [(tid, 'pulse', 0) in cache for tid in range(10000, 10004)] == \
+        [True, True, True, False]
+
+    misses = cache.misses
+    selector.sb_train_id.setValue(10001)
+    wait_for_assembly(calib)
+    assert cache.misses == misses
+    selector.stop_prefetch()
+    assert (10003, 'pulse', 0) in cache
+
+    # Whole trains are only read, and read ahead, in mean mode
+    assert not any((tid, 'stack') in cache for tid in range(10000, 10004))
+    QTest.mouseClick(selector.rb_mean, QtCore.Qt.LeftButton)
+    wait_for_assembly(calib)
+    selector.stop_prefetch()
+    assert all((tid, 'stack') in cache for tid in range(10000, 10004))
+
+def test_async_assembly(mock_long_run, calib):
+    """Test that only the latest of several quick selections is displayed."""
+    selector = calib.run_selector
+    selector.read_rundir(mock_long_run)
+    shown = []
+    calib.assembly_signals.done.connect(lambda request, _: shown.append(request))
+
+    for pulse in (1, 2, 3):
+        selector.sb_pulse_id.setValue(pulse)
+    wait_for_assembly(calib)
+
+    assert shown[-1] == calib._assembly_request
+    expected = selector.read_selection((10000, 3, None))
+    np.testing.assert_array_equal(calib.raw_data, expected)
+    assert calib.data.shape == calib.canvas.shape
+
+def test_run_reduction(mock_long_run, calib):
+    """Test reducing the pulses of several trains in the viewer."""
+    selector = calib.run_selector
+    selector.read_rundir(mock_long_run)
+    QTest.mouseClick(selector.rb_run, QtCore.Qt.LeftButton)
+    selector.cb_run_method.setCurrentText('max')
+    selector.sb_n_trains.setValue(3)
+    wait_for_assembly(calib)
+    assert selector.selection() == (10000, 0, ('run', 'max', 3))
+    assert (10000, 'run', 'max', 3) in selector.train_cache
+
+    stacks = [selector.read_train_stack(tid) for tid in (10000, 10001, 10002)]
+    expected = np.nanmax(np.concatenate(stacks), axis=0)
+    np.testing.assert_allclose(calib.raw_data, np.nan_to_num(expected))
+
+def test_run_summary(mock_long_run, calib):
+    """Test that a run is reopened from its summary without reading it."""
+    selector = calib.run_selector
+    selector.read_rundir(mock_long_run)
+    QTest.mouseClick(selector.rb_mean, QtCore.Qt.LeftButton)
+    wait_for_assembly(calib)
+    mean = calib.raw_data
+    selector.stop_prefetch()
+
+    selector.read_rundir(mock_long_run)
+    assert selector._rundir is None
+    assert selector._train_ids == [10000, 10001, 10002, 10003]
+    assert selector.sb_pulse_id.maximum() == 4
+    wait_for_assembly(calib)
+    assert selector._rundir is None
+    np.testing.assert_array_equal(calib.raw_data, mean)
+
+    # Changed run files invalidate the summary
+    fname = sorted(os.listdir(mock_long_run))[0]
+    os.utime(os.path.join(mock_long_run, fname))
+    selector.read_rundir(mock_long_run)
+    assert selector._rundir is not None
+
+def test_hits(mock_long_run, calib):
+    """Test averaging only the brightest pulses of a train."""
+    from ..io_utils import frame_intensity
+
+    selector = calib.run_selector
+    selector.read_rundir(mock_long_run)
+    QTest.mouseClick(selector.rb_hits, QtCore.Qt.LeftButton)
+    selector.sb_top_n.setValue(2)
+    wait_for_assembly(calib)
+    assert selector.selection() == (10000, 0, ('hits', 2))
+
+    train_stack = selector.read_train_stack(10000)
+    brightest = np.argsort(frame_intensity(train_stack))[-2:]
+    expected = np.nanmean(train_stack[brightest], axis=0)
+    np.testing.assert_allclose(calib.raw_data, np.nan_to_num(expected))
+
+def test_dark_run(mock_run, calib):
+    """Test subtracting the dark offset of every memory cell in the viewer."""
+    selector = calib.run_selector
+    selector.read_rundir(mock_run)
+    QTest.mouseClick(selector.rb_pulse, QtCore.Qt.LeftButton)
+    selector.sb_pulse_id.setValue(3)
+    wait_for_assembly(calib)
+    raw = calib.raw_data
+
+    # The run is its own dark run, every pulse is the offset of its cell
+    selector.read_dark(mock_run)
+    wait_for_assembly(calib)
+    dark = selector.preprocessor.dark
+    assert dark.shape == (5,) + raw.shape
+    np.testing.assert_allclose(np.nan_to_num(dark[3]), raw, rtol=1e-5)
+    np.testing.assert_allclose(calib.raw_data, 0, atol=1e-3)
+    np.testing.assert_allclose(np.nan_to_num(selector.read_pulse(10000, 3)),
+                               0, atol=1e-3)
+    # Unlike the mean offset of all cells
+    mean_dark = np.nan_to_num(dark.mean(axis=0))
+    assert np.clip(raw - mean_dark, 0, None).max() > 1
+
+    selector.cb_common_mode.setChecked(True)
+    wait_for_assembly(calib)
+    assert selector.preprocessor.common_mode
+    assert selector.preprocessor.asic_shape == (64, 64)
+
+def test_live_layouts():
+    """Test stacking the detector data of karabo-bridge messages."""
+    from ..qt.live import module_stack_from_bridge
+
+    stack = np.random.rand(3, 16, 512, 128)
+    online = {'SPB_DET_AGIPD1M-1/CAL/APPEND_CORRECTED':
+              {'image.data': stack.transpose(1, 3, 2, 0)}}
+    np.testing.assert_array_equal(
+        module_stack_from_bridge(online, module_shape=(512, 128)), stack)
+    offline = {'SPB_DET_AGIPD1M-1/CAL/APPEND_CORRECTED': {'image.data': stack}}
+    np.testing.assert_array_equal(
+        module_stack_from_bridge(offline, module_shape=(512, 128)), stack)
+    modules = {'SPB_DET_AGIPD1M-1/DET/{}CH0:xtdf'.format(modno):
+               {'image.data': stack[:, modno]} for modno in range(16)}
+    np.testing.assert_array_equal(module_stack_from_bridge(modules), stack)
+    with pytest.raises(ValueError):
+        module_stack_from_bridge({'SA1_XTD2_XGM/DOOCS/MAIN': {}})
+
+def test_rolling_mean():
+    """Missing pixels should be averaged over the trains that have them."""
+    from ..qt.live import RollingMean
+
+    rolling = RollingMean(2)
+    rolling.add(np.array([1., np.nan, np.nan]))
+    rolling.add(np.array([3., 4., np.nan]))
+    np.testing.assert_array_equal(rolling.mean(), [2, 4, np.nan])
+    rolling.add(np.array([5., np.nan, np.nan]))
+    assert len(rolling) == 2
+    np.testing.assert_array_equal(rolling.mean(), [4, 4, np.nan])
+    assert rolling.mean().dtype == np.float32
+
+def test_live(mock_long_run, calib):
+    """Test showing a rolling average of live data from a karabo-bridge."""
+    server_mod = pytest.importorskip('karabo_bridge.server')
+    from extra_data import RunDirectory
+    from ..io_utils import read_train
+
+    run = RunDirectory(mock_long_run)
+    server = server_mod.ServerInThread('tcp://127.0.0.1:*')
+    server.start()
+    selector = calib.run_selector
+    selector.sb_live_average.setValue(2)
+    selector.start_live(server.endpoint)
+    source = selector.live_source
+    try:
+        for tid in (10000, 10001):
+            server.feed(run.train_from_id(tid)[1])
+        deadline = time.time() + 10
+        while source.received < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        selector._show_live()
+        wait_for_assembly(calib)
+        tid, _, sel_method = selector.selection()
+    finally:
+        selector.stop_live()
+        server.stop()
+
+    assert not source.running and source.error is None
+    assert (source.received, source.dropped) == (2, 1)
+    assert tid == 10001 and sel_method[0] == 'live'
+    means = [np.nan_to_num(np.nanmean(read_train(run, tid), axis=0))
+             for tid in (10000, 10001)]
+    np.testing.assert_allclose(calib.raw_data, np.mean(means, axis=0),
+                               rtol=1e-5)
+    assert not selector.bt_live.isChecked()
+
+def test_coalesced_moves(mock_run, calib, monkeypatch):
+    """Test that quick quadrant moves cause one geometry update and redraw."""
+    calib.run_selector.read_rundir(mock_run)
+    wait_for_assembly(calib)
+    calib._draw_rect(1)
+    geom = calib.geom_obj
+    moves, redraws = [], []
+    move_quad, redraw_image = geom.move_quad, calib.redraw_image
+    monkeypatch.setattr(geom, 'move_quad', lambda quad, inc: (
+        moves.append((quad, tuple(inc))), move_quad(quad, inc)))
+    monkeypatch.setattr(calib, 'redraw_image', lambda: (
+        redraws.append(1), redraw_image()))
+
+    monkeypatch.setattr(Defaults, 'move_acceleration', 1)
+    for _ in range(10):
+        calib._move_right()
+    assert not moves
+    QTest.qWait(3 * Defaults.move_interval_ms)
+    assert moves == [(1, (10, 0))]
+    assert len(redraws) == 1
+
+    # Steps grow while a key is held
+    monkeypatch.setattr(Defaults, 'move_acceleration', 2)
+    calib._last_move = None
+    for _ in range(5):
+        calib._move_up()
+    QTest.qWait(3 * Defaults.move_interval_ms)
+    assert moves[-1] == (1, (0, 1 + 2 + 4 + 8 + Defaults.move_max_step))
+    assert len(redraws) == 2
+
+def test_hover(mock_run, calib):
+    """Test the readout of the detector pixel under the cursor."""
+    calib.run_selector.read_rundir(mock_run)
+    wait_for_assembly(calib)
+    # The image is shown upside down
+    Y, X = calib.data.shape
+    filled = np.argwhere(~np.isnan(calib.data))
+    y, x = filled[len(filled) // 2]
+    label = calib.geom_obj.pixel_at(y, x, canvas=calib.data.shape)
+    scene_pos = calib.imv.getImageItem().mapToScene(
+        QtCore.QPointF(x + 0.5, Y - 1 - y + 0.5))
+    calib._hover((scene_pos,))
+
+    message = calib.statusBar().currentMessage()
+    value = calib.raw_data[label.module, label.ss, label.fs]
+    assert message.startswith('y: {}, x: {}'.format(y, x))
+    assert 'module {}, tile {}'.format(label.module, label.tile) in message
+    # Common mode blocks of AGIPD are the 64 x 64 pixel ASICs
+    block = (label.ss // 64) * 2 + label.fs // 64
+    assert 'common mode block {},'.format(block) in message
+    assert 'ss {}, fs {}'.format(label.ss, label.fs) in message
+    assert message.endswith('value {:g}'.format(value))
+    assert calib.data[y, x] == value
@@ -10,8 +10,11 @@ from extra_data.tests.mockdata import write_file
 LOOKUP = {'AGIPD':(AGIPDModule, 'SPB_DET_AGIPD1M-1'),
           'LPD':(LPDModule, 'FXE_DET_LPD1M-1')}
 
-def create_test_directory(path_dir, det='AGIPD'):
-    """Create a mock RunDirectory and add test-data to it."""
+def create_test_directory(path_dir, det='AGIPD', ntrains=1, contiguous=False):
+    """Create a mock RunDirectory and add test-data to it.
+
+    With contiguous the image data is stored unchunked, like corrected data.
+    """
     test_file = os.path.join(os.path.dirname(__file__),
                              'data_{}.npz'.format(det.lower()))
     raw_data = np.load(test_file)['data']
@@ -22,8 +25,34 @@ def create_test_directory(path_dir, det='AGIPD'):
         path = os.path.join(path_dir, fname)
         write_file(path, [DetModule('{}/DET/{}CH0'.format(det_path, modno),
                                       raw=False, frames_per_train=5)],
-                        ntrains=1, chunksize=1)
+                        ntrains=ntrains, chunksize=1)
         with File(os.path.join(path_dir, fname), 'a') as f:
-            f[dset][:] = raw_data[modno]
+            data = np.concatenate([raw_data[modno]] * ntrains)
+            if contiguous:
+                dtype = f[dset].dtype
+                del f[dset]
+                f.create_dataset(dset, data=data.astype(dtype))
+            else:
+                f[dset][:] = data
+
 
+def create_ring_stack(geom, ring_2th_deg, sample_dist_m, beam_centre=(0, 0),
+                      width_deg=0.05):
+    """Create a module stack with Gaussian powder rings.
 
+    Parameters:
+        geom (DetectorGeometryBase): extra_geom geometry of the detector
+        ring_2th_deg (list): 2theta positions of the rings in degrees
+        sample_dist_m (float): Distance from the detector to the sample
+    Keywords:
+        beam_centre (tuple): x, y position of the beam in m (default (0, 0))
+        width_deg (float): Standard deviation of the rings in degrees
+    """
+    pos = geom.get_pixel_positions()
+    radii = np.hypot(pos[..., 0] - beam_centre[0],
+                     pos[..., 1] - beam_centre[1])
+    tth = np.degrees(np.arctan2(radii, sample_dist_m))
+    data = np.zeros(tth.shape)
+    for ring in ring_2th_deg:
+        data += np.exp(-0.5 * ((tth - ring) / width_deg)**2)
+    return data
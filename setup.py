@@ -69,6 +69,9 @@ setup(name="geoAssembler",
               'nbsphinx',
               'ipython',  # For nbsphinx syntax highlighting
           ],
+          'live': [
+              'karabo-bridge',
+          ],
           'test': [
               'pytest',
               'testpath',